@@ -0,0 +1,29 @@
+'''
+gunicorn settings of the api container: API_WORKERS uvicorn workers (one per core by default).
+Every worker loads the configs and runs its own event loop, decode pool and prediction cache; the id tables are memory
+mapped from SHARED_METADATA_DIR (see utils/routing.py) and the prometheus metrics of all of the workers are summed
+through PROMETHEUS_MULTIPROC_DIR.
+'''
+import multiprocessing
+import os
+import shutil
+
+bind = '0.0.0.0:5000'
+worker_class = 'uvicorn.workers.UvicornWorker'
+workers = int(os.getenv('API_WORKERS') or multiprocessing.cpu_count())
+timeout = 120
+
+
+def on_starting(server):
+    # the metrics (and shared tables) of the previous run would be picked up otherwise
+    for env in ('PROMETHEUS_MULTIPROC_DIR', 'SHARED_METADATA_DIR'):
+        shared_dir = os.getenv(env)
+        if shared_dir:
+            shutil.rmtree(shared_dir, ignore_errors=True)
+            os.makedirs(shared_dir)
+
+
+def child_exit(server, worker):
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
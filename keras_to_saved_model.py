@@ -1,32 +1,175 @@
 import logging
 import os
+import pickle
+import tomllib
 
 import tensorflow as tf
 
+from tensorflow import keras
 from tensorflow.keras import models
 
+# name of the signature that takes the encoded (jpeg/png) images, see src/utils/tfs_client.py
+BYTES_SIGNATURE_NAME = 'serve_bytes'
+BYTES_INPUT_NAME = 'image_bytes'
 
-def keras_to_saved_model(source: str, target: str): 
+# the fused model is served as one more model of the product line, its ids are the _ids of all of the final models
+# see src/utils/tfs_models.py (identify_fused)
+FUSED_MODEL_NAME = 'fused'
+ROOT_MODEL_NAME = 'm0'
+
+
+def make_serve_bytes(fn, img_height: int, img_width: int, channels: int):
+    '''
+    Wraps fn (called on the preprocessed float32 batch) so it takes the encoded image files as a string batch (N,),
+    doing the decode, the resize to the model's input size and the /255 scaling inside of the graph.
+    '''
+    def decode(image_bytes):
+        img = tf.io.decode_image(image_bytes, channels=channels, expand_animations=False)
+        img = tf.image.resize(img, [img_height, img_width])
+        return img / 255.0
+
+    def serve_bytes(image_bytes):
+        images = tf.map_fn(
+                decode,
+                image_bytes,
+                fn_output_signature=tf.TensorSpec([img_height, img_width, channels], tf.float32),
+                )
+        return fn(images)
+
+    return serve_bytes
+
+
+def keras_to_saved_model(source: str, target: str):
+    '''
+    Exports a .keras model as a tfs SavedModel with two signatures:
+        - serve: takes the preprocessed float32 batch (N, height, width, 3), scaled to [0, 1]
+        - serve_bytes: takes the encoded image files as a string batch (N,) and does the decode,
+          resize to the model's input size and /255 scaling inside of the graph
+    '''
     # load the tf keras model
-    model = models.load_model(source) 
+    model = models.load_model(source)
+    _, img_height, img_width, channels = model.input_shape
+
+    serve_bytes = make_serve_bytes(lambda images: model(images, training=False), img_height, img_width, channels)
+
+    export_archive = keras.export.ExportArchive()
+    export_archive.track(model)
+    export_archive.add_endpoint(
+            name='serve',
+            fn=model.__call__,
+            input_signature=[tf.TensorSpec(model.input_shape, tf.float32, name=model.inputs[0].name)],
+            )
+    export_archive.add_endpoint(
+            name=BYTES_SIGNATURE_NAME,
+            fn=serve_bytes,
+            input_signature=[tf.TensorSpec([None], tf.string, name=BYTES_INPUT_NAME)],
+            )
+    export_archive.write_out(target)
+    logging.info(' [keras_to_saved_model] exported %s to %s', source, target)
+
+
+def fuse_saved_model(keras_dir: str, ids_dir: str, config_path: str, target: str):
+    '''
+    Exports the whole hierarchy of a product line (m0 and every submodel) as one SavedModel, so a scan costs a single
+    tfs call instead of one per level. Inside of the graph, m0 routes every image, the images are gathered by submodel
+    (dynamic_partition), each submodel runs on its own slice, and the results are put back in order (dynamic_stitch).
+
+    The serve and serve_bytes signatures take the same inputs as the single models and return one float32 (N, 2) tensor:
+        - column 0: the index of the _id in fused_ids.pkl (the ids of all of the final models, one after the other)
+        - column 1: the combined confidence (routing confidence times the final model's confidence)
+    fused_ids.pkl is written next to the m*_ids.pkl. To serve it, add the model to tfs.config and a [fused] table
+    (is_final = true) to the product line's config.toml.
+
+    Args:
+        keras_dir (str): directory of the m*.keras files of the product line
+        ids_dir (str): directory of the m*_ids.pkl routing tables (data/{pl})
+        config_path (str): the product line's config.toml, tells the routing models from the final ones
+        target (str): version directory to write the SavedModel to, ex) saved_models/pokemon/fused/1/
+    '''
+    with open(config_path, 'rb') as f:
+        config = tomllib.load(f)
+
+    def load_ids(model_name: str) -> list[str]:
+        with open(os.path.join(ids_dir, f'{model_name}_ids.pkl'), 'rb') as f:
+            return list(pickle.load(f))
+
+    # walk the hierarchy from m0, the ids of a routing model are the names of its submodels
+    loaded, ids, fused_ids, offsets = {}, {}, [], {}
+    pending = [ROOT_MODEL_NAME]
+    while pending:
+        model_name = pending.pop(0)
+        if model_name in loaded:
+            continue
+        loaded[model_name] = models.load_model(os.path.join(keras_dir, f'{model_name}.keras'))
+        ids[model_name] = load_ids(model_name)
+        if config[model_name]['is_final']:
+            offsets[model_name] = len(fused_ids)
+            fused_ids.extend(ids[model_name])
+        else:
+            pending.extend(dict.fromkeys(ids[model_name]))
+
+    root = loaded[ROOT_MODEL_NAME]
+    _, img_height, img_width, channels = root.input_shape
+
+    def run(model_name: str, images):
+        probabilities = loaded[model_name](images, training=False)
+        best = tf.argmax(probabilities, axis=1, output_type=tf.int32)
+        confidences = tf.reduce_max(probabilities, axis=1)
+        if config[model_name]['is_final']:
+            return best + offsets[model_name], confidences
+
+        submodels = list(dict.fromkeys(ids[model_name]))
+        class_to_submodel = tf.constant([submodels.index(i) for i in ids[model_name]], dtype=tf.int32)
+        partitions = tf.gather(class_to_submodel, best)
+        positions = tf.dynamic_partition(tf.range(tf.shape(images)[0]), partitions, len(submodels))
+        image_slices = tf.dynamic_partition(images, partitions, len(submodels))
+
+        results = [run(submodel, image_slice) for submodel, image_slice in zip(submodels, image_slices)]
+        labels = tf.dynamic_stitch(positions, [label for label, _ in results])
+        sub_confidences = tf.dynamic_stitch(positions, [confidence for _, confidence in results])
+        return labels, confidences * sub_confidences
+
+    def serve(images):
+        labels, confidences = run(ROOT_MODEL_NAME, images)
+        # one float tensor, so every transport handles it like the softmax of a single model (exact below 2**24 ids)
+        return tf.stack([tf.cast(labels, tf.float32), confidences], axis=1)
+
+    export_archive = keras.export.ExportArchive()
+    for model in loaded.values():
+        export_archive.track(model)
+    export_archive.add_endpoint(
+            name='serve',
+            fn=serve,
+            input_signature=[tf.TensorSpec(root.input_shape, tf.float32, name=root.inputs[0].name)],
+            )
+    export_archive.add_endpoint(
+            name=BYTES_SIGNATURE_NAME,
+            fn=make_serve_bytes(serve, img_height, img_width, channels),
+            input_signature=[tf.TensorSpec([None], tf.string, name=BYTES_INPUT_NAME)],
+            )
+    export_archive.write_out(target)
 
-    # # save it with the 
-    model.export(target, format='tf_saved_model')
+    with open(os.path.join(ids_dir, f'{FUSED_MODEL_NAME}_ids.pkl'), 'wb') as f:
+        pickle.dump(fused_ids, f)
+    logging.info(' [fuse_saved_model] fused %d models (%d ids) into %s', len(loaded), len(fused_ids), target)
 
 
-keras_to_saved_model('/home/jude/harmony/saved_models/lorcana/m0.keras', '/home/jude/harmony/saved_models/save_lorcana/m0/1/')
+if __name__ == '__main__':
+    keras_to_saved_model('/home/jude/harmony/saved_models/lorcana/m0.keras', '/home/jude/harmony/saved_models/save_lorcana/m0/1/')
 
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m0.keras', '/home/jude/harmony/saved_models/save_pokemon/m0/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m1.keras', '/home/jude/harmony/saved_models/save_pokemon/m1/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m2.keras', '/home/jude/harmony/saved_models/save_pokemon/m2/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m3.keras', '/home/jude/harmony/saved_models/save_pokemon/m3/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m4.keras', '/home/jude/harmony/saved_models/save_pokemon/m4/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m5.keras', '/home/jude/harmony/saved_models/save_pokemon/m5/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m6.keras', '/home/jude/harmony/saved_models/save_pokemon/m6/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m7.keras', '/home/jude/harmony/saved_models/save_pokemon/m7/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m8.keras', '/home/jude/harmony/saved_models/save_pokemon/m8/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m9.keras', '/home/jude/harmony/saved_models/save_pokemon/m9/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m10.keras', '/home/jude/harmony/saved_models/save_pokemon/m10/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m11.keras', '/home/jude/harmony/saved_models/save_pokemon/m11/1/')
-keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m12.keras', '/home/jude/harmony/saved_models/save_pokemon/m12/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m0.keras', '/home/jude/harmony/saved_models/save_pokemon/m0/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m1.keras', '/home/jude/harmony/saved_models/save_pokemon/m1/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m2.keras', '/home/jude/harmony/saved_models/save_pokemon/m2/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m3.keras', '/home/jude/harmony/saved_models/save_pokemon/m3/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m4.keras', '/home/jude/harmony/saved_models/save_pokemon/m4/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m5.keras', '/home/jude/harmony/saved_models/save_pokemon/m5/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m6.keras', '/home/jude/harmony/saved_models/save_pokemon/m6/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m7.keras', '/home/jude/harmony/saved_models/save_pokemon/m7/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m8.keras', '/home/jude/harmony/saved_models/save_pokemon/m8/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m9.keras', '/home/jude/harmony/saved_models/save_pokemon/m9/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m10.keras', '/home/jude/harmony/saved_models/save_pokemon/m10/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m11.keras', '/home/jude/harmony/saved_models/save_pokemon/m11/1/')
+    keras_to_saved_model('/home/jude/harmony/saved_models/pokemon/m12.keras', '/home/jude/harmony/saved_models/save_pokemon/m12/1/')
 
+    fuse_saved_model('/home/jude/harmony/saved_models/pokemon/', '/home/jude/harmony/data/pokemon/',
+                     '/home/jude/harmony/saved_models/pokemon/config.toml', '/home/jude/harmony/saved_models/save_pokemon/fused/1/')
@@ -0,0 +1,180 @@
+import asyncio
+import concurrent.futures
+import io
+import os
+import tarfile
+import tempfile
+import zipfile
+
+from typing import AsyncIterator, Iterator
+
+from starlette.responses import StreamingResponse
+
+# images are identified DEFAULT_BULK_WINDOW at a time (a query parameter of /predict/bulk, at most MAX_BULK_WINDOW)
+DEFAULT_BULK_WINDOW = 32
+MAX_BULK_WINDOW = 256
+# a member bigger than this is reported as an error without being read
+BULK_MAX_IMAGE_BYTES_ENV = 'BULK_MAX_IMAGE_BYTES'
+DEFAULT_BULK_MAX_IMAGE_BYTES = 32 * 1024 * 1024
+# a zip is spooled before it can be read (its index is at its end), in memory up to this size and on disk past it
+BULK_SPOOL_BYTES_ENV = 'BULK_SPOOL_BYTES'
+DEFAULT_BULK_SPOOL_BYTES = 8 * 1024 * 1024
+
+ZIP_MAGIC = b'PK\x03\x04'
+EMPTY_ZIP_MAGIC = b'PK\x05\x06'
+
+
+class BodyReader(io.RawIOBase):
+    '''
+    A blocking file object over the body of a request, for the tarfile module running in a worker thread:
+    every read pulls the next chunks from the request's async stream on the event loop, so nothing is read off
+    the socket before the archive reader asks for it and at most one chunk is buffered.
+
+    Args:
+        chunks (AsyncIterator[bytes]): the body, ex) request.stream()
+        head (bytes): what was already read from chunks (to sniff the format)
+        loop (asyncio.AbstractEventLoop): the loop the request is served on
+    '''
+    def __init__(self, chunks: AsyncIterator[bytes], head: bytes, loop: asyncio.AbstractEventLoop):
+        self.chunks = chunks
+        self.buffer = head
+        self.loop = loop
+        self.eof = False
+        self.aborted = False
+        self.reading: concurrent.futures.Future | None = None
+
+    def readable(self) -> bool:
+        return True
+
+    def next_chunk(self) -> bytes:
+        if self.aborted:
+            raise OSError('the request was cancelled')
+        self.reading = asyncio.run_coroutine_threadsafe(anext(self.chunks), self.loop)
+        if self.aborted:
+            self.reading.cancel()
+        try:
+            return self.reading.result()
+        except StopAsyncIteration:
+            self.eof = True
+            return b''
+        except concurrent.futures.CancelledError:
+            raise OSError('the request was cancelled') from None
+
+    def abort(self):
+        '''
+        Fails the read that is waiting for a chunk (and the next ones), called from the event loop.
+        '''
+        self.aborted = True
+        if self.reading is not None:
+            self.reading.cancel()
+
+    def readinto(self, b) -> int:
+        while not self.buffer and not self.eof:
+            self.buffer = self.next_chunk()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+def iter_tar(fileobj, max_bytes: int) -> Iterator[tuple[str, bytes | None, str | None]]:
+    '''
+    The (name, data, error) of every file of a tar stream (gzip, bz2 and xz too), read sequentially without seeking.
+    '''
+    with tarfile.open(fileobj=fileobj, mode='r|*') as archive:
+        for member in archive:
+            if not member.isfile():
+                continue
+            if member.size > max_bytes:
+                # the stream skips the member's data when moving on to the next one
+                yield member.name, None, f'larger than {max_bytes} bytes'
+                continue
+            yield member.name, archive.extractfile(member).read(), None
+
+
+def iter_zip(fileobj, max_bytes: int) -> Iterator[tuple[str, bytes | None, str | None]]:
+    '''
+    The (name, data, error) of every file of a zip, in the order of its index.
+    '''
+    with zipfile.ZipFile(fileobj) as archive:
+        for info in archive.infolist():
+            if info.is_dir():
+                continue
+            if info.file_size > max_bytes:
+                yield info.filename, None, f'larger than {max_bytes} bytes'
+                continue
+            yield info.filename, archive.read(info), None
+
+
+async def spool(head: bytes, chunks: AsyncIterator[bytes], max_memory: int) -> tempfile.SpooledTemporaryFile:
+    spooled = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    spooled.write(head)
+    async for chunk in chunks:
+        # writes past max_memory go to disk
+        await asyncio.to_thread(spooled.write, chunk)
+    spooled.seek(0)
+    return spooled
+
+
+async def archive_files(chunks: AsyncIterator[bytes]) -> AsyncIterator[tuple[str, bytes | None, str | None]]:
+    '''
+    The (name, data, error) of every file of the archive in a request body, one at a time, whatever the size of the archive.
+    A tar is read as it is uploaded, a zip is spooled first (in memory up to BULK_SPOOL_BYTES, then on disk).
+    The archive is parsed in a worker thread, the event loop only passes the chunks along.
+
+    Raises:
+        tarfile.TarError | zipfile.BadZipFile: if the body is not a valid archive
+    '''
+    max_bytes = int(os.getenv(BULK_MAX_IMAGE_BYTES_ENV, DEFAULT_BULK_MAX_IMAGE_BYTES))
+    loop = asyncio.get_running_loop()
+
+    head = b''
+    async for chunk in chunks:
+        head += chunk
+        if len(head) >= len(ZIP_MAGIC):
+            break
+
+    fileobj = None
+    reader = None
+    files = None
+    pending = None
+    try:
+        if head.startswith((ZIP_MAGIC, EMPTY_ZIP_MAGIC)):
+            fileobj = await spool(head, chunks, int(os.getenv(BULK_SPOOL_BYTES_ENV, DEFAULT_BULK_SPOOL_BYTES)))
+            files = iter_zip(fileobj, max_bytes)
+        else:
+            reader = BodyReader(chunks, head, loop)
+            files = iter_tar(io.BufferedReader(reader), max_bytes)
+
+        while True:
+            # shielded: cancelling the await does not stop the thread, it is waited for below
+            pending = asyncio.ensure_future(asyncio.to_thread(next, files, None))
+            item = await asyncio.shield(pending)
+            if item is None:
+                return
+            yield item
+    finally:
+        if pending is not None and not pending.done():
+            # cancelled (ex) the client went away) while the thread reads the next file: a generator can not be closed
+            # while it runs, so the thread is unblocked (its read fails) and waited for, and its error dropped
+            if reader is not None:
+                reader.abort()
+            await asyncio.wait({pending})
+            if not pending.cancelled():
+                pending.exception()
+        if files is not None:
+            files.close()
+        if fileobj is not None:
+            fileobj.close()
+
+
+class DuplexStreamingResponse(StreamingResponse):
+    '''
+    A StreamingResponse that does not listen for the client disconnecting while it streams. Starlette's does so by reading
+    the request's messages, which would take the chunks of a body that is still being read while the response streams
+    (see /predict/bulk). A client that goes away still ends the stream: reading the body or sending the next line fails.
+    '''
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+        if self.background is not None:
+            await self.background()
@@ -0,0 +1,214 @@
+import asyncio
+import hashlib
+import logging
+import os
+import time
+
+from collections import OrderedDict
+
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.routing import RoutingTables
+from utils.tfs_models import CachedConfigs, identify, take
+from utils.deadline import DeadlineExceeded, remaining, within_deadline
+from utils.timing import timed
+
+# CACHE_MAX_BYTES = 0 turns the cache off
+CACHE_MAX_BYTES_ENV = 'CACHE_MAX_BYTES'
+CACHE_TTL_ENV = 'CACHE_TTL_S'
+CACHE_HASH_SIZE_ENV = 'CACHE_HASH_SIZE'
+DEFAULT_CACHE_MAX_BYTES = 64 * 1024 * 1024
+DEFAULT_CACHE_TTL = 3600.0
+DEFAULT_CACHE_HASH_SIZE = 16
+
+# rough size of an entry besides its hash and _id (the tuples, floats and the OrderedDict links)
+ENTRY_OVERHEAD = 256
+
+
+def perceptual_hash(image: np.ndarray, hash_size: int) -> bytes:
+    '''
+    Difference hash of a preprocessed image: the grayscale image is shrunk to hash_size x (hash_size + 1) block means,
+    and every bit says whether a block is brighter than its left neighbour.
+    Re-encodes, rescans of the same file and small exposure changes give the same hash, different cards do not.
+
+    Args:
+        image (np.ndarray): a preprocessed image (height, width, 3)
+        hash_size (int): the hash has hash_size ** 2 bits
+    Returns:
+        bytes: the packed bits
+    '''
+    gray = np.asarray(image, dtype=np.float32).mean(axis=2)
+    height, width = gray.shape
+    rows = np.linspace(0, height, hash_size + 1).astype(int)[:-1]
+    cols = np.linspace(0, width, hash_size + 2).astype(int)[:-1]
+    blocks = np.add.reduceat(np.add.reduceat(gray, rows, axis=0), cols, axis=1)
+    counts = np.outer(np.diff(np.append(rows, height)), np.diff(np.append(cols, width)))
+    means = blocks / counts
+    return np.packbits(means[:, 1:] > means[:, :-1]).tobytes()
+
+
+def instance_hash(instance, hash_size: int) -> bytes:
+    if isinstance(instance, (bytes, bytearray)):
+        # encoded uploads are never decoded in the api, so only identical files can share an entry
+        return b'raw' + hashlib.blake2b(instance, digest_size=16).digest()
+    return perceptual_hash(instance, hash_size)
+
+
+class PredictionCache(metaclass=Singleton):
+    '''
+    Caches the final (_id, confidence) of an image, keyed by product line plus a perceptual hash of the preprocessed image,
+    so rescans and duplicates within a batch skip the m0 + submodel inference.
+    Duplicates that are already being identified by another request wait for that inference instead of starting their own.
+    LRU eviction, a ttl and a memory cap (CACHE_MAX_BYTES) bound the cache. Entries are dropped when the tfs version of
+    one of the product line's models or one of its id tables changes. Failed identifications (None) are never cached,
+    neither are results below the request's threshold, so only complete answers are shared between thresholds.
+    Partial answers (see request_deadline) have no _id either, so they are never cached.
+    '''
+    def __init__(self):
+        self.max_bytes = int(os.getenv(CACHE_MAX_BYTES_ENV, DEFAULT_CACHE_MAX_BYTES))
+        self.ttl = float(os.getenv(CACHE_TTL_ENV, DEFAULT_CACHE_TTL))
+        self.hash_size = int(os.getenv(CACHE_HASH_SIZE_ENV, DEFAULT_CACHE_HASH_SIZE))
+
+        self.entries: OrderedDict[tuple, tuple[str, float, float, int]] = OrderedDict()
+        self.in_flight: dict[tuple, asyncio.Future] = {}
+        self.generations: dict[str, tuple] = {}
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def generation(self, pl: PLS) -> tuple:
+        '''
+        Changes whenever a model of the product line is redeployed or one of its id tables is reloaded.
+        '''
+        generation = (RoutingTables().version(pl), CachedConfigs().model_versions(pl))
+        if self.generations.get(pl.value) != generation:
+            if pl.value in self.generations:
+                self.invalidate(pl)
+            self.generations[pl.value] = generation
+        return generation
+
+    def invalidate(self, pl: PLS):
+        stale = [key for key in self.entries if key[0] == pl.value]
+        for key in stale:
+            self.bytes -= self.entries.pop(key)[3]
+        self.invalidations += 1
+        logging.info(' [PredictionCache] %s changed, dropped %d entries', pl.value, len(stale))
+
+    def lookup(self, key: tuple, now: float, threshold: float) -> tuple[str | None, float] | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        label, confidence, stored_at, size = entry
+        if now - stored_at > self.ttl:
+            del self.entries[key]
+            self.bytes -= size
+            return None
+        self.entries.move_to_end(key)
+        return (label if confidence >= threshold else None), confidence
+
+    def store(self, key: tuple, label: str, confidence: float, now: float):
+        size = len(key[2]) + len(label) + ENTRY_OVERHEAD
+        if key in self.entries:
+            self.bytes -= self.entries.pop(key)[3]
+        self.entries[key] = (label, confidence, now, size)
+        self.bytes += size
+
+        while self.bytes > self.max_bytes and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.bytes -= evicted[3]
+            self.evictions += 1
+
+    async def identify(self, instances, pl: PLS, threshold: float = 0.0, partial: list[dict] | None = None) -> tuple[list[str], list[float]]:
+        '''
+        Same contract as identify(instances, 'm0', pl, threshold, partial=partial), going through the cache.
+        '''
+        if not self.enabled or len(instances) == 0:
+            return await identify(instances, 'm0', pl, threshold, partial=partial)
+
+        generation = self.generation(pl)
+        with timed('hash', pl.value):
+            hashes = await asyncio.to_thread(lambda: [instance_hash(instance, self.hash_size) for instance in instances])
+        keys = [(pl.value, generation, h) for h in hashes]
+        # a request only waits on an inference that ran with the same threshold (a higher one could have cut it off early),
+        # and requests with a deadline (whose answers can be partial) only on each other
+        flight = (threshold, remaining() is not None)
+        flight_keys = [key + flight for key in keys]
+
+        results: list[tuple[str | None, float, dict] | None] = [None] * len(keys)
+        owned: dict[tuple, list[int]] = {}   # keys this request identifies, and the indices that want them
+        waiting: dict[int, asyncio.Future] = {}  # indices that wait on another request's inference
+        now = time.monotonic()
+        for i, key in enumerate(keys):
+            cached = self.lookup(key, now, threshold)
+            if cached is not None:
+                results[i] = (*cached, {})
+                self.hits += 1
+            elif key in owned:
+                owned[key].append(i)
+                self.coalesced += 1
+            elif flight_keys[i] in self.in_flight:
+                waiting[i] = self.in_flight[flight_keys[i]]
+                self.coalesced += 1
+            else:
+                owned[key] = [i]
+                self.in_flight[flight_keys[i]] = asyncio.get_running_loop().create_future()
+                self.misses += 1
+
+        owned_keys = list(owned)
+        try:
+            if owned_keys:
+                owned_partial = [{} for _ in owned_keys]
+                labels, confidences = await identify(take(instances, [owned[key][0] for key in owned_keys]), 'm0', pl, threshold,
+                                                     partial=owned_partial)
+                now = time.monotonic()
+                for key, label, confidence, image_partial in zip(owned_keys, labels, confidences, owned_partial):
+                    for i in owned[key]:
+                        results[i] = (label, confidence, image_partial)
+                    if label is not None:
+                        self.store(key, label, confidence, now)
+                    self.in_flight.pop(key + flight).set_result((label, confidence, image_partial))
+        finally:
+            # if this request failed or was cancelled, the requests waiting on it get a failed identification
+            for key in owned_keys:
+                future = self.in_flight.pop(key + flight, None)
+                if future is not None and not future.done():
+                    future.set_result((None, 0.0, {}))
+
+        for i, future in waiting.items():
+            try:
+                # shielded, so a cancelled request does not cancel the inference other requests wait on
+                async with within_deadline('a duplicate being identified'):
+                    results[i] = await asyncio.shield(future)
+            except DeadlineExceeded:
+                results[i] = (None, 0.0, {'route': None, 'confidence': 0.0})
+
+        if partial is not None:
+            for image_partial, result in zip(partial, results):
+                image_partial.update(result[2])
+        return [r[0] for r in results], [r[1] for r in results]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses + self.coalesced
+        return {
+                'enabled': self.enabled,
+                'entries': len(self.entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'coalesced': self.coalesced,
+                'hit_rate': (self.hits + self.coalesced) / lookups if lookups else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'in_flight': len(self.in_flight),
+                }
@@ -0,0 +1,160 @@
+import asyncio
+import contextvars
+import io
+import logging
+import os
+
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import lru_cache
+
+import numpy as np
+
+from PIL import Image
+
+from utils.singleton import Singleton
+from utils.timing import timed
+
+# 'thread' or 'process', and how many workers the pool gets (defaults to the number of cores)
+DECODE_EXECUTOR_ENV = 'DECODE_EXECUTOR'
+DECODE_WORKERS_ENV = 'DECODE_WORKERS'
+DEFAULT_DECODE_EXECUTOR = 'thread'
+
+
+def decode_image(data: bytes, img_width: int, img_height: int) -> Image.Image:
+    '''
+    Decodes an uploaded image. For jpegs, libjpeg is asked to scale the DCT by 1/2, 1/4 or 1/8 while decoding
+    (draft mode), to the smallest scale that is still at least img_width x img_height.
+    A 3000x4000 phone scan is then decoded at 750x1000 instead of decoding all 12M pixels only to throw them away.
+    '''
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (img_width, img_height))
+    return image.convert('RGB')
+
+
+@lru_cache(maxsize=64)
+def resize_weights(in_size: int, out_size: int) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    '''
+    The source pixels and weights of a bilinear resize along one axis, computed like tf.image.resize
+    (half pixel centers, no antialiasing): output pixel i samples the input at (i + 0.5) * in_size / out_size - 0.5.
+
+    Returns:
+        tuple[np.ndarray, np.ndarray, np.ndarray]: the lower and upper source index and the weight of the upper one
+    '''
+    position = (np.arange(out_size, dtype=np.float32) + 0.5) * np.float32(in_size / out_size) - 0.5
+    floor = np.floor(position)
+    lower = np.maximum(floor, 0).astype(np.intp)
+    upper = np.minimum(np.ceil(position), in_size - 1).astype(np.intp)
+    return lower, upper, (position - floor).astype(np.float32)
+
+
+def resize_bilinear(image: np.ndarray, img_width: int, img_height: int, out: np.ndarray | None = None) -> np.ndarray:
+    '''
+    Bilinear resize of a (height, width, channels) image, numerically matching tf.image.resize(image, [img_height, img_width])
+    (see benchmarks/resize_parity.py). Only the two source rows of every output row are read.
+
+    Args:
+        image (np.ndarray): the decoded image, any dtype
+        img_width (int): output width
+        img_height (int): output height
+        out (np.ndarray | None): float32 (img_height, img_width, channels) array to write into, ex) a slice of a batch
+    Returns:
+        np.ndarray: the float32 resized image (out when given)
+    '''
+    y_lower, y_upper, y_weight = resize_weights(image.shape[0], img_height)
+    x_lower, x_upper, x_weight = resize_weights(image.shape[1], img_width)
+
+    # the four neighbours are gathered in the image's own dtype (uint8 from PIL) and only then cast, it is 3x faster
+    top, bottom = image[y_lower], image[y_upper]
+    top_left = top[:, x_lower].astype(np.float32)
+    top_right = top[:, x_upper].astype(np.float32)
+    bottom_left = bottom[:, x_lower].astype(np.float32)
+    bottom_right = bottom[:, x_upper].astype(np.float32)
+
+    # same order of operations as tensorflow: along the rows first, then between them
+    x_weight = x_weight[None, :, None]
+    top_right -= top_left
+    top_right *= x_weight
+    top_left += top_right
+    bottom_right -= bottom_left
+    bottom_right *= x_weight
+    bottom_left += bottom_right
+
+    if out is None:
+        out = np.empty((img_height, img_width, image.shape[2]), dtype=np.float32)
+    np.subtract(bottom_left, top_left, out=out)
+    out *= y_weight[:, None, None]
+    out += top_left
+    return out
+
+
+def preprocess_image(data: bytes, img_width: int, img_height: int, out: np.ndarray | None = None, pl: str = '') -> np.ndarray | None:
+    '''
+    Decodes and resizes one upload to the model input (float32, scaled to [0, 1]), same as the training pipeline
+    did with tf.image.resize, without importing tensorflow into the api.
+    Runs inside of the pool, returns None for files that are not valid images.
+
+    Args:
+        out (np.ndarray | None): where to write the result, ex) the image's slice of a preallocated batch
+        pl (str): the product line, for the stage timings
+    '''
+    try:
+        with timed('decode', pl):
+            image = np.asarray(decode_image(data, img_width, img_height))
+    except Exception as e:
+        logging.error(' [preprocess_image] invalid image: %s', e)
+        return None
+    with timed('resize', pl):
+        out = resize_bilinear(image, img_width, img_height, out)
+        out /= np.float32(255.0)
+    return out
+
+
+class DecodePool(metaclass=Singleton):
+    '''
+    The pool the uploads are decoded and preprocessed in, so the event loop keeps serving other requests meanwhile.
+    PIL and numpy release the gil while they decode and resize, so threads scale with the cores;
+    a process pool can be picked instead with DECODE_EXECUTOR=process.
+    '''
+    def __init__(self):
+        kind = os.getenv(DECODE_EXECUTOR_ENV, DEFAULT_DECODE_EXECUTOR)
+        workers = int(os.getenv(DECODE_WORKERS_ENV, os.cpu_count() or 1))
+
+        self.executor: Executor
+        if kind == 'process':
+            self.executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='decode')
+        logging.info(' [DecodePool] %s pool with %d workers', kind, workers)
+
+    async def preprocess(self, datas: list[bytes], img_width: int, img_height: int, pl: str = '') -> tuple[np.ndarray, list[int]]:
+        '''
+        Preprocesses every upload in the pool concurrently, into one preallocated contiguous float32 batch
+        (thread workers write their image straight into its slice, process workers send it back to be copied in).
+
+        Args:
+            pl (str): the product line, for the stage timings (which a process pool can not record)
+        Returns:
+            tuple[np.ndarray, list[int]]: the (len(datas), img_height, img_width, 3) batch,
+                and the indices of the uploads that were valid images (the other rows are garbage)
+        '''
+        loop = asyncio.get_running_loop()
+        batch = np.empty((len(datas), img_height, img_width, 3), dtype=np.float32)
+        in_process = isinstance(self.executor, ProcessPoolExecutor)
+        if in_process:
+            jobs = [(preprocess_image, data, img_width, img_height, None, pl) for data in datas]
+        else:
+            # run in the request's context, so the decode and resize times reach its Server-Timing header
+            jobs = [(contextvars.copy_context().run, preprocess_image, data, img_width, img_height, batch[i], pl) for i, data in enumerate(datas)]
+        results = await asyncio.gather(*(loop.run_in_executor(self.executor, *job) for job in jobs))
+
+        valid = []
+        for i, result in enumerate(results):
+            if result is None:
+                continue
+            if in_process:
+                batch[i] = result
+            valid.append(i)
+        return batch, valid
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -1,31 +1,131 @@
-import os, logging, uvicorn
+import asyncio, io, json, os, logging, time, uvicorn
+import numpy as np
 
-from fastapi import FastAPI, HTTPException, File, Form, UploadFile
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, File, Form, Header, Query, Request, UploadFile
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from PIL import Image
+from prometheus_client import CONTENT_TYPE_LATEST, REGISTRY, CollectorRegistry, generate_latest, multiprocess
 
-from processing.image_processing import get_tensor_from_image # TODO: THIS should just be the same preprocess step
+from utils.product_lines import string_to_product_line, PRODUCTLINES as PLS
+from utils.tfs_models import CachedConfigs, EarlyExit, identify
+from utils.backends import Backends
+from utils.catalog import Catalog
+from utils.circuit import CircuitBreakers
+from utils.hedging import Hedges
+from utils.replicas import Replicas
+from utils.batching import MicroBatchers
+from utils.metrics import FAILURES, IMAGES, IN_FLIGHT_REQUESTS
+from utils.timing import StageTimings, record_stage, request_timings, server_timing, timed
+from utils.deadline import request_deadline
 
-from utils.product_lines import string_to_product_line
-from utils.data_conversion import label_to_id
-from utils.tfs_models import identify, CachedConfigs
+from api.preprocessing import DecodePool
+from api.cache import PredictionCache
+from api.bulk import DEFAULT_BULK_WINDOW, MAX_BULK_WINDOW, DuplexStreamingResponse, archive_files
 
 from data.collect import generate_keys
 from data.collect import download_images_parallel
 
 logging.getLogger().setLevel(0) # 20
 
-CachedConfigs()
+# what tf.io.decode_image can decode inside of the serve_bytes signature
+ENCODED_FORMATS = ('JPEG', 'PNG', 'GIF', 'BMP')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # the configs load in the background, so the api takes traffic right away (unready product lines get a 503)
+    CachedConfigs().start()
+    yield
+    await CachedConfigs().stop()
+    # the tfs connection pools live on the event loop, so they are opened and closed with the app
+    await Backends().close()
+    DecodePool().shutdown()
+    Catalog().close()
 
 app = FastAPI(
         title='Harmony ML API',
         version='1.0.0',
+        lifespan=lifespan,
         )
 
+class InFlightMiddleware:
+    '''
+    Counts the /predict requests being served (IN_FLIGHT_REQUESTS). A plain asgi middleware: the app returns once the
+    whole response was sent, so a streamed response (/predict/stream, /predict/bulk) counts until its last line,
+    not only until its first one like an http middleware around call_next would.
+    Also stamps when the request arrived (request.state.received_at), for the upload stage (see record_upload).
+    '''
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or not scope['path'].startswith('/predict'):
+            await self.app(scope, receive, send)
+            return
+        scope.setdefault('state', {})['received_at'] = time.perf_counter()
+        with IN_FLIGHT_REQUESTS.labels(scope['path']).track_inprogress():
+            await self.app(scope, receive, send)
+
+app.add_middleware(InFlightMiddleware)
+
 # Routes
 @app.get('/ping', summary='testing')
 async def ping() -> dict[str, str]:
     return {'ping': 'pong'}
 
+@app.get('/ready', summary='which product lines have their config and tfs metadata loaded, and their models available')
+async def ready() -> dict:
+    '''
+    A product line that is still loading, or has its m0 circuit open, only fails its own requests (see require_ready),
+    so it is reported here without failing the probe of the others. /ready/{product_line_string} is the probe of one product line.
+    '''
+    status = CachedConfigs().status()
+    for pl in PLS:
+        status[pl.value].update(CachedConfigs().model_health(pl))
+    return status
+
+@app.get('/ready/{product_line_string}', summary='503 until the product line has its config and tfs metadata loaded')
+async def ready_product_line(product_line_string: str) -> dict:
+    '''
+    An open circuit is reported (available: false, and in /health) but keeps the 200: the product line needs requests
+    to probe its models and close it again.
+    '''
+    pl = string_to_product_line(product_line_string)
+    require_ready(pl)
+    status = CachedConfigs().status()[pl.value]
+    status.update(CachedConfigs().model_health(pl))
+    return status
+
+@app.get('/health', summary='the availability of every model (from the circuit breakers), the api itself is up if it answers')
+async def health() -> dict:
+    product_lines = {pl.value: CachedConfigs().model_health(pl) for pl in PLS}
+    healthy = all(
+            pl_health['available'] and all(state == 'closed' for state in pl_health['models'].values())
+            for pl_health in product_lines.values()
+            )
+    return {'status': 'ok' if healthy else 'degraded', 'product_lines': product_lines}
+
+@app.get('/stats', summary='counters of the inference pipeline (achieved batch sizes, ...)')
+async def stats() -> dict:
+    return {
+            'batching': MicroBatchers().stats(),
+            'cache': PredictionCache().stats(),
+            'circuits': CircuitBreakers().stats(),
+            'early_exit': EarlyExit().stats(),
+            'hedging': Hedges().stats(),
+            'replicas': Replicas().stats(),
+            'stages': StageTimings().stats(),
+            }
+
+@app.get('/metrics', summary='prometheus metrics: per stage timings, images, failures, submodel fan-out, tfs timeouts')
+async def metrics() -> Response:
+    registry = REGISTRY
+    if os.getenv('PROMETHEUS_MULTIPROC_DIR'):
+        # with several workers, every worker writes its metrics to the shared dir and they are summed here
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+
 # @app.get('/validate', summary='validates the structure of our application')
 # async def validate():
 #     logging.warning('validate endpoint not implemented yet')
@@ -55,47 +155,296 @@ async def ping() -> dict[str, str]:
 #     generate_keys(pl)
 #     return {}
 
+def require_ready(pl: PLS):
+    '''
+    Answers with a 503 while the product line's config and tfs metadata are not loaded yet (the others keep working).
+    '''
+    if not CachedConfigs().is_ready(pl):
+        CachedConfigs().start_loading(pl)
+        raise HTTPException(status_code=503, detail=f'{pl.value} is not ready yet', headers={'Retry-After': '5'})
+
+def record_upload(request: Request, pl: PLS):
+    '''
+    The upload stage: fastapi receives and parses the whole multipart body (spooling the files) before the handler runs,
+    so it is measured from when InFlightMiddleware saw the request to now.
+    '''
+    received_at = getattr(request.state, 'received_at', None)
+    if received_at is not None:
+        record_stage('upload', time.perf_counter() - received_at, pl.value)
+
 @app.post('/predict')
 async def predict(
+        request: Request,
         product_line_string: str = Form(..., description='productLine name (e.g., locrana, mtg)'),
         images: list[UploadFile] = File(..., description='image scans from client that are to be identified'),
-        threshold: float = Form(..., description='what percent confidence that is deemed correct')
+        threshold: float = Form(..., description='what percent confidence that is deemed correct'),
+        encoded: bool = Form(False, description='forward the uploaded files untouched, tfs decodes and resizes them in the graph'),
+        debug: bool = Form(False, description='also return the models each image went through and the time spent in each stage'),
+        details: bool = Form(False, description='also return the name and tcgplayer id of every card (null when unknown)'),
+        deadline_ms: float | None = Form(None, description='answer within this many milliseconds, images that run out of time come back partial'),
+        x_deadline_ms: float | None = Header(None, description='same as deadline_ms, the form field wins when both are sent'),
         ):
+    '''
+    The time spent in each stage (decode, preprocess, serialize, every model waited on, postprocess...) is returned
+    in a Server-Timing header. With debug, the response also has the routing tree of every image
+    (model, label, confidence and latency of each call); debug requests skip the prediction cache.
+    With a deadline, the response has a partial list: null for the images that got their final answer in time, and
+    {route, confidence} for the others, the submodel m0 routed them to (null if m0 did not answer) and its confidence.
+    '''
+    start = time.perf_counter()
+    budget = deadline_seconds(deadline_ms if deadline_ms is not None else x_deadline_ms)
+    with request_timings() as timings, request_deadline(budget):
+        pl = string_to_product_line(product_line_string)
+        record_upload(request, pl)
+        require_ready(pl)
+        threshold = confidence_threshold(threshold)
+        IMAGES.labels(pl.value).inc(len(images))
 
-    pl = string_to_product_line(product_line_string)
-    
-    # with Process are we able to process all of these in parallel?
-    # first find out if these use cpu instructions
-    # from multiprocessing import Process
-    # p1 = Process(target(func1))
-    pil_images = []
-    for image in images:
-        try:
-            pil_image = Image.open(image.file).convert('RGB')
-        except Exception as exc:  # noqa: BLE001
-            logging.error(HTTPException(status_code=400, detail=f'invalid image: {exc}'))
-            pil_image = None
-            continue
-        pil_images.append(pil_image)
+        if encoded:
+            instances = await read_encoded_images(images, pl)
+        else:
+            instances = await preprocess_images(images, pl)
 
-    instances = []
+        partial = None if budget is None else [{} for _ in range(len(instances))]
+        with timed('identify', pl.value):
+            if debug:
+                routing = [[] for _ in range(len(instances))]
+                predictions, confidences = await identify(instances, 'm0', pl, threshold, trace=routing, partial=partial)
+            else:
+                # rescans and duplicates are answered from the cache (or share the inference that is already running)
+                predictions, confidences = await PredictionCache().identify(instances, pl, threshold, partial)
+
+        json_prediction_obj = {
+                'predictions': predictions,
+                'confidences': confidences 
+                }
+        if partial is not None:
+            json_prediction_obj['partial'] = [image_partial or None for image_partial in partial]
+        if details:
+            with timed('details', pl.value):
+                json_prediction_obj['cards'] = card_details(predictions, pl)
+        if debug:
+            json_prediction_obj['debug'] = {
+                    'routing': routing,
+                    'stages': [{'stage': stage, 'model': model, 'ms': seconds * 1000} for stage, model, seconds in timings],
+                    }
+        with timed('response', pl.value):
+            response = JSONResponse(json_prediction_obj)
+    response.headers['Server-Timing'] = server_timing(timings, time.perf_counter() - start)
+    return response
+
+def card_details(predictions: list[str | None], pl: PLS) -> list[dict | None]:
+    '''
+    {name, tcgplayer_id} of every predicted _id, from the product line's catalog (a single indexed query for the batch).
+    '''
+    if not Catalog().is_open(pl):
+        logging.warning(' [card_details] the catalog of %s is not open', pl.value)
+        return [None] * len(predictions)
+    return Catalog().summaries(pl, predictions)
+
+async def preprocess_images(images: list[UploadFile], pl: PLS) -> np.ndarray:
+    '''
+    Decodes the uploads and resizes them to m0's input size in the decode pool (invalid images are dropped).
+    '''
     # NOTE: for simplicity we need the models to all comply to the same width and height
     input_width = CachedConfigs().request_config(pl)['m0']['input_width']
     input_height  = CachedConfigs().request_config(pl)['m0']['input_height']
 
-    for pil_image in pil_images:
-        img_tensor = get_tensor_from_image(pil_image, input_width, input_height) # TODO: use the custom data.dataset.tensor_from_image
+    with timed('read', pl.value):
+        datas = [await image.read() for image in images]
+    with timed('preprocess', pl.value):
+        batch, valid = await DecodePool().preprocess(datas, input_width, input_height, pl.value)
+    FAILURES.labels(pl.value, '', 'invalid_image').inc(len(datas) - len(valid))
+
+    # kept as one ndarray, the transport decides how to encode it (json lists or packed binary tensors)
+    return batch if len(valid) == len(datas) else batch[valid]
 
-        instance = img_tensor.numpy().tolist()
-        instances.append(instance)
+async def read_encoded_images(images: list[UploadFile], pl: PLS) -> list[bytes]:
+    '''
+    Reads the uploads as is (no decoding), for the serve_bytes signature.
+    Only the header is parsed, so files tfs could not decode are dropped here instead of failing the whole batch.
+    '''
+    instances = []
+    for image in images:
+        with timed('read', pl.value):
+            data = await image.read()
+        if is_encodable_image(data):
+            instances.append(data)
+        else:
+            FAILURES.labels(pl.value, '', 'invalid_image').inc()
+    return instances
 
-    predictions, confidences = identify(instances, 'm0', pl)
+def deadline_seconds(deadline_ms: float | None) -> float | None:
+    '''
+    The request's budget in seconds (None without a deadline), counted from when /predict starts handling the request.
+    '''
+    if deadline_ms is None:
+        return None
+    if deadline_ms <= 0:
+        raise HTTPException(status_code=400, detail=f'deadline_ms must be positive, got {deadline_ms}')
+    return deadline_ms / 1000
 
-    json_prediction_obj = {
-            'predictions': [label_to_id(int(p), pl) if p is not None else None for p in predictions],
-            'confidences': confidences 
-            }
-    return json_prediction_obj
+def confidence_threshold(threshold: float) -> float:
+    '''
+    The threshold as a fraction, it is also accepted as a percent (ex. 80 for 0.8).
+    Predictions below it come back as None, and identify skips the submodels of images that can not reach it.
+    '''
+    if not 0 <= threshold <= 100:
+        raise HTTPException(status_code=400, detail=f'threshold must be between 0 and 1 (or a percent), got {threshold}')
+    return threshold / 100 if threshold > 1 else threshold
+
+def is_encodable_image(data: bytes) -> bool:
+    try:
+        image_format = Image.open(io.BytesIO(data)).format
+        if image_format not in ENCODED_FORMATS:
+            raise ValueError(f'unsupported format {image_format}')
+    except Exception as exc:  # noqa: BLE001
+        logging.error(HTTPException(status_code=400, detail=f'invalid image: {exc}'))
+        return False
+    return True
+
+@app.post('/predict/stream', summary='like /predict, but streams one ndjson line per image as soon as it is identified')
+async def predict_stream(
+        request: Request,
+        product_line_string: str = Form(..., description='productLine name (e.g., locrana, mtg)'),
+        images: list[UploadFile] = File(..., description='image scans from client that are to be identified'),
+        threshold: float = Form(..., description='what percent confidence that is deemed correct'),
+        encoded: bool = Form(False, description='forward the uploaded files untouched, tfs decodes and resizes them in the graph'),
+        ):
+    '''
+    Every image goes through the pipeline on its own (the micro-batcher still merges them into shared tfs calls),
+    and its {index, id, confidence} line is sent as soon as it finishes, so the client does not wait for the slowest image.
+    index is the position of the image in the upload. Invalid images get an id of null and an error.
+    '''
+    pl = string_to_product_line(product_line_string)
+    record_upload(request, pl)
+    require_ready(pl)
+    threshold = confidence_threshold(threshold)
+    IMAGES.labels(pl.value).inc(len(images))
+    with timed('read', pl.value):
+        datas = [await image.read() for image in images]
+
+    async def identify_upload(index: int, data: bytes) -> dict:
+        if encoded:
+            instance = data if is_encodable_image(data) else None
+        else:
+            input_width = CachedConfigs().request_config(pl)['m0']['input_width']
+            input_height  = CachedConfigs().request_config(pl)['m0']['input_height']
+            with timed('preprocess', pl.value):
+                batch, valid = await DecodePool().preprocess([data], input_width, input_height, pl.value)
+            instance = batch[0] if valid else None
+
+        if instance is None:
+            FAILURES.labels(pl.value, '', 'invalid_image').inc()
+            return {'index': index, 'id': None, 'confidence': 0.0, 'error': 'invalid image'}
+
+        (prediction,), (confidence,) = await PredictionCache().identify([instance], pl, threshold)
+        return {'index': index, 'id': prediction, 'confidence': confidence}
+
+    async def results():
+        tasks = [asyncio.create_task(identify_upload(i, data)) for i, data in enumerate(datas)]
+        try:
+            for next_result in asyncio.as_completed(tasks):
+                yield json.dumps(await next_result) + '\n'
+        finally:
+            # the client went away, no point in finishing the rest
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(results(), media_type='application/x-ndjson')
+
+@app.post('/predict/bulk', summary='identifies every image of a tar or zip archive sent as the body, streaming one ndjson line per image')
+async def predict_bulk(
+        request: Request,
+        product_line_string: str = Query(..., description='productLine name (e.g., locrana, mtg)'),
+        threshold: float = Query(..., description='what percent confidence that is deemed correct'),
+        encoded: bool = Query(False, description='forward the files untouched, tfs decodes and resizes them in the graph'),
+        window: int = Query(DEFAULT_BULK_WINDOW, ge=1, le=MAX_BULK_WINDOW, description='images identified together'),
+        ):
+    '''
+    For whole collections: the body is a tar (compressed or not) or zip archive of scans, sent as is
+    (ex) curl -X POST -T collection.tar '.../predict/bulk?...', -T alone sends a PUT). The files are read window at a time, decoded and identified together (through the
+    prediction cache and the micro-batcher), and their {index, name, id, confidence} lines are sent while the next window
+    is read, so the memory a request holds is bounded by its window, not by the size of the archive.
+    index is the position of the file in the archive, files that are not valid images get an id of null and an error.
+    A tar is identified while it uploads (the client should read the response as it sends), a zip once it is uploaded.
+    The last line is {done, images, identified, failed}, with an error when the archive could not be read to its end.
+    '''
+    pl = string_to_product_line(product_line_string)
+    require_ready(pl)
+    threshold = confidence_threshold(threshold)
+
+    async def read_windows(windows: asyncio.Queue):
+        files = []
+        try:
+            async for name, data, error in archive_files(request.stream()):
+                files.append((name, data, error))
+                if len(files) == window:
+                    await windows.put(files)
+                    files = []
+        finally:
+            # the files read before the end of the archive (or an error reading it) still get their lines,
+            # unless results() went away and cancelled the reader
+            if not asyncio.current_task().cancelling():
+                if files:
+                    await windows.put(files)
+                await windows.put(None)
+
+    async def results():
+        # the next window is read while the current one is identified, at most one waits in between
+        windows = asyncio.Queue(maxsize=1)
+        reader = asyncio.create_task(read_windows(windows))
+        counts = {'images': 0, 'identified': 0, 'failed': 0}
+        try:
+            while (files := await windows.get()) is not None:
+                for line in await identify_window(files, counts['images'], pl, threshold, encoded):
+                    counts['images'] += 1
+                    counts['identified' if line['id'] is not None else 'failed'] += 1
+                    yield json.dumps(line) + '\n'
+            try:
+                await reader
+                summary = {'done': True, **counts}
+            except Exception as e:  # noqa: BLE001
+                logging.warning(' [predict_bulk] could not read the archive: %r', e)
+                summary = {'done': False, **counts, 'error': f'could not read the archive: {e!r}'}
+            yield json.dumps(summary) + '\n'
+        finally:
+            # the client went away, no point in reading the rest
+            reader.cancel()
+
+    return DuplexStreamingResponse(results(), media_type='application/x-ndjson')
+
+async def identify_window(files: list[tuple[str, bytes | None, str | None]], start: int, pl: PLS, threshold: float, encoded: bool) -> list[dict]:
+    '''
+    Identifies a window of the files of /predict/bulk in one go, and returns their lines (index counted from start).
+    '''
+    lines = [{'index': start + i, 'name': name, 'id': None, 'confidence': 0.0} for i, (name, _, _) in enumerate(files)]
+    for line, (_, _, error) in zip(lines, files):
+        if error is not None:
+            line['error'] = error
+    readable = [i for i, (_, data, _) in enumerate(files) if data is not None]
+    IMAGES.labels(pl.value).inc(len(files))
+
+    if encoded:
+        valid = [i for i in readable if is_encodable_image(files[i][1])]
+        instances = [files[i][1] for i in valid]
+    else:
+        input_width = CachedConfigs().request_config(pl)['m0']['input_width']
+        input_height  = CachedConfigs().request_config(pl)['m0']['input_height']
+        with timed('preprocess', pl.value):
+            batch, decoded = await DecodePool().preprocess([files[i][1] for i in readable], input_width, input_height, pl.value)
+        valid = [readable[j] for j in decoded]
+        instances = batch if len(decoded) == len(readable) else batch[decoded]
+    for i in set(readable) - set(valid):
+        lines[i]['error'] = 'invalid image'
+    FAILURES.labels(pl.value, '', 'invalid_image').inc(len(files) - len(valid))
+
+    with timed('identify', pl.value):
+        predictions, confidences = await PredictionCache().identify(instances, pl, threshold)
+    for i, prediction, confidence in zip(valid, predictions, confidences):
+        lines[i]['id'] = prediction
+        lines[i]['confidence'] = confidence
+    return lines
 
 # ---------------------------------------------------------------------------
 if __name__ == '__main__':
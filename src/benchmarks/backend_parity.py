@@ -0,0 +1,82 @@
+'''
+Checks that the local (in process) backend identifies a fixture set of scans exactly like tensorflow serving does,
+before a product line is switched to backend='local'. Needs the tfs container of the product line to be up
+and its exported models under SAVED_MODEL_DIR (tests/test_local_inference.py checks the same on a tiny model, without tfs).
+
+    PYTHONPATH=src python -m benchmarks.backend_parity --pl pokemon --images data/fixtures/pokemon
+
+Prints one json line per image that differs and a summary; exits with 1 if any label differs
+(or a confidence differs by more than --tolerance).
+'''
+import argparse
+import asyncio
+import glob
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+from api.preprocessing import preprocess_image
+from utils.backends import Backends
+from utils.product_lines import string_to_product_line
+from utils.tfs_models import CachedConfigs, identify
+
+
+async def identify_with(backend: str, pl, batch: np.ndarray) -> tuple[list, list, float]:
+    serving_config = CachedConfigs().request_config(pl).get('serving', {})
+    Backends().configure(pl, {**serving_config, 'backend': backend})
+
+    start = time.perf_counter()
+    labels, confidences = await identify(batch, 'm0', pl)
+    return labels, confidences, time.perf_counter() - start
+
+
+async def check_parity(pl, paths: list[str], tolerance: float) -> int:
+    await CachedConfigs().load(pl)
+    config = CachedConfigs().request_config(pl)['m0']
+
+    batch = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            batch.append(preprocess_image(f.read(), config['input_width'], config['input_height']))
+    valid = [i for i, image in enumerate(batch) if image is not None]
+    batch = np.stack([batch[i] for i in valid])
+
+    try:
+        tfs_labels, tfs_confidences, tfs_seconds = await identify_with('tfs', pl, batch)
+        local_labels, local_confidences, local_seconds = await identify_with('local', pl, batch)
+    finally:
+        await Backends().close()
+
+    mismatches = 0
+    for i, tfs_label, tfs_conf, local_label, local_conf in zip(valid, tfs_labels, tfs_confidences, local_labels, local_confidences):
+        if tfs_label != local_label or abs(tfs_conf - local_conf) > tolerance:
+            mismatches += 1
+            print(json.dumps({'image': paths[i], 'tfs': [tfs_label, tfs_conf], 'local': [local_label, local_conf]}))
+
+    print(json.dumps({
+        'product_line': pl.value,
+        'images': len(valid),
+        'mismatches': mismatches,
+        'tfs_seconds': round(tfs_seconds, 4),
+        'local_seconds': round(local_seconds, 4),
+        }))
+    return mismatches
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--pl', required=True, help='product line, ex) pokemon')
+    parser.add_argument('--images', required=True, help='directory of fixture scans')
+    parser.add_argument('--tolerance', type=float, default=1e-4, help='max confidence difference')
+    args = parser.parse_args()
+
+    paths = sorted(p for p in glob.glob(os.path.join(args.images, '*')) if os.path.isfile(p))
+    mismatches = asyncio.run(check_parity(string_to_product_line(args.pl), paths, args.tolerance))
+    sys.exit(1 if mismatches else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,165 @@
+'''
+Memory and throughput of /predict/bulk as the archive grows: for every card count, an archive of that many scans is posted
+to the api (against the stub tfs) and the rss of the api is sampled from /proc while it is identified. A tar is generated
+while it uploads (the client never holds it), a zip is written to a temp file first, as a client would send one from disk.
+The scans repeat, so the prediction cache is off unless --cache.
+
+    PYTHONPATH=src python -m benchmarks.bulk --cards 200 800 3200 --image-size 375 500 --input-shape 64 48 3 --submodels 4
+
+Prints one json object per format and card count: cards/s, the seconds to the first result line (a tar is answered while
+it uploads), the archive size, the rss of the api before the run and the highest rss sampled during it (MB).
+The peak rss should not grow with the card count, only with the window.
+'''
+import asyncio
+import json
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import zipfile
+
+import aiohttp
+
+from benchmarks.loadtest import PRODUCT_LINE, make_parser, make_scans, run_api, write_product_lines
+from benchmarks.stub_tfs import run_stub
+from benchmarks.workers import read_kb, worker_pids
+
+CHUNK_BYTES = 64 * 1024
+# distinct scans the archives cycle through
+SCANS = 64
+
+
+def tar_member(name: str, data: bytes) -> bytes:
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    padding = -len(data) % tarfile.BLOCKSIZE
+    return info.tobuf(format=tarfile.PAX_FORMAT) + data + b'\0' * padding
+
+
+async def tar_stream(scans: list[bytes], cards: int, sent: list[int]):
+    for i in range(cards):
+        member = tar_member(f'cards/{i:06d}.jpg', scans[i % len(scans)])
+        sent[0] += len(member)
+        yield member
+    # the end of archive marker, two empty blocks
+    yield b'\0' * tarfile.BLOCKSIZE * 2
+
+
+def write_zip(path: str, scans: list[bytes], cards: int):
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for i in range(cards):
+            archive.writestr(f'cards/{i:06d}.jpg', scans[i % len(scans)])
+
+
+async def file_stream(path: str, sent: list[int]):
+    with open(path, 'rb') as f:
+        while chunk := f.read(CHUNK_BYTES):
+            sent[0] += len(chunk)
+            yield chunk
+
+
+class RssSampler:
+    '''
+    Samples the rss of the workers of the api every interval seconds in a thread, keeping the highest one.
+    '''
+    def __init__(self, pid: int, interval: float = 0.05):
+        self.pids = worker_pids(pid)
+        self.interval = interval
+        self.peak_kb = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def rss_kb(self) -> int:
+        return sum(read_kb(f'/proc/{pid}/status', 'VmRSS') or 0 for pid in self.pids)
+
+    def run(self):
+        while not self.stopped.is_set():
+            self.peak_kb = max(self.peak_kb, self.rss_kb())
+            self.stopped.wait(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopped.set()
+        self.thread.join()
+
+
+async def post_archive(base_url: str, body, args) -> dict:
+    params = {'product_line_string': PRODUCT_LINE, 'threshold': str(args.threshold), 'window': str(args.window),
+              'encoded': 'true' if args.encoded else 'false'}
+    timeout = aiohttp.ClientTimeout(total=None, sock_read=300)
+    lines = 0
+    first_line = None
+    summary = None
+    start = time.perf_counter()
+    async with aiohttp.ClientSession(timeout=timeout) as session:
+        async with session.post(f'{base_url}/predict/bulk', params=params, data=body) as response:
+            response.raise_for_status()
+            async for line in response.content:
+                if first_line is None:
+                    first_line = time.perf_counter() - start
+                result = json.loads(line)
+                if 'done' in result:
+                    summary = result
+                else:
+                    lines += 1
+    return {'seconds': time.perf_counter() - start, 'first_line_seconds': first_line, 'lines': lines, 'summary': summary}
+
+
+async def run(base_url: str, pid: int, scans: list[bytes], archive_format: str, cards: int, root: str, args) -> dict:
+    sent = [0]
+    if archive_format == 'zip':
+        path = os.path.join(root, f'{cards}.zip')
+        write_zip(path, scans, cards)
+        body = file_stream(path, sent)
+    else:
+        body = tar_stream(scans, cards, sent)
+
+    with RssSampler(pid) as sampler:
+        rss_before = sampler.rss_kb()
+        result = await post_archive(base_url, body, args)
+    if archive_format == 'zip':
+        os.remove(path)
+
+    summary = result['summary'] or {}
+    return {
+            'format': archive_format,
+            'cards': cards,
+            'archive_mb': round(sent[0] / 2**20, 1),
+            'identified': summary.get('identified'),
+            'failed': summary.get('failed'),
+            'error': summary.get('error'),
+            'cards_per_s': round(result['lines'] / result['seconds'], 1),
+            'first_line_s': None if result['first_line_seconds'] is None else round(result['first_line_seconds'], 3),
+            'rss_mb_before': round(rss_before / 1024, 1),
+            'rss_mb_peak': round(sampler.peak_kb / 1024, 1),
+            }
+
+
+async def benchmark(base_url: str, pid: int, scans: list[bytes], root: str, args):
+    for archive_format in args.format:
+        for cards in args.cards:
+            print(json.dumps(await run(base_url, pid, scans, archive_format, cards, root, args)), flush=True)
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--cards', type=int, nargs='+', default=[200, 800, 3200], help='cards per archive')
+    parser.add_argument('--format', choices=['tar', 'zip'], nargs='+', default=['tar', 'zip'])
+    parser.add_argument('--window', type=int, default=32, help='the window query parameter of /predict/bulk')
+    args = parser.parse_args()
+
+    scans = make_scans(SCANS, *args.image_size)
+    with tempfile.TemporaryDirectory() as root:
+        env, classes = write_product_lines(root, args)
+        with run_stub(args.tfs_port, latency_ms=args.latency_ms, classes=classes, input_shape=tuple(args.input_shape)), \
+                run_api(args.api_port, env, 1, args.verbose) as process:
+            asyncio.run(benchmark(f'http://127.0.0.1:{args.api_port}', process.pid, scans, root, args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+'''
+Encode and decode time of the tfs rest bodies: the old path (row "instances" through json and python lists, "predictions"
+parsed with json.loads) against the one the client uses (columnar "inputs" written by orjson straight from the ndarray,
+"outputs" parsed by orjson), at a few batch sizes.
+
+    PYTHONPATH=src python -m benchmarks.codec --batch-sizes 1 16 64 --classes 23675 --repeats 20
+
+Prints one json object per path and batch size: median encode / decode ms and the size of the bodies.
+'''
+import argparse
+import json
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.stub_tfs import DEFAULT_INPUT_SHAPE
+from utils.tfs_client import decode_predictions, encode_instances
+
+
+def encode_rows(instances: np.ndarray) -> bytes:
+    return json.dumps({'instances': instances.tolist()}).encode()
+
+
+def decode_rows(raw: bytes) -> np.ndarray:
+    return np.asarray(json.loads(raw)['predictions'], dtype=np.float32)
+
+
+def median_ms(fn, arg, repeats: int) -> float:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(arg)
+        times.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(times), 3)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 16, 64])
+    parser.add_argument('--classes', type=int, default=23675, help='softmax width of the model')
+    parser.add_argument('--input-shape', type=int, nargs=3, default=DEFAULT_INPUT_SHAPE, help='model input height width channels')
+    parser.add_argument('--repeats', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for batch_size in args.batch_sizes:
+        instances = rng.random((batch_size, *args.input_shape), dtype=np.float32)
+        softmax = rng.dirichlet(np.ones(args.classes), size=batch_size).astype(np.float32)
+        # tfs writes the shortest repr of every float
+        rows_response = json.dumps({'predictions': softmax.tolist()}).encode()
+        columnar_response = json.dumps({'outputs': softmax.tolist()}).encode()
+        assert np.array_equal(decode_rows(rows_response), decode_predictions(columnar_response))
+
+        for path, encode, decode, response in (
+                ('rows_json', encode_rows, decode_rows, rows_response),
+                ('columnar', lambda batch: encode_instances(batch, columnar=True), decode_predictions, columnar_response),
+                ):
+            print(json.dumps({
+                'path': path,
+                'batch_size': batch_size,
+                'encode_ms': median_ms(encode, instances, args.repeats),
+                'decode_ms': median_ms(decode, response, args.repeats),
+                'request_bytes': len(encode(instances)),
+                'response_bytes': len(response),
+                }))
+
+
+if __name__ == '__main__':
+    main()
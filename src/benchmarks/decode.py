@@ -0,0 +1,103 @@
+'''
+Decode + preprocess cost of full-size phone scans, before (full decode on the event loop) and after
+(draft mode jpeg decode in the DecodePool).
+
+    PYTHONPATH=src python -m benchmarks.decode --images 16 --size 3000 4000 --concurrency 8
+
+Prints per-image decode cost and requests/sec of simulated /predict preprocessing, as json.
+'''
+import argparse
+import asyncio
+import io
+import json
+import statistics
+import time
+
+import numpy as np
+
+from PIL import Image
+
+from api.preprocessing import DecodePool, preprocess_image
+from processing.image_processing import get_tensor_from_image
+
+INPUT_WIDTH = 313
+INPUT_HEIGHT = 437
+
+
+def make_scan(width: int, height: int, seed: int) -> bytes:
+    '''
+    A synthetic scan that compresses like a photo (smooth gradients plus sensor noise).
+    '''
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    pixels = np.clip(base + rng.normal(0, 8, base.shape), 0, 255).astype(np.uint8)
+
+    buffer = io.BytesIO()
+    Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+    return buffer.getvalue()
+
+
+def preprocess_before(data: bytes) -> np.ndarray:
+    image = Image.open(io.BytesIO(data)).convert('RGB')
+    return get_tensor_from_image(image, INPUT_WIDTH, INPUT_HEIGHT).numpy()
+
+
+def preprocess_after(data: bytes) -> np.ndarray:
+    return preprocess_image(data, INPUT_WIDTH, INPUT_HEIGHT)
+
+
+def time_per_image(fn, scans: list[bytes]) -> float:
+    fn(scans[0])  # warm up
+    times = []
+    for data in scans:
+        start = time.perf_counter()
+        fn(data)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+async def requests_per_second(scans: list[bytes], images_per_request: int, concurrency: int, pooled: bool) -> float:
+    async def request(i: int):
+        datas = [scans[(i + j) % len(scans)] for j in range(images_per_request)]
+        if pooled:
+            await DecodePool().preprocess(datas, INPUT_WIDTH, INPUT_HEIGHT)
+        else:
+            for data in datas:
+                preprocess_before(data)
+
+    n_requests = max(concurrency * 2, len(scans) // images_per_request)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def bounded(i: int):
+        async with semaphore:
+            await request(i)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(bounded(i) for i in range(n_requests)))
+    return n_requests / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--images', type=int, default=16, help='number of distinct scans to generate')
+    parser.add_argument('--size', type=int, nargs=2, default=[3000, 4000], help='width height of the scans')
+    parser.add_argument('--images-per-request', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    scans = [make_scan(*args.size, seed=i) for i in range(args.images)]
+    result = {
+            'scan_size': args.size,
+            'scan_bytes': statistics.mean(len(s) for s in scans),
+            'before_ms_per_image': time_per_image(preprocess_before, scans),
+            'after_ms_per_image': time_per_image(preprocess_after, scans),
+            'before_requests_per_s': asyncio.run(requests_per_second(scans, args.images_per_request, args.concurrency, pooled=False)),
+            'after_requests_per_s': asyncio.run(requests_per_second(scans, args.images_per_request, args.concurrency, pooled=True)),
+            }
+    DecodePool().shutdown()
+    print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
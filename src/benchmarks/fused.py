@@ -0,0 +1,90 @@
+'''
+identify through the fused model (one tfs call per scan) versus the call per level of the hierarchy (m0, then a submodel),
+against the stub tfs. A throwaway product line (config.toml, routing tables) is written to a temp dir.
+
+    PYTHONPATH=src python -m benchmarks.fused --submodels 12 --ids 2000 --latency-ms 5 --concurrency 1 8 32
+
+Prints one json object per path and concurrency: latency percentiles (ms), scans/sec and tfs calls per scan.
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.stub_tfs import run_stub, write_product_line
+
+INPUT_SHAPE = (64, 48, 3)
+
+
+async def run(pl, use_fused: bool, concurrency: int, requests: int) -> dict:
+    from utils.tfs_client import TFSClient
+    from utils.tfs_models import CachedConfigs, identify
+
+    CachedConfigs().request_config(pl)['serving']['use_fused'] = int(use_fused)
+    rng = np.random.default_rng(0)
+    images = rng.random((requests, *INPUT_SHAPE), dtype=np.float32)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def scan(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await identify(images[i:i + 1], 'm0', pl)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await identify(images[:1], 'm0', pl)  # warm up the connection pool
+    start = time.perf_counter()
+    await asyncio.gather(*(scan(i) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    await TFSClient().close()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+            'path': 'fused' if use_fused else 'per_level',
+            'concurrency': concurrency,
+            'p50_ms': round(quantiles[49], 3),
+            'p95_ms': round(quantiles[94], 3),
+            'p99_ms': round(quantiles[98], 3),
+            'scans_per_s': round(requests / elapsed, 1),
+            'tfs_calls_per_scan': 1 if use_fused else 2,
+            }
+
+
+async def benchmark(args, pl):
+    from utils.tfs_models import CachedConfigs
+
+    await CachedConfigs().load(pl)
+    for concurrency in args.concurrency:
+        for use_fused in (False, True):
+            print(json.dumps(await run(pl, use_fused, concurrency, args.requests)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submodels', type=int, default=12)
+    parser.add_argument('--ids', type=int, default=2000, help='ids per submodel')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='stub latency of every tfs call')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[1, 8, 32])
+    parser.add_argument('--requests', type=int, default=400)
+    parser.add_argument('--port', type=int, default=8611)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        data_dir, saved_model_dir, tables = write_product_line(root, 'pokemon', args.port, args.submodels, args.ids, fused=True)
+        os.environ['DATA_DIR'] = data_dir
+        os.environ['SAVED_MODEL_DIR'] = saved_model_dir
+
+        from utils.product_lines import PRODUCTLINES as PLS
+
+        classes = ','.join(f'{model_name}={len(ids)}' for model_name, ids in tables.items())
+        with run_stub(args.port, latency_ms=args.latency_ms, classes=classes, input_shape=INPUT_SHAPE):
+            asyncio.run(benchmark(args, PLS.POKEMON))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+'''
+Tail latency of identify with and without hedged tfs calls, against a stub tfs whose calls are occasionally slow
+(--slow-fraction of them take --slow-ms instead of --latency-ms). A throwaway product line is written to a temp dir.
+
+    PYTHONPATH=src python -m benchmarks.hedging --latency-ms 5 --slow-fraction 0.02 --slow-ms 200 --requests 2000 --concurrency 8
+
+Prints one json object per mode: latency percentiles (ms), tfs calls per scan, and the hedge rate and wins.
+'''
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.stub_tfs import run_stub, write_product_line
+
+INPUT_SHAPE = (64, 48, 3)
+
+
+async def run(pl, hedge: bool, args) -> dict:
+    from utils.hedging import Hedges
+    from utils.tfs_client import TFSClient
+    from utils.tfs_models import identify
+
+    TFSClient().get_options(pl).update({'hedge': int(hedge), 'hedge_percentile': args.percentile, 'hedge_budget': args.budget})
+    Hedges().states.clear()
+    rng = np.random.default_rng(0)
+    images = rng.random((args.requests, *INPUT_SHAPE), dtype=np.float32)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+
+    async def scan(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            await identify(images[i:i + 1], 'm0', pl)
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    await asyncio.gather(*(scan(i) for i in range(args.requests)))
+    await TFSClient().close()
+
+    quantiles = statistics.quantiles(latencies, n=1000)
+    hedging = {model_name: stats for model_name, stats in Hedges().stats().get(pl.value, {}).items()}
+    calls = sum(stats['calls'] for stats in hedging.values())
+    hedges = sum(stats['hedges'] for stats in hedging.values())
+    return {
+            'mode': 'hedged' if hedge else 'plain',
+            'p50_ms': round(quantiles[499], 3),
+            'p95_ms': round(quantiles[949], 3),
+            'p99_ms': round(quantiles[989], 3),
+            'p999_ms': round(quantiles[998], 3),
+            'hedge_rate': round(hedges / calls, 4) if calls else 0.0,
+            'hedge_wins': sum(stats['wins'] for stats in hedging.values()),
+            'hedges': hedges,
+            'delay_ms': {model_name: stats['delay_ms'] for model_name, stats in hedging.items()},
+            }
+
+
+async def benchmark(args, pl):
+    from utils.tfs_models import CachedConfigs
+
+    await CachedConfigs().load(pl)
+    for hedge in (False, True):
+        print(json.dumps(await run(pl, hedge, args)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--submodels', type=int, default=4)
+    parser.add_argument('--ids', type=int, default=500, help='ids per submodel')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='stub latency of a normal tfs call')
+    parser.add_argument('--slow-fraction', type=float, default=0.02)
+    parser.add_argument('--slow-ms', type=float, default=200.0)
+    parser.add_argument('--percentile', type=float, default=95.0, help='hedge after this percentile of the recent latencies')
+    parser.add_argument('--budget', type=float, default=0.05, help='most extra calls hedging can add')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--port', type=int, default=8631)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        data_dir, saved_model_dir, tables = write_product_line(root, 'pokemon', args.port, args.submodels, args.ids)
+        os.environ['DATA_DIR'] = data_dir
+        os.environ['SAVED_MODEL_DIR'] = saved_model_dir
+        # the breakers would open on the slow calls
+        os.environ['BREAKER_SLOW_SECONDS'] = '0'
+
+        from utils.product_lines import PRODUCTLINES as PLS
+
+        classes = ','.join(f'{model_name}={len(ids)}' for model_name, ids in tables.items())
+        with run_stub(args.port, latency_ms=args.latency_ms, classes=classes, input_shape=INPUT_SHAPE,
+                      slow_fraction=args.slow_fraction, slow_ms=args.slow_ms):
+            asyncio.run(benchmark(args, PLS.POKEMON))
+
+
+if __name__ == '__main__':
+    main()
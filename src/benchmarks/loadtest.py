@@ -0,0 +1,248 @@
+'''
+End-to-end load test of /predict: starts the stub tfs and the api (uvicorn api.server:app) in subprocesses,
+against a throwaway product line, and drives it with concurrent multipart requests of generated jpeg scans.
+
+    PYTHONPATH=src python -m benchmarks.loadtest --concurrency 16 --images-per-request 4 --image-size 750 1000 \
+        --requests 500 --latency-ms 5 --submodels 12 --ids 2000
+
+Prints one json object: the options, latency percentiles (ms), requests/sec, images/sec, errors and the mean ms per request
+spent in each stage of the pipeline (from the harmony_stage_seconds histogram of /metrics, summed over the workers),
+so runs can be diffed against each other.
+'''
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.error
+import urllib.request
+
+import aiohttp
+import numpy as np
+
+from PIL import Image
+from prometheus_client.parser import text_string_to_metric_families
+
+from benchmarks.stub_tfs import DEFAULT_INPUT_SHAPE, run_stub, write_product_line
+from utils.product_lines import PRODUCTLINES as PLS
+
+PRODUCT_LINE = PLS.POKEMON.value
+GUNICORN_CONF = os.path.join(os.path.dirname(__file__), '..', '..', 'docker', 'api', 'gunicorn.conf.py')
+
+
+def make_scans(n: int, width: int, height: int) -> list[bytes]:
+    '''
+    n distinct jpegs that compress like photos (gradients plus noise), distinct so the prediction cache can not hide work.
+    '''
+    rng = np.random.default_rng(0)
+    y, x = np.mgrid[0:height, 0:width]
+    base = np.stack([x * 255 / width, y * 255 / height, (x + y) * 127 / (width + height)], axis=-1)
+    scans = []
+    for _ in range(n):
+        pixels = np.clip(base + rng.normal(0, 8, base.shape) + rng.uniform(-40, 40), 0, 255).astype(np.uint8)
+        buffer = io.BytesIO()
+        Image.fromarray(pixels).save(buffer, format='JPEG', quality=90)
+        scans.append(buffer.getvalue())
+    return scans
+
+
+@contextlib.contextmanager
+def run_api(port: int, env: dict, workers: int, verbose: bool = False, timeout: float = 60.0, server: str = 'uvicorn'):
+    '''
+    Runs the api in a subprocess until the block exits, once the product line is ready (on every worker).
+    server is uvicorn, or gunicorn with the settings of the api container. With several workers, their metrics are
+    summed through a throwaway PROMETHEUS_MULTIPROC_DIR (unless env has one), like in the container.
+    '''
+    metrics_dir = None
+    if workers > 1 and not (env.get('PROMETHEUS_MULTIPROC_DIR') or os.getenv('PROMETHEUS_MULTIPROC_DIR')):
+        metrics_dir = tempfile.mkdtemp(prefix='harmony-metrics-')
+        env = {**env, 'PROMETHEUS_MULTIPROC_DIR': metrics_dir}
+    if server == 'gunicorn':
+        cmd = [sys.executable, '-m', 'gunicorn', '-c', GUNICORN_CONF, 'api.server:app', '--bind', f'127.0.0.1:{port}',
+               '--workers', str(workers), '--log-level', 'warning']
+    else:
+        cmd = [sys.executable, '-m', 'uvicorn', 'api.server:app', '--port', str(port), '--workers', str(workers), '--log-level', 'warning']
+    output = None if verbose else subprocess.DEVNULL
+    process = subprocess.Popen(cmd, env={**os.environ, **env}, stdout=output, stderr=output)
+    try:
+        wait_until_ready(f'http://127.0.0.1:{port}/ready', timeout, workers)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+        if metrics_dir is not None:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+
+def wait_until_ready(url: str, timeout: float, workers: int = 1):
+    '''
+    Every worker loads the product line on its own, and a request lands on any of them:
+    ready once enough answers in a row (a few per worker) said so.
+    '''
+    start = time.time()
+    in_a_row = 0
+    while time.time() - start < timeout:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                status = json.load(response)
+        except urllib.error.HTTPError as e:
+            status = json.load(e)
+        except OSError:
+            status = {}
+        if status.get(PRODUCT_LINE, {}).get('ready'):
+            in_a_row += 1
+            if in_a_row >= 3 * workers:
+                return
+            continue
+        in_a_row = 0
+        time.sleep(0.2)
+    raise TimeoutError(f'{PRODUCT_LINE} was not ready within {timeout}s')
+
+
+def stage_totals(metrics: str) -> dict[str, float]:
+    '''
+    The ms spent in every stage (stage or stage:model, over all of the product lines) from the text of /metrics.
+    '''
+    totals = {}
+    for family in text_string_to_metric_families(metrics):
+        if family.name != 'harmony_stage_seconds':
+            continue
+        for sample in family.samples:
+            if sample.name == 'harmony_stage_seconds_sum':
+                stage, model = sample.labels['stage'], sample.labels['model']
+                key = f'{stage}:{model}' if model else stage
+                totals[key] = totals.get(key, 0.0) + sample.value * 1000
+    return totals
+
+
+async def drive(base_url: str, scans: list[bytes], args) -> dict:
+    latencies = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+    connector = aiohttp.TCPConnector(limit=args.concurrency)
+
+    async with aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=120)) as session:
+        async def request(i: int):
+            nonlocal errors
+            form = aiohttp.FormData()
+            form.add_field('product_line_string', PRODUCT_LINE)
+            form.add_field('threshold', str(args.threshold))
+            form.add_field('encoded', str(args.encoded).lower())
+            for j in range(args.images_per_request):
+                form.add_field('images', scans[(i * args.images_per_request + j) % len(scans)], filename=f'{j}.jpg', content_type='image/jpeg')
+
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    async with session.post(f'{base_url}/predict', data=form) as response:
+                        await response.read()
+                        if response.status != 200:
+                            errors += 1
+                except aiohttp.ClientError:
+                    errors += 1
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        async def get_stages() -> dict:
+            # /metrics sums every worker (/stats is the one worker that answered), keyed like the stages of /stats
+            async with session.get(f'{base_url}/metrics') as response:
+                return stage_totals(await response.text())
+
+        await asyncio.gather(*(request(i) for i in range(args.warmup)))
+        stages_before = await get_stages()
+        latencies.clear()
+        errors = 0
+
+        start = time.perf_counter()
+        await asyncio.gather(*(request(i) for i in range(args.requests)))
+        elapsed = time.perf_counter() - start
+        stages_after = await get_stages()
+
+    quantiles = statistics.quantiles(latencies, n=100)
+    stages = {}
+    for stage, after in stages_after.items():
+        stages[stage] = round((after - stages_before.get(stage, 0.0)) / args.requests, 3)
+    return {
+            'requests': args.requests,
+            'errors': errors,
+            'p50_ms': round(quantiles[49], 3),
+            'p95_ms': round(quantiles[94], 3),
+            'p99_ms': round(quantiles[98], 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'max_ms': round(max(latencies), 3),
+            'requests_per_s': round(args.requests / elapsed, 2),
+            'images_per_s': round(args.requests * args.images_per_request / elapsed, 2),
+            'stage_ms_per_request': stages,
+            }
+
+
+def write_product_lines(root: str, args) -> tuple[dict, str]:
+    '''
+    Writes the throwaway product lines and returns the env of the api and the classes of the stub.
+    '''
+    # every product line gets the same hierarchy, so the api does not keep retrying the ones that are not driven
+    for pl in PLS:
+        data_dir, saved_model_dir, tables = write_product_line(root, pl.value, args.tfs_port, args.submodels, args.ids,
+                                                               serving=args.serving)
+    env = {
+            'DATA_DIR': data_dir,
+            'SAVED_MODEL_DIR': saved_model_dir,
+            'TFS_PORT': str(args.tfs_port),
+            'PYTHONPATH': os.pathsep.join(filter(None, [os.path.dirname(os.path.dirname(__file__)), os.getenv('PYTHONPATH')])),
+            }
+    if not args.cache:
+        env['CACHE_MAX_BYTES'] = '0'
+
+    classes = ','.join(f'{model_name}={len(ids)}' for model_name, ids in tables.items())
+    return env, classes
+
+
+def make_parser(description: str) -> argparse.ArgumentParser:
+    '''
+    The options of the load (and of the throwaway product lines), shared with the workers benchmark.
+    '''
+    parser = argparse.ArgumentParser(description=description, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--images-per-request', type=int, default=1)
+    parser.add_argument('--image-size', type=int, nargs=2, default=[750, 1000], help='width height of the uploaded scans')
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--threshold', type=float, default=0.0)
+    parser.add_argument('--encoded', action='store_true', help='send the files to the serve_bytes signature')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='stub latency of every tfs call')
+    parser.add_argument('--submodels', type=int, default=12, help='submodels m0 routes to (0 for a single final m0)')
+    parser.add_argument('--ids', type=int, default=2000, help='ids per final model')
+    parser.add_argument('--input-shape', type=int, nargs=3, default=DEFAULT_INPUT_SHAPE, help='model input height width channels')
+    parser.add_argument('--cache', action='store_true', help='keep the prediction cache on')
+    parser.add_argument('--serving', default='', help='extra toml lines for the [serving] table')
+    parser.add_argument('--verbose', action='store_true', help='show the logs of the api')
+    parser.add_argument('--api-port', type=int, default=8621)
+    parser.add_argument('--tfs-port', type=int, default=8622)
+    return parser
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--workers', type=int, default=1, help='api workers')
+    parser.add_argument('--server', choices=['uvicorn', 'gunicorn'], default='uvicorn')
+    args = parser.parse_args()
+
+    scans = make_scans(min(args.requests * args.images_per_request, 64), *args.image_size)
+    with tempfile.TemporaryDirectory() as root:
+        env, classes = write_product_lines(root, args)
+        with run_stub(args.tfs_port, latency_ms=args.latency_ms, classes=classes, input_shape=tuple(args.input_shape)), \
+                run_api(args.api_port, env, args.workers, args.verbose, server=args.server):
+            result = asyncio.run(drive(f'http://127.0.0.1:{args.api_port}', scans, args))
+
+    options = {key: value for key, value in vars(args).items() if key not in ('api_port', 'tfs_port', 'verbose')}
+    print(json.dumps({'options': options, **result}))
+
+
+if __name__ == '__main__':
+    main()
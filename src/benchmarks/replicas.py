@@ -0,0 +1,122 @@
+'''
+Throughput of identify as the calls of a product line are spread over more tfs replicas. Every replica is a stub tfs that
+serves --stub-concurrency calls at a time (the gpu), so a single replica caps the throughput and each added one raises it.
+Also runs the largest replica count with the other balancer, with model affinity, and with one more replica that refuses
+every connection (to show it being ejected). A throwaway product line is written to a temp dir.
+
+    PYTHONPATH=src python -m benchmarks.replicas --replicas 4 --latency-ms 10 --stub-concurrency 1 --concurrency 16
+
+Prints one json object per run: scans/s, latency percentiles (ms), failed scans and the calls every replica got.
+'''
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import statistics
+import tempfile
+import time
+
+import numpy as np
+
+from benchmarks.stub_tfs import run_stub, write_product_line
+
+INPUT_SHAPE = (16, 12, 3)
+
+
+async def run(pl, name: str, targets: list[str], balancer: str, affinity: int, args) -> dict:
+    from utils.replicas import Replicas
+    from utils.tfs_client import TFSClient
+    from utils.tfs_models import identify
+
+    client = TFSClient()
+    client.get_options(pl).update({'replicas': ','.join(targets), 'balancer': balancer, 'affinity': affinity})
+    client.configure_replicas(pl)
+    rng = np.random.default_rng(0)
+    images = rng.random((args.requests, *INPUT_SHAPE), dtype=np.float32)
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies = []
+    failures = 0
+
+    async def scan(i: int):
+        nonlocal failures
+        async with semaphore:
+            start = time.perf_counter()
+            _ids, _ = await identify(images[i:i + 1], 'm0', pl)
+            # a failed model call leaves the scan without an _id (the stub is always confident enough)
+            if _ids[0] is None:
+                failures += 1
+            latencies.append((time.perf_counter() - start) * 1000)
+
+    before = {target: stats['calls'] for target, stats in Replicas().stats()[pl.value]['rest'].items()}
+    start = time.perf_counter()
+    await asyncio.gather(*(scan(i) for i in range(args.requests)))
+    seconds = time.perf_counter() - start
+    await client.close()
+
+    replicas = Replicas().stats()[pl.value]['rest']
+    quantiles = statistics.quantiles(latencies, n=100)
+    return {
+            'run': name,
+            'replicas': len(targets),
+            'balancer': balancer,
+            'affinity': affinity,
+            'scans_per_s': round(args.requests / seconds, 1),
+            'p50_ms': round(quantiles[49], 3),
+            'p99_ms': round(quantiles[98], 3),
+            'failed_scans': failures,
+            'calls': {target: stats['calls'] - before.get(target, 0) for target, stats in replicas.items() if target in targets},
+            'ejections': {target: stats['ejections'] for target, stats in replicas.items() if target in targets and stats['ejections']},
+            }
+
+
+async def benchmark(args, pl, targets: list[str], dead_target: str):
+    from utils.tfs_models import CachedConfigs
+
+    await CachedConfigs().load(pl)
+    for n in range(1, len(targets) + 1):
+        print(json.dumps(await run(pl, 'scaling', targets[:n], 'p2c', 0, args)), flush=True)
+    other = 'least_outstanding' if args.balancer == 'p2c' else 'p2c'
+    print(json.dumps(await run(pl, 'balancer', targets, other, 0, args)), flush=True)
+    if args.affinity:
+        print(json.dumps(await run(pl, 'affinity', targets, args.balancer, args.affinity, args)), flush=True)
+    print(json.dumps(await run(pl, 'ejection', [*targets, dead_target], args.balancer, 0, args)), flush=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--replicas', type=int, default=4)
+    parser.add_argument('--submodels', type=int, default=4)
+    parser.add_argument('--ids', type=int, default=500, help='ids per submodel')
+    parser.add_argument('--latency-ms', type=float, default=10.0, help='stub latency of a tfs call')
+    parser.add_argument('--stub-concurrency', type=int, default=1, help='calls a replica serves at the same time')
+    parser.add_argument('--balancer', type=str, default='p2c', choices=('p2c', 'least_outstanding'))
+    parser.add_argument('--affinity', type=int, default=2, help='replicas per model of the affinity run, 0 to skip it')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--port', type=int, default=8641, help='the replicas listen on port, port + 1...')
+    args = parser.parse_args()
+
+    ports = [args.port + i for i in range(args.replicas)]
+    targets = [f'http://127.0.0.1:{port}' for port in ports]
+    # nothing listens there, its calls fail until it is ejected
+    dead_target = f'http://127.0.0.1:{args.port + args.replicas}'
+    with tempfile.TemporaryDirectory() as root:
+        data_dir, saved_model_dir, tables = write_product_line(root, 'pokemon', args.port, args.submodels, args.ids)
+        os.environ['DATA_DIR'] = data_dir
+        os.environ['SAVED_MODEL_DIR'] = saved_model_dir
+        # the breakers would open on the calls queued behind a single replica
+        os.environ['BREAKER_SLOW_SECONDS'] = '0'
+
+        from utils.product_lines import PRODUCTLINES as PLS
+
+        classes = ','.join(f'{model_name}={len(ids)}' for model_name, ids in tables.items())
+        with contextlib.ExitStack() as stack:
+            for port in ports:
+                stack.enter_context(run_stub(port, latency_ms=args.latency_ms, classes=classes, input_shape=INPUT_SHAPE,
+                                             concurrency=args.stub_concurrency))
+            asyncio.run(benchmark(args, PLS.POKEMON, targets, dead_target))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+'''
+Validates the numpy preprocessing of the api (api/preprocessing.py) against the tensorflow one the models were trained with
+(tf.image.resize + /255, processing/image_processing.py), and times both. Needs tensorflow, the api itself does not.
+
+    PYTHONPATH=src python -m benchmarks.resize_parity --sizes 3000x4000 750x1000 313x437 200x150 --output 313x437
+
+Prints one json line per input size with the max absolute difference and the ms per image of each; exits with 1 if a
+difference is above --tolerance.
+'''
+import argparse
+import json
+import statistics
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from api.preprocessing import resize_bilinear
+
+
+def parse_size(size: str) -> tuple[int, int]:
+    width, height = size.split('x')
+    return int(width), int(height)
+
+
+def tf_preprocess(image: np.ndarray, img_width: int, img_height: int) -> np.ndarray:
+    # same as processing.image_processing.get_tensor_from_image
+    img = tf.convert_to_tensor(image, dtype=tf.float32)
+    return (tf.image.resize(img, [img_height, img_width]) / 255.0).numpy()
+
+
+def numpy_preprocess(image: np.ndarray, img_width: int, img_height: int) -> np.ndarray:
+    out = resize_bilinear(image, img_width, img_height)
+    out /= np.float32(255.0)
+    return out
+
+
+def median_ms(fn, *args, repeats: int = 10) -> float:
+    fn(*args)  # warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn(*args)
+        times.append((time.perf_counter() - start) * 1000)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sizes', nargs='+', default=['3000x4000', '750x1000', '313x437', '200x150'], help='input WIDTHxHEIGHT')
+    parser.add_argument('--output', default='313x437', help='model input WIDTHxHEIGHT')
+    parser.add_argument('--tolerance', type=float, default=1e-5)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    img_width, img_height = parse_size(args.output)
+    rng = np.random.default_rng(args.seed)
+    failed = False
+    for size in args.sizes:
+        width, height = parse_size(size)
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+
+        difference = float(np.abs(tf_preprocess(image, img_width, img_height) - numpy_preprocess(image, img_width, img_height)).max())
+        failed |= difference > args.tolerance
+        print(json.dumps({
+            'input': size,
+            'output': args.output,
+            'max_abs_difference': difference,
+            'tf_ms': round(median_ms(tf_preprocess, image, img_width, img_height), 3),
+            'numpy_ms': round(median_ms(numpy_preprocess, image, img_width, img_height), 3),
+            }))
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,297 @@
+'''
+Stand-in for tensorflow serving, so the api and the tfs clients can be benchmarked without the gpu containers.
+It serves the rest predict and metadata apis, and the grpc PredictionService when grpcio and the tfs protos are installed.
+Predictions are cheap and deterministic: the winning class of an image is picked from its pixel mean.
+
+    PYTHONPATH=src python -m benchmarks.stub_tfs --port 8501 --grpc-port 8500 --latency-ms 5 --classes m0=13,m1=200
+'''
+import argparse
+import asyncio
+import base64
+import contextlib
+import json
+import logging
+import os
+import pickle
+import subprocess
+import sys
+import time
+import urllib.request
+
+import numpy as np
+
+from aiohttp import web
+
+DEFAULT_CLASSES = 100
+DEFAULT_INPUT_SHAPE = (437, 313, 3)
+# answers like a fused hierarchy (see fuse_saved_model): (label, confidence) rows instead of a softmax
+FUSED_MODEL_NAME = 'fused'
+
+
+class StubModels:
+    '''
+    The fake models the stub serves.
+
+    Args:
+        classes (dict[str, int]): number of output classes per model name, unknown models get default_classes
+        latency (float): seconds every predict call sleeps before answering (simulates the gpu)
+        input_shape (tuple): the input shape reported by the metadata api
+        slow_fraction (float): fraction of the predict calls that sleep slow_latency instead (simulates gc pauses, queue spikes)
+        concurrency (int): predict calls that sleep at the same time, the rest queue (simulates the capacity of the gpu),
+            0 for no limit
+    '''
+    def __init__(self, classes: dict[str, int] | None = None, latency: float = 0.0,
+                 input_shape: tuple = DEFAULT_INPUT_SHAPE, default_classes: int = DEFAULT_CLASSES,
+                 slow_fraction: float = 0.0, slow_latency: float = 0.0, concurrency: int = 0):
+        self.classes = classes or {}
+        self.latency = latency
+        self.slow_fraction = slow_fraction
+        self.slow_latency = slow_latency
+        self.rng = np.random.default_rng(0)
+        self.input_shape = input_shape
+        self.default_classes = default_classes
+        self.calls = 0
+        self.slots = asyncio.Semaphore(concurrency) if concurrency else contextlib.nullcontext()
+
+    def delay(self) -> float:
+        if self.slow_fraction and self.rng.random() < self.slow_fraction:
+            return self.slow_latency
+        return self.latency
+
+    async def wait(self):
+        '''
+        Sleeps the latency of a predict call, in one of the concurrency slots.
+        '''
+        async with self.slots:
+            delay = self.delay()
+            if delay:
+                await asyncio.sleep(delay)
+
+    def num_classes(self, model_name: str) -> int:
+        return self.classes.get(model_name, self.default_classes)
+
+    def predict(self, model_name: str, batch: np.ndarray | list[bytes]) -> np.ndarray:
+        '''
+        batch is either the preprocessed pixels or a list of encoded image files (the serve_bytes signature)
+        '''
+        self.calls += 1
+        k = self.num_classes(model_name)
+        n = len(batch)
+        if isinstance(batch, np.ndarray):
+            means = batch.reshape(n, -1).astype(np.float64).mean(axis=1) if n else np.zeros(0)
+        else:
+            means = np.array([np.frombuffer(b, dtype=np.uint8).mean() / 255.0 for b in batch])
+        labels = (means * 1e6).astype(np.int64) % k
+
+        if model_name == FUSED_MODEL_NAME:
+            return np.stack([labels, np.full(n, 0.81)], axis=1).astype(np.float32)
+        predictions = np.full((n, k), 0.1 / k, dtype=np.float32)
+        predictions[np.arange(n), labels] += 0.9
+        return predictions
+
+    def metadata(self, model_name: str) -> dict:
+        dims = [{'size': '-1'}] + [{'size': str(d)} for d in self.input_shape]
+        signature = {
+                'inputs': {'input_layer': {'dtype': 'DT_FLOAT', 'tensor_shape': {'dim': dims}, 'name': 'serve_input_layer:0'}},
+                'outputs': {'output_0': {'dtype': 'DT_FLOAT', 'tensor_shape': {'dim': [{'size': '-1'}, {'size': str(self.num_classes(model_name))}]}}},
+                'method_name': 'tensorflow/serving/predict',
+                }
+        return {
+                'model_spec': {'name': model_name, 'signature_name': '', 'version': '1'},
+                'metadata': {'signature_def': {'signature_def': {'serve': signature, 'serving_default': signature}}},
+                }
+
+
+# -------------------------------------------------------
+#   rest
+# -------------------------------------------------------
+def make_app(models: StubModels) -> web.Application:
+    async def predict(request: web.Request) -> web.Response:
+        model_name, _, method = request.match_info['model'].partition(':')
+        if method != 'predict':
+            raise web.HTTPNotFound()
+
+        body = json.loads(await request.read())
+        # the row (instances -> predictions) and columnar (inputs -> outputs) formats
+        columnar = 'inputs' in body
+        instances = body['inputs'] if columnar else body['instances']
+        if instances and isinstance(instances[0], dict):
+            batch = [base64.b64decode(instance['b64']) for instance in instances]
+        else:
+            batch = np.asarray(instances, dtype=np.float32)
+        await models.wait()
+        return web.json_response({'outputs' if columnar else 'predictions': models.predict(model_name, batch).tolist()})
+
+    async def metadata(request: web.Request) -> web.Response:
+        return web.json_response(models.metadata(request.match_info['model']))
+
+    app = web.Application(client_max_size=1 << 30)
+    app.router.add_post('/v1/models/{model}', predict)
+    app.router.add_get('/v1/models/{model}/metadata', metadata)
+    return app
+
+
+# -------------------------------------------------------
+#   grpc
+# -------------------------------------------------------
+async def start_grpc(models: StubModels, port: int):
+    import grpc
+
+    from utils.tfs_grpc import MAX_MESSAGE_LENGTH, to_tensor_proto
+    from utils.tfs_protos import DT_STRING, DT_UINT8, PREDICT_METHOD, PredictRequest, PredictResponse
+
+    async def predict(request, context):
+        proto = next(iter(request.inputs.values()))
+        if proto.dtype == DT_STRING:
+            batch = list(proto.string_val)
+        else:
+            shape = [d.size for d in proto.tensor_shape.dim]
+            dtype = np.uint8 if proto.dtype == DT_UINT8 else np.float32
+            batch = np.frombuffer(proto.tensor_content, dtype=dtype).reshape(shape)
+        await models.wait()
+
+        response = PredictResponse()
+        response.model_spec.name = request.model_spec.name
+        response.outputs['output_0'].CopyFrom(to_tensor_proto(models.predict(request.model_spec.name, batch)))
+        return response
+
+    server = grpc.aio.server(options=[
+        ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+        ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+        ])
+    service, method = PREDICT_METHOD.lstrip('/').split('/')
+    server.add_generic_rpc_handlers([grpc.method_handlers_generic_handler(service, {
+        method: grpc.unary_unary_rpc_method_handler(predict, request_deserializer=PredictRequest.FromString,
+                                                    response_serializer=PredictResponse.SerializeToString),
+        })])
+    server.add_insecure_port(f'0.0.0.0:{port}')
+    await server.start()
+    return server
+
+
+async def serve(models: StubModels, port: int, grpc_port: int | None = None):
+    runner = web.AppRunner(make_app(models), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, '0.0.0.0', port).start()
+    logging.info(' [stub_tfs] rest on %d', port)
+
+    grpc_server = None
+    if grpc_port:
+        # kept referenced, a grpc.aio server that gets garbage collected stops serving
+        grpc_server = await start_grpc(models, grpc_port)
+        logging.info(' [stub_tfs] grpc on %d', grpc_port)
+
+    try:
+        await asyncio.Event().wait()
+    finally:
+        if grpc_server is not None:
+            await grpc_server.stop(None)
+
+
+# -------------------------------------------------------
+#   helpers for the benchmarks
+# -------------------------------------------------------
+def parse_classes(s: str) -> dict[str, int]:
+    '''
+    'm0=13,m1=200' -> {'m0': 13, 'm1': 200}
+    '''
+    classes = {}
+    for pair in filter(None, s.split(',')):
+        model_name, n = pair.split('=')
+        classes[model_name] = int(n)
+    return classes
+
+
+@contextlib.contextmanager
+def run_stub(port: int, grpc_port: int | None = None, latency_ms: float = 0.0, classes: str = '', timeout: float = 30.0,
+             input_shape: tuple | None = None, slow_fraction: float = 0.0, slow_ms: float = 0.0, concurrency: int = 0):
+    '''
+    Runs the stub in a subprocess (so it does not compete with the benchmark for the gil) until the block exits.
+    '''
+    cmd = [sys.executable, '-m', 'benchmarks.stub_tfs', '--port', str(port), '--latency-ms', str(latency_ms), '--classes', classes]
+    if grpc_port:
+        cmd += ['--grpc-port', str(grpc_port)]
+    if input_shape:
+        cmd += ['--input-shape', *map(str, input_shape)]
+    if slow_fraction:
+        cmd += ['--slow-fraction', str(slow_fraction), '--slow-ms', str(slow_ms)]
+    if concurrency:
+        cmd += ['--concurrency', str(concurrency)]
+    process = subprocess.Popen(cmd)
+    try:
+        wait_until_up(f'http://127.0.0.1:{port}/v1/models/m0/metadata', timeout)
+        yield process
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def write_product_line(root: str, pl: str, port: int, submodels: int, ids_per_submodel: int, fused: bool = False,
+                       serving: str = "max_batch_size = 0") -> tuple[str, str, dict[str, list[str]]]:
+    '''
+    Writes a throwaway product line under root, served by the stub on port: an m0 that routes to submodels final models
+    of ids_per_submodel _ids each (m0 is the only, final, model when submodels is 0), plus the fused model when fused.
+
+    Args:
+        serving (str): extra toml lines for the [serving] table
+    Returns:
+        tuple[str, str, dict]: the DATA_DIR and SAVED_MODEL_DIR to point the api at, and the ids of every model
+    '''
+    data_dir = os.path.join(root, 'data', pl)
+    model_dir = os.path.join(root, 'saved_models', pl)
+    os.makedirs(data_dir)
+    os.makedirs(model_dir)
+
+    if submodels:
+        tables = {'m0': [f'm{i + 1}' for i in range(submodels)]}
+        for i in range(submodels):
+            tables[f'm{i + 1}'] = [f'card-{i + 1}-{j}' for j in range(ids_per_submodel)]
+    else:
+        tables = {'m0': [f'card-{j}' for j in range(ids_per_submodel)]}
+    if fused:
+        tables[FUSED_MODEL_NAME] = [_id for model_name, ids in tables.items() if model_name != 'm0' or not submodels for _id in ids]
+    for model_name, ids in tables.items():
+        with open(os.path.join(data_dir, f'{model_name}_ids.pkl'), 'wb') as f:
+            pickle.dump(ids, f)
+
+    with open(os.path.join(model_dir, 'config.toml'), 'w') as f:
+        f.write(f'[m0]\nis_final = {str(not submodels).lower()}\n')
+        for model_name in tables:
+            if model_name != 'm0':
+                f.write(f'[{model_name}]\nis_final = true\n')
+        f.write(f"[serving]\nurl = 'http://127.0.0.1:{port}'\n{serving}\n")
+
+    return os.path.join(root, 'data'), os.path.join(root, 'saved_models'), tables
+
+
+def wait_until_up(url: str, timeout: float):
+    start = time.time()
+    while time.time() - start < timeout:
+        try:
+            urllib.request.urlopen(url, timeout=1)
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'{url} did not come up within {timeout}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--port', type=int, default=8501)
+    parser.add_argument('--grpc-port', type=int, default=None)
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--classes', type=str, default='', help='classes per model, ex) m0=13,m1=200')
+    parser.add_argument('--default-classes', type=int, default=DEFAULT_CLASSES)
+    parser.add_argument('--input-shape', type=int, nargs=3, default=DEFAULT_INPUT_SHAPE, help='reported by the metadata api')
+    parser.add_argument('--slow-fraction', type=float, default=0.0, help='fraction of the predict calls that take --slow-ms')
+    parser.add_argument('--slow-ms', type=float, default=0.0)
+    parser.add_argument('--concurrency', type=int, default=0, help='predict calls served at the same time, 0 for no limit')
+    args = parser.parse_args()
+
+    models = StubModels(parse_classes(args.classes), args.latency_ms / 1000, tuple(args.input_shape), args.default_classes,
+                        args.slow_fraction, args.slow_ms / 1000, args.concurrency)
+    asyncio.run(serve(models, args.port, args.grpc_port))
+
+
+if __name__ == '__main__':
+    main()
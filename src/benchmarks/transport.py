@@ -0,0 +1,84 @@
+'''
+Compares the rest (json instances) and grpc (packed tensor_content) transports of the tfs client:
+request payload size and round trip latency against the stub tfs, at a few batch sizes.
+
+    PYTHONPATH=src python -m benchmarks.transport --batch-sizes 1 4 16 --repeats 20
+
+Prints one json object per transport and batch size.
+'''
+import argparse
+import asyncio
+import json
+import statistics
+import time
+
+import numpy as np
+
+from benchmarks.stub_tfs import DEFAULT_INPUT_SHAPE, run_stub
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.tfs_client import TFSClient, encode_instances
+
+
+def payload_size(transport: str, batch: np.ndarray) -> int:
+    if transport == 'rest':
+        return len(encode_instances(batch, columnar=True))
+
+    return len(TFSClient().get_grpc_transport(PLS.POKEMON).encode('m0', batch))
+
+
+async def time_round_trips(pl: PLS, batch: np.ndarray, repeats: int) -> list[float]:
+    client = TFSClient()
+    await client.predict('m0', pl, batch)  # warm up the connection
+
+    latencies = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        await client.predict('m0', pl, batch)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+async def run(args) -> list[dict]:
+    results = []
+    rng = np.random.default_rng(0)
+    for transport in args.transports:
+        TFSClient().configure(PLS.POKEMON, {
+            'transport': transport,
+            'url': f'http://127.0.0.1:{args.port}',
+            'grpc_url': f'127.0.0.1:{args.grpc_port}',
+            'grpc_dtype': args.grpc_dtype,
+            'timeout': 120.0,
+            })
+        for batch_size in args.batch_sizes:
+            batch = rng.random((batch_size, *DEFAULT_INPUT_SHAPE), dtype=np.float32)
+            latencies = await time_round_trips(PLS.POKEMON, batch, args.repeats)
+            results.append({
+                'transport': transport,
+                'batch_size': batch_size,
+                'request_bytes': payload_size(transport, batch),
+                'p50_ms': statistics.median(latencies),
+                'mean_ms': statistics.fmean(latencies),
+                'max_ms': max(latencies),
+                })
+        await TFSClient().close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 4, 16])
+    parser.add_argument('--repeats', type=int, default=20)
+    parser.add_argument('--transports', nargs='+', default=['rest', 'grpc'], choices=['rest', 'grpc'])
+    parser.add_argument('--grpc-dtype', default='float32', choices=['float32', 'uint8'])
+    parser.add_argument('--port', type=int, default=18501)
+    parser.add_argument('--grpc-port', type=int, default=18500)
+    args = parser.parse_args()
+
+    grpc_port = args.grpc_port if 'grpc' in args.transports else None
+    with run_stub(args.port, grpc_port, classes='m0=23675'):
+        for result in asyncio.run(run(args)):
+            print(json.dumps(result))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+'''
+Memory and throughput of the api from 1 to N workers, against the stub tfs: for every worker count, the api is started
+(gunicorn with the settings of the api container, or uvicorn), loaded like benchmarks.loadtest, and the memory of each
+of its workers is read from /proc once it is ready and again after the load.
+
+    PYTHONPATH=src python -m benchmarks.workers --workers 1 2 4 8 --ids 50000 --concurrency 32 --requests 2000 --compare-unshared
+
+Prints one json object per worker count (and per table mode with --compare-unshared): the mean rss and pss (MB) of a worker
+at startup and after the load, the summed pss of all of them, and requests/sec, images/sec and latency percentiles.
+pss splits the shared pages between the processes mapping them, so the memory mapped id tables show up there.
+The stub is a single process, give it some latency (--latency-ms) so it is not what limits the scaling.
+'''
+import asyncio
+import contextlib
+import json
+import os
+import shutil
+import statistics
+import tempfile
+
+from benchmarks.loadtest import drive, make_parser, make_scans, run_api, write_product_lines
+from benchmarks.stub_tfs import run_stub
+
+
+def read_kb(path: str, field: str) -> int | None:
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def worker_pids(pid: int) -> list[int]:
+    '''
+    The worker processes of the api: the children of its main process (but multiprocessing's resource tracker),
+    or the main process itself when it serves on its own (uvicorn with a single worker).
+    '''
+    pids = []
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+            with open(f'/proc/{entry}/cmdline', 'rb') as f:
+                cmdline = f.read()
+        except (OSError, IndexError, ValueError):
+            continue
+        if ppid == pid and b'resource_tracker' not in cmdline:
+            pids.append(int(entry))
+    return pids or [pid]
+
+
+def memory(pid: int) -> dict:
+    '''
+    Mean and summed rss / pss (MB) of the workers of the api.
+    '''
+    pids = worker_pids(pid)
+    rss = [read_kb(f'/proc/{worker}/status', 'VmRSS') or 0 for worker in pids]
+    pss = [read_kb(f'/proc/{worker}/smaps_rollup', 'Pss') or 0 for worker in pids]
+    return {
+            'workers_found': len(pids),
+            'rss_mb_per_worker': round(statistics.mean(rss) / 1024, 1) if rss else None,
+            'pss_mb_per_worker': round(statistics.mean(pss) / 1024, 1) if pss else None,
+            'pss_mb_total': round(sum(pss) / 1024, 1),
+            }
+
+
+def main():
+    parser = make_parser(__doc__)
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--server', choices=['uvicorn', 'gunicorn'], default='gunicorn')
+    parser.add_argument('--compare-unshared', action='store_true', help='also run with a copy of the id tables per worker')
+    parser.add_argument('--startup-timeout', type=float, default=120.0)
+    args = parser.parse_args()
+
+    scans = make_scans(min(args.requests * args.images_per_request, 64), *args.image_size)
+    with tempfile.TemporaryDirectory() as root:
+        env, classes = write_product_lines(root, args)
+        with run_stub(args.tfs_port, latency_ms=args.latency_ms, classes=classes, input_shape=tuple(args.input_shape)):
+            for workers in args.workers:
+                for shared in (True, False) if args.compare_unshared else (True,):
+                    # in memory like in the container, a fresh dir per run so the first worker builds the tables
+                    shared_dir = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else root) if shared else ''
+                    run_env = {**env, 'SHARED_METADATA_DIR': shared_dir}
+                    try:
+                        with run_api(args.api_port, run_env, workers, args.verbose, args.startup_timeout, args.server) as process:
+                            at_startup = memory(process.pid)
+                            result = asyncio.run(drive(f'http://127.0.0.1:{args.api_port}', scans, args))
+                            after_load = memory(process.pid)
+                    finally:
+                        if shared_dir:
+                            with contextlib.suppress(OSError):
+                                shutil.rmtree(shared_dir)
+
+                    print(json.dumps({
+                        'workers': workers,
+                        'shared_tables': shared,
+                        'startup': at_startup,
+                        'after_load': after_load,
+                        **{key: result[key] for key in ('requests_per_s', 'images_per_s', 'p50_ms', 'p95_ms', 'p99_ms', 'errors')},
+                        }), flush=True)
+
+
+if __name__ == '__main__':
+    main()
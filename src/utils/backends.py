@@ -0,0 +1,46 @@
+import logging
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.inference import InferenceBackend
+from utils.local_inference import LocalBackend
+from utils.tfs_client import TFSClient, get_serving_option
+
+# backend='tfs' (the tensorflow serving containers) or 'local' (the models in the api process),
+# can be overridden with the env or per product line in the [serving] table of its config.toml
+DEFAULT_BACKEND = 'tfs'
+BACKENDS: dict[str, type] = {
+        'tfs': TFSClient,
+        'local': LocalBackend,
+        }
+
+
+class Backends(metaclass=Singleton):
+    '''
+    Which InferenceBackend every product line runs its models on.
+    '''
+    def __init__(self):
+        self.names: dict[str, str] = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        name = get_serving_option(serving_config, 'backend', 'INFERENCE_BACKEND', DEFAULT_BACKEND)
+        if name not in BACKENDS:
+            raise ValueError(f'unknown inference backend {name!r} for {pl.value}, expected one of {list(BACKENDS)}')
+        if self.names.get(pl.value, name) != name:
+            logging.info(' [Backends] %s switched from %s to %s', pl.value, self.names[pl.value], name)
+        self.names[pl.value] = name
+        BACKENDS[name]().configure(pl, serving_config)
+
+    def name(self, pl: PLS) -> str:
+        return self.names.get(pl.value, DEFAULT_BACKEND)
+
+    def get(self, pl: PLS) -> InferenceBackend:
+        return BACKENDS[self.name(pl)]()
+
+    async def close(self):
+        for name in set(self.names.values()) | {DEFAULT_BACKEND}:
+            await BACKENDS[name]().close()
+
+
+def get_backend(pl: PLS) -> InferenceBackend:
+    return Backends().get(pl)
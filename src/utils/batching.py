@@ -0,0 +1,187 @@
+import asyncio
+import logging
+import time
+
+from collections import Counter
+
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.backends import get_backend
+from utils.circuit import CircuitBreakers
+from utils.deadline import REQUEST_DEADLINE, DeadlineExceeded, remaining
+from utils.tfs_client import get_serving_option, is_encoded
+
+# defaults, can be overridden with the env or per product line in the [serving] table of its config.toml
+# (max_batch_size = 0 turns the batching off for a product line)
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_BATCH_WAIT_MS = 2.0
+
+
+async def call_backend(model_name: str, pl: PLS, instances, timeout: float | None = None) -> np.ndarray:
+    '''
+    The backend call of a model, its outcome (and latency) moves the model's circuit breaker.
+    A call cut short by the budget of its requests (DeadlineExceeded) says nothing about the model and is not recorded.
+    '''
+    started = time.monotonic()
+    try:
+        predictions = await get_backend(pl).predict(model_name, pl, instances, timeout)
+    except DeadlineExceeded:
+        raise
+    except Exception as e:
+        CircuitBreakers().record(pl, model_name, started, e)
+        raise
+    CircuitBreakers().record(pl, model_name, started)
+    return predictions
+
+
+class MicroBatcher:
+    '''
+    Collects the instances that concurrent requests send to one (product line, model) and sends them to the backend together.
+    A batch is flushed once it holds max_batch_size instances or its oldest instance waited max_wait seconds,
+    then every waiting request gets its own slice of the predictions back.
+    A request is never split between batches: the pending instances are flushed first when a request would take the batch
+    over max_batch_size (the most tfs accepts), and a request bigger than max_batch_size is sent on its own.
+    The backend call gets the budget of the request with the most time left (see request_deadline),
+    or the backend's own timeout when one of the requests has no deadline.
+    '''
+    def __init__(self, model_name: str, pl: PLS, max_batch_size: int, max_wait: float):
+        self.model_name = model_name
+        self.pl = pl
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.pending: list[tuple[list, asyncio.Future, float | None]] = []
+        self.pending_size = 0
+        self.timer: asyncio.TimerHandle | None = None
+        self.tasks: set[asyncio.Task] = set()
+
+        self.batch_sizes = Counter()
+        self.requests = 0
+
+    async def predict(self, instances) -> np.ndarray:
+        future = asyncio.get_running_loop().create_future()
+        if self.pending and self.pending_size + len(instances) > self.max_batch_size:
+            self.flush()
+        self.pending.append((instances, future, REQUEST_DEADLINE.get()))
+        self.pending_size += len(instances)
+        self.requests += 1
+
+        if self.pending_size >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None:
+            self.timer = asyncio.get_running_loop().call_later(self.max_wait, self.flush)
+        return await future
+
+    def resize(self, max_batch_size: int, max_wait: float):
+        '''
+        Applies the options of a config refresh. The next batch uses them, the pending one is flushed when it already holds enough.
+        '''
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        if self.pending_size >= max_batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        if not self.pending:
+            return
+
+        pending, self.pending, self.pending_size = self.pending, [], 0
+        task = asyncio.create_task(self.send(pending))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def send(self, pending: list[tuple[list, asyncio.Future, float | None]]):
+        instances = []
+        for request_instances, _, _ in pending:
+            instances.extend(request_instances)
+        deadlines = [deadline for _, _, deadline in pending]
+        timeout = None if None in deadlines else max(deadlines) - time.monotonic()
+        self.batch_sizes[len(instances)] += 1
+
+        try:
+            if timeout is not None and timeout <= 0:
+                raise DeadlineExceeded(f'no budget left for {self.pl.value}/{self.model_name}')
+            predictions = await call_backend(self.model_name, self.pl, instances, timeout)
+        except Exception as e:
+            for _, future, _ in pending:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        start = 0
+        for request_instances, future, _ in pending:
+            end = start + len(request_instances)
+            if not future.done():  # the request could have been cancelled while waiting
+                future.set_result(predictions[start:end])
+            start = end
+
+    def stats(self) -> dict:
+        batches = sum(self.batch_sizes.values())
+        instances = sum(size * n for size, n in self.batch_sizes.items())
+        return {
+                'requests': self.requests,
+                'batches': batches,
+                'instances': instances,
+                'mean_batch_size': instances / batches if batches else 0.0,
+                'max_batch_size': max(self.batch_sizes, default=0),
+                'batch_sizes': dict(sorted(self.batch_sizes.items())),
+                }
+
+
+class MicroBatchers(metaclass=Singleton):
+    '''
+    One MicroBatcher per (product line, model, kind of instances) (pixels and encoded files go to different signatures).
+    '''
+    def __init__(self):
+        self.options: dict[str, dict] = {}
+        self.batchers: dict[tuple[str, str, bool], MicroBatcher] = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        '''
+        Sets the batching options of a product line, the batchers it already has take them too
+        (with max_batch_size = 0 they send what they hold and are no longer used).
+        '''
+        options = {
+            'max_batch_size': get_serving_option(serving_config, 'max_batch_size', 'BATCH_MAX_SIZE', DEFAULT_MAX_BATCH_SIZE),
+            'max_batch_wait_ms': get_serving_option(serving_config, 'max_batch_wait_ms', 'BATCH_MAX_WAIT_MS', DEFAULT_MAX_BATCH_WAIT_MS),
+        }
+        if options != self.options.get(pl.value):
+            for (pl_value, _, _), batcher in self.batchers.items():
+                if pl_value == pl.value:
+                    batcher.resize(options['max_batch_size'], options['max_batch_wait_ms'] / 1000)
+        self.options[pl.value] = options
+
+    def get_options(self, pl: PLS) -> dict:
+        if pl.value not in self.options:
+            self.configure(pl, {})
+        return self.options[pl.value]
+
+    async def predict(self, model_name: str, pl: PLS, instances) -> np.ndarray:
+        '''
+        Same contract as InferenceBackend.predict, but the call shares its backend call with concurrent calls to the same model.
+        Fails right away with a CircuitOpenError while the model's circuit is open.
+        '''
+        CircuitBreakers().check(pl, model_name)
+        options = self.get_options(pl)
+        if options['max_batch_size'] <= 0:
+            return await call_backend(model_name, pl, instances, remaining())
+
+        key = (pl.value, model_name, is_encoded(instances))
+        batcher = self.batchers.get(key)
+        if batcher is None:
+            batcher = MicroBatcher(model_name, pl, options['max_batch_size'], options['max_batch_wait_ms'] / 1000)
+            self.batchers[key] = batcher
+            logging.info(' [MicroBatchers] batching %s/%s (max %d instances, %.1fms)',
+                         pl.value, model_name, batcher.max_batch_size, options['max_batch_wait_ms'])
+        return await batcher.predict(instances)
+
+    def stats(self) -> dict:
+        stats = {}
+        for (pl, model_name, encoded), batcher in self.batchers.items():
+            stats.setdefault(pl, {})[model_name + (':encoded' if encoded else '')] = batcher.stats()
+        return stats
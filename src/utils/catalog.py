@@ -0,0 +1,206 @@
+import fcntl
+import json
+import logging
+import os
+import pickle
+import sqlite3
+import sys
+import threading
+
+from utils.product_lines import PRODUCTLINES as PLS, string_to_product_line
+from utils.singleton import Singleton
+from utils.file_handler.dir import get_data_dir
+from utils.file_handler.json import load_deckdrafterprod
+
+CATALOG_NAME = 'catalog.sqlite'
+# the name of a card is stored under a different field depending on the game (see data_conversion.format_json)
+NAME_FIELDS = ('name', 'productName')
+TCGPLAYER_FIELD = 'tcgplayer_productId'
+
+SCHEMA = '''
+CREATE TABLE cards (
+    _id TEXT PRIMARY KEY,
+    label INTEGER UNIQUE,
+    name TEXT,
+    tcgplayer_id TEXT,
+    card TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+'''
+
+
+def get_catalog_path(pl: PLS) -> str:
+    return os.path.join(get_data_dir(), pl.value, CATALOG_NAME)
+
+
+def get_deckdrafterprod_path(pl: PLS) -> str:
+    return os.path.join(get_data_dir(), pl.value, 'deckdrafterprod.json')
+
+
+def master_labels(pl: PLS, deckdrafterprod: list) -> dict[str, int]:
+    '''
+    The master label of every _id: its index in master_ids.pkl (see data.collect.generate_keys),
+    or in deckdrafterprod.json when the master ids were not generated yet (generate_keys keeps that order).
+    '''
+    master_ids_path = os.path.join(get_data_dir(), pl.value, 'master_ids.pkl')
+    if os.path.exists(master_ids_path):
+        with open(master_ids_path, 'rb') as f:
+            _ids = pickle.load(f)
+    else:
+        _ids = [str(card['_id']) for card in deckdrafterprod]
+    return {str(_id): label for label, _id in enumerate(_ids)}
+
+
+def build_catalog(pl: PLS) -> str:
+    '''
+    Builds the indexed catalog of a product line from its deckdrafterprod.json: one row per card, keyed by _id,
+    with its master label, name and tcgplayer id next to the raw json object.
+    Written to a temp file and moved in place, so readers never see a half built catalog.
+
+    Args:
+        pl (PRODUCTLINES): The product_line we are working with.
+    Returns:
+        str: the path of the catalog
+    '''
+    source_path = get_deckdrafterprod_path(pl)
+    source_mtime = os.path.getmtime(source_path)
+    deckdrafterprod = load_deckdrafterprod(pl, 'r')
+    labels = master_labels(pl, deckdrafterprod)
+
+    def rows():
+        for card in deckdrafterprod:
+            _id = str(card['_id'])
+            name = next((card[field] for field in NAME_FIELDS if card.get(field) is not None), None)
+            tcgplayer_id = card.get(TCGPLAYER_FIELD)
+            yield (_id, labels.get(_id), name, None if tcgplayer_id is None else str(tcgplayer_id), json.dumps(card))
+
+    path = get_catalog_path(pl)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    connection = sqlite3.connect(tmp_path)
+    try:
+        connection.executescript(SCHEMA)
+        # a duplicated _id keeps its last object, like a dict built from the json would
+        connection.executemany('INSERT OR REPLACE INTO cards VALUES (?, ?, ?, ?, ?)', rows())
+        connection.execute('INSERT INTO meta VALUES (?, ?)', ('source_mtime', repr(source_mtime)))
+        connection.commit()
+    finally:
+        connection.close()
+    os.replace(tmp_path, path)
+    logging.info(' [build_catalog] %s: %d cards', path, len(deckdrafterprod))
+    return path
+
+
+def is_stale(pl: PLS) -> bool:
+    '''
+    True when the catalog is missing or was built from an older deckdrafterprod.json.
+    '''
+    path = get_catalog_path(pl)
+    if not os.path.exists(path):
+        return True
+    try:
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+        try:
+            (source_mtime,), = connection.execute("SELECT value FROM meta WHERE key = 'source_mtime'").fetchall()
+        finally:
+            connection.close()
+    except (sqlite3.Error, ValueError):
+        return True
+    return float(source_mtime) != os.path.getmtime(get_deckdrafterprod_path(pl))
+
+
+class Catalog(metaclass=Singleton):
+    '''
+    Card metadata of every product line, looked up through the primary key / unique index of its sqlite catalog
+    (see build_catalog) instead of scanning all of deckdrafterprod.json. Only the rows asked for are read,
+    so a lookup costs a few index probes and the catalog is never loaded into memory.
+    The bulk lookups take a list and answer in the same order, None for what is not in the catalog.
+    '''
+    def __init__(self):
+        self.connections: dict[str, sqlite3.Connection] = {}
+        self.mtimes: dict[str, float] = {}
+        # open runs in a worker thread while the event loop reads, so the connections are shared between threads
+        self.lock = threading.Lock()
+
+    def open(self, pl: PLS):
+        '''
+        (Re)builds the catalog if deckdrafterprod.json changed, and opens it read only. Blocking, call it off the event loop.
+        With several api workers, the first one to take the lock builds a stale catalog and the others wait and open it.
+        '''
+        path = get_catalog_path(pl)
+        with open(f'{path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if is_stale(pl):
+                build_catalog(pl)
+        mtime = os.path.getmtime(path)
+        if self.mtimes.get(pl.value) == mtime:
+            return
+
+        connection = sqlite3.connect(f'file:{path}?mode=ro', uri=True, check_same_thread=False)
+        with self.lock:
+            old = self.connections.get(pl.value)
+            self.connections[pl.value] = connection
+            self.mtimes[pl.value] = mtime
+        if old is not None:
+            old.close()
+        logging.info(' [Catalog] opened %s', path)
+
+    def is_open(self, pl: PLS) -> bool:
+        return pl.value in self.connections
+
+    def query(self, pl: PLS, columns: str, key: str, values: list) -> dict:
+        '''
+        {key: row} of the rows whose key is one of values, in a single query (the values are passed as one json array).
+        '''
+        connection = self.connections.get(pl.value)
+        if connection is None:
+            raise KeyError(f'the catalog of {pl.value} is not open')
+        with self.lock:
+            rows = connection.execute(
+                    f'SELECT {key}, {columns} FROM cards WHERE {key} IN (SELECT value FROM json_each(?))',
+                    (json.dumps(values),),
+                    ).fetchall()
+        return {row[0]: row[1:] for row in rows}
+
+    def cards(self, pl: PLS, _ids: list[str | None]) -> list[dict | None]:
+        '''
+        The raw deckdrafterprod json object of every _id.
+        '''
+        rows = self.query(pl, 'card', '_id', [_id for _id in _ids if _id is not None])
+        return [json.loads(rows[_id][0]) if _id in rows else None for _id in _ids]
+
+    def summaries(self, pl: PLS, _ids: list[str | None]) -> list[dict | None]:
+        '''
+        The name and tcgplayer id of every _id, what /predict returns next to the _ids.
+        '''
+        rows = self.query(pl, 'name, tcgplayer_id', '_id', [_id for _id in _ids if _id is not None])
+        return [{'name': rows[_id][0], 'tcgplayer_id': rows[_id][1]} if _id in rows else None for _id in _ids]
+
+    def labels(self, pl: PLS, _ids: list[str]) -> list[int | None]:
+        '''
+        The master label of every _id.
+        '''
+        rows = self.query(pl, 'label', '_id', list(_ids))
+        return [rows[_id][0] if _id in rows else None for _id in _ids]
+
+    def ids(self, pl: PLS, labels: list[int]) -> list[str | None]:
+        '''
+        The _id of every master label.
+        '''
+        rows = self.query(pl, '_id', 'label', [int(label) for label in labels])
+        return [rows[int(label)][0] if int(label) in rows else None for label in labels]
+
+    def close(self):
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+            self.mtimes.clear()
+        for connection in connections:
+            connection.close()
+
+
+if __name__ == '__main__':
+    # python -m utils.catalog pokemon lorcana
+    for product_line_string in sys.argv[1:] or [pl.value for pl in PLS]:
+        build_catalog(string_to_product_line(product_line_string))
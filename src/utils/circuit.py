@@ -0,0 +1,204 @@
+import logging
+import time
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.tfs_client import get_serving_option
+from utils.metrics import CIRCUIT_STATE
+
+# defaults, can be overridden with the env or per product line in the [serving] table of its config.toml
+DEFAULT_BREAKER_FAILURES = 5
+DEFAULT_BREAKER_OPEN_SECONDS = 10.0
+# a call slower than this counts as a failure (0 turns it off)
+DEFAULT_BREAKER_SLOW_SECONDS = 5.0
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+# grpc status codes that mean the request was bad, not that the model is unavailable
+CLIENT_ERROR_CODES = ('INVALID_ARGUMENT', 'FAILED_PRECONDITION', 'OUT_OF_RANGE')
+
+
+class CircuitOpenError(Exception):
+    '''
+    Raised instead of calling a model whose circuit is open.
+    '''
+
+
+def is_server_failure(e: BaseException) -> bool:
+    '''
+    True for the errors that say the model is unavailable (timeouts, refused connections, 5xx...),
+    False for the ones caused by the request itself (a 4xx, ex) an image tfs could not decode).
+    '''
+    status = getattr(e, 'status', None)
+    if isinstance(status, int):
+        return status >= 500
+    code = getattr(e, 'code', None)
+    if callable(code):
+        return getattr(code(), 'name', None) not in CLIENT_ERROR_CODES
+    return True
+
+
+class Breaker:
+    '''
+    The circuit of one (product line, model):
+        - closed: calls go through, failures_in_a_row consecutive failures (or slow calls) open it
+        - open: calls fail right away for open_seconds
+        - half_open: a single probe call goes through, its success closes the circuit and its failure opens it again
+          (a probe that never reports back, ex) a cancelled request, is replaced after open_seconds)
+    Once the circuit opened, only its probe moves it: the outcome of a call that started before the probe
+    (ex) a slow call sent while the circuit was still closed) is ignored.
+    '''
+    def __init__(self):
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probe_started_at: float | None = None
+        self.last_error: str | None = None
+        self.trips = 0
+
+    def allow(self, open_seconds: float) -> bool:
+        if self.state == CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == OPEN:
+            if now - self.opened_at < open_seconds:
+                return False
+            self.state = HALF_OPEN
+        elif self.probe_started_at is not None and now - self.probe_started_at < open_seconds:
+            return False
+        self.probe_started_at = now
+        return True
+
+    def record(self, failed: bool, max_failures: int, started: float, error: str | None = None) -> bool:
+        '''
+        Args:
+            started (float): time.monotonic() when the call started
+        Returns:
+            bool: True if the call changed the state of the circuit
+        '''
+        if self.state != CLOSED and (self.probe_started_at is None or started < self.probe_started_at):
+            return False
+        state = self.state
+        if not failed:
+            self.state = CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self.probe_started_at = None
+            return state != CLOSED
+
+        self.failures += 1
+        self.last_error = error
+        if self.state == HALF_OPEN or self.failures >= max_failures:
+            if self.state != OPEN:
+                self.trips += 1
+            self.state = OPEN
+            self.opened_at = time.monotonic()
+            self.probe_started_at = None
+        return state != self.state
+
+    def current_state(self, open_seconds: float) -> str:
+        '''
+        The state the next call would find: an open circuit that waited long enough is ready to probe.
+        '''
+        if self.state == OPEN and time.monotonic() - self.opened_at >= open_seconds:
+            return HALF_OPEN
+        return self.state
+
+    def stats(self) -> dict:
+        return {
+                'state': self.state,
+                'failures_in_a_row': self.failures,
+                'opened_seconds_ago': None if self.opened_at is None else time.monotonic() - self.opened_at,
+                'trips': self.trips,
+                'last_error': self.last_error,
+                }
+
+
+class CircuitBreakers(metaclass=Singleton):
+    '''
+    A circuit breaker per (product line, model), in front of the backend calls (see MicroBatchers),
+    so the images of a model that is down fail right away instead of each waiting out the tfs timeout.
+    Only the outcome of real backend calls moves a circuit, /health and /ready read the states without calling the models.
+    Set with breaker_failures, breaker_open_seconds and breaker_slow_seconds in the [serving] table.
+    '''
+    def __init__(self):
+        self.options: dict[str, dict] = {}
+        self.breakers: dict[tuple[str, str], Breaker] = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        self.options[pl.value] = {
+            'failures': get_serving_option(serving_config, 'breaker_failures', 'BREAKER_FAILURES', DEFAULT_BREAKER_FAILURES),
+            'open_seconds': get_serving_option(serving_config, 'breaker_open_seconds', 'BREAKER_OPEN_SECONDS', DEFAULT_BREAKER_OPEN_SECONDS),
+            'slow_seconds': get_serving_option(serving_config, 'breaker_slow_seconds', 'BREAKER_SLOW_SECONDS', DEFAULT_BREAKER_SLOW_SECONDS),
+        }
+
+    def get_options(self, pl: PLS) -> dict:
+        if pl.value not in self.options:
+            self.configure(pl, {})
+        return self.options[pl.value]
+
+    def get(self, pl: PLS, model_name: str) -> Breaker:
+        key = (pl.value, model_name)
+        breaker = self.breakers.get(key)
+        if breaker is None:
+            breaker = Breaker()
+            self.breakers[key] = breaker
+        return breaker
+
+    def check(self, pl: PLS, model_name: str):
+        '''
+        Raises:
+            CircuitOpenError: if the model's circuit is open (or half open with its probe in flight)
+        '''
+        breaker = self.get(pl, model_name)
+        state = breaker.state
+        if not breaker.allow(self.get_options(pl)['open_seconds']):
+            raise CircuitOpenError(f'the circuit of {pl.value}/{model_name} is {breaker.state}')
+        if breaker.state != state:
+            logging.info(' [CircuitBreakers] %s/%s is now %s, probing', pl.value, model_name, breaker.state)
+            self.update_metric(pl, model_name, breaker)
+
+    def record(self, pl: PLS, model_name: str, started: float, error: BaseException | None = None):
+        '''
+        Records the outcome of a backend call that started at started (time.monotonic()): a failure of the model
+        (see is_server_failure), or a call slower than breaker_slow_seconds, counts towards opening its circuit,
+        anything else closes it.
+        '''
+        seconds = time.monotonic() - started
+        options = self.get_options(pl)
+        slow = 0 < options['slow_seconds'] < seconds
+        failed = slow or (error is not None and is_server_failure(error))
+        reason = repr(error) if error is not None else f'slow call ({seconds:.2f}s)' if slow else None
+
+        breaker = self.get(pl, model_name)
+        if breaker.record(failed, options['failures'], started, reason):
+            log = logging.warning if breaker.state == OPEN else logging.info
+            log(' [CircuitBreakers] %s/%s is now %s (%s)', pl.value, model_name, breaker.state, reason or 'call succeeded')
+            self.update_metric(pl, model_name, breaker)
+
+    def update_metric(self, pl: PLS, model_name: str, breaker: Breaker):
+        CIRCUIT_STATE.labels(pl.value, model_name).set(STATE_VALUES[breaker.state])
+
+    def is_available(self, pl: PLS, model_name: str) -> bool:
+        '''
+        False while the model's circuit is open, for /ready and /health (which report it without failing the probe of the api).
+        A circuit that can probe counts as available, the next request is the one that can close it.
+        '''
+        breaker = self.breakers.get((pl.value, model_name))
+        return breaker is None or breaker.current_state(self.get_options(pl)['open_seconds']) != OPEN
+
+    def states(self, pl: PLS, model_names) -> dict:
+        '''
+        The state of every model, without calling any (models that were never called are closed).
+        '''
+        open_seconds = self.get_options(pl)['open_seconds']
+        return {model_name: self.breakers.get((pl.value, model_name), Breaker()).current_state(open_seconds) for model_name in model_names}
+
+    def stats(self) -> dict:
+        stats = {}
+        for (pl, model_name), breaker in self.breakers.items():
+            stats.setdefault(pl, {})[model_name] = breaker.stats()
+        return stats
@@ -6,61 +6,60 @@ import tomllib
 from pathlib import Path
 
 from utils.product_lines import PRODUCTLINES as PLS
-from utils.file_handler.json import load_deckdrafterprod
-from utils.file_handler.pickle import load_ids
+from utils.catalog import Catalog
 
 # TODO : move this to the processing package
-def label_to_id(label : int, pl : PLS) -> str:
+# a label here is the master label of a card: its index in master_ids.pkl (see data.collect.generate_keys),
+# the one definition shared with the catalog (see utils/catalog.py). the labels a model outputs are indices into
+# that model's own m*_ids.pkl, identify maps them to _ids through the RoutingTables
+def open_catalog(pl: PLS) -> Catalog:
+    if not Catalog().is_open(pl):
+        Catalog().open(pl)
+    return Catalog()
+
+
+def label_to_id(label : int, pl : PLS) -> str | None:
     '''
-    Convert a given label to the deckdrafterprod _id based on the m0_labels.toml
+    Convert a given master label to the deckdrafterprod _id, in the indexed catalog
 
     Args:
-        label (str): what the tensorflow model will spit out
+        label (int): the master label of the card
         pl (PRODUCTLINES): The product_line we are working with.
     Returns:
-        str: _id that is associated with that label
+        str | None: _id that is associated with that label (None if the catalog does not know the label)
     '''
-    _ids = load_ids(pl, 'm0', 'rb')
-    return _ids[label]
+    return open_catalog(pl).ids(pl, [label])[0]
 
 
-def id_to_label(_id : str, pl : PLS) -> str:
-    # TODO
+def id_to_label(_id : str, pl : PLS) -> int | None:
     '''
-    Convert a given deckdrafterprod _id to the label based on the m0_labels.toml
+    Convert a given deckdrafterprod _id to its master label, in the indexed catalog
 
     Args:
         _id (str): deckdrafterprod _id 
         pl (PRODUCTLINES): The product_line we are working with.
     Returns:
-        str: what the tensorflow model will spit out
+        int | None: the master label of the card (None if the catalog does not know the _id)
     '''
-    
-    # look up the variable
-    return ''
+    return open_catalog(pl).labels(pl, [str(_id)])[0]
 
 def label_to_json(label : int, pl : PLS) -> dict:
     '''
-    Look up which json str has the particular label based on the master_labels.toml
+    Look up which json str has the particular master label, in the indexed catalog (see utils/catalog.py)
 
     Args:
-        label (str): what the tensorflow model will spit out
+        label (int): the master label of the card
         pl (PRODUCTLINES): The product_line we are working with.
     Returns:
         dict: json entry that is associated with that label (dict by default)
     '''
-    _ids = load_ids(pl, 'm0', 'rb')
-    predicted_id = _ids[label]
+    predicted_id = label_to_id(label, pl)
     logging.info(' Label: %d -> _id: %s', label, predicted_id)
 
-    deckdrafterprod: dict = load_deckdrafterprod(pl, 'r')
-    card_obj = {}
-    for obj in deckdrafterprod:
-        if str(obj['_id']) == str(predicted_id):
-            logging.info(' Json object with _id: %s found in deckdrafterprod', predicted_id)
-            card_obj = obj
-    if card_obj == {}:
+    card_obj, = open_catalog(pl).cards(pl, [predicted_id])
+    if card_obj is None:
         logging.warning(' [label_to_json] object with %s not found. Returning empty json str', predicted_id)
+        card_obj = {}
 
     # returns the raw json str without any filtering of the fields 
     # each field name can be different based on the game, so we must process it
@@ -0,0 +1,78 @@
+import asyncio
+import contextlib
+import contextvars
+import time
+
+from utils.metrics import is_timeout
+
+# the time.monotonic() at which the budget of the request being served runs out, see request_deadline
+REQUEST_DEADLINE: contextvars.ContextVar[float | None] = contextvars.ContextVar('request_deadline', default=None)
+
+
+class DeadlineExceeded(Exception):
+    '''
+    Raised when the request's budget runs out before a model answered.
+    The model is not to blame, so neither the circuit breakers nor the replica ejection count it.
+    '''
+
+
+@contextlib.contextmanager
+def request_deadline(seconds: float | None):
+    '''
+    Gives the request being served (and the tasks it starts, ex) the submodel calls) seconds to answer.
+    Every model call waits at most for what is left of it and sends it along as its backend timeout,
+    so the timeouts shrink as the request goes down the model hierarchy. None keeps the backends' own timeouts.
+    '''
+    token = REQUEST_DEADLINE.set(None if seconds is None else time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        REQUEST_DEADLINE.reset(token)
+
+
+def remaining() -> float | None:
+    '''
+    Seconds left of the request's budget (can be negative), None when it has no deadline.
+    '''
+    deadline = REQUEST_DEADLINE.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+@contextlib.asynccontextmanager
+async def within_deadline(what: str):
+    '''
+    Bounds the block by what is left of the request's budget (no bound without one).
+
+    Args:
+        what (str): what the block waits on, for the error
+    Raises:
+        DeadlineExceeded: if the budget ran out before (or while) the block ran
+    '''
+    seconds = remaining()
+    if seconds is None:
+        yield
+        return
+    if seconds <= 0:
+        raise DeadlineExceeded(f'no budget left for {what}')
+    timeout = asyncio.timeout(seconds)
+    try:
+        async with timeout:
+            yield
+    except TimeoutError as e:
+        if timeout.expired():
+            raise DeadlineExceeded(f'the budget ran out waiting on {what}') from e
+        raise
+
+
+@contextlib.contextmanager
+def budget_timeouts(timeout: float | None, default: float):
+    '''
+    Around a backend call whose timeout was shrunk to the budget of the requests it serves (see MicroBatcher.send):
+    if it times out before its usual timeout (default), the budget ran out and DeadlineExceeded is raised instead.
+    '''
+    try:
+        yield
+    except Exception as e:
+        if timeout is not None and timeout < default and is_timeout(e):
+            raise DeadlineExceeded(f'the budget ran out after {timeout:.3f}s') from e
+        raise
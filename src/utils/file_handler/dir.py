@@ -1,5 +1,6 @@
 import os
 import logging 
+import tempfile
 import time
 
 from utils.product_lines import PRODUCTLINES as PLS
@@ -8,6 +9,7 @@ DATA_DIR_ENV= 'DATA_DIR'
 SAVED_MODEL_DIR_ENV = 'SAVED_MODEL_DIR'
 KERAS_MODEL_DIR_ENV = 'KERAS_MODEL_DIR'
 CONFIG_DIR_ENV = 'CONFIG_DIR'
+SHARED_METADATA_DIR_ENV = 'SHARED_METADATA_DIR'
 
 # TRAIN_DATASET_PATH_ENV = 'TRAIN_DATASET_PATH_NAME'
 # VAL_DATASET_PATH_ENV = 'VAL_DATASET_PATH_NAME'
@@ -36,6 +38,16 @@ def get_keras_model_dir() -> str:
 def get_config_dir() -> str:
     return get_env(CONFIG_DIR_ENV)
 
+def get_shared_metadata_dir() -> str | None:
+    '''
+    Where the api workers share their id tables (memory mapped), in memory under /dev/shm by default.
+    Set SHARED_METADATA_DIR to an empty string for every worker to keep its own copy instead.
+    '''
+    shared_dir = os.getenv(SHARED_METADATA_DIR_ENV)
+    if shared_dir is None:
+        shared_dir = os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir(), 'harmony')
+    return shared_dir or None
+
 # -------------------------
 
 def get_record_path(pl: PLS) -> str:
@@ -0,0 +1,133 @@
+import asyncio
+import collections
+import logging
+import time
+
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.metrics import HEDGES, HEDGE_WINS
+
+# the latencies the percentile is computed over, it is recomputed every RECOMPUTE_EVERY calls
+WINDOW = 512
+MIN_SAMPLES = 50
+RECOMPUTE_EVERY = 32
+# hedges that can be saved up while the model is fast, so a burst of slow calls can not hedge all at once
+MAX_SAVED_HEDGES = 10.0
+
+
+class HedgeState:
+    '''
+    The recent latencies of one (product line, model), the delay after which its calls are hedged and its counters.
+    '''
+    def __init__(self):
+        self.latencies = collections.deque(maxlen=WINDOW)
+        self.delay: float | None = None
+        self.since_recompute = 0
+        self.tokens = 0.0
+
+        self.calls = 0
+        self.hedges = 0
+        self.wins = 0
+        self.over_budget = 0
+
+    def observe(self, seconds: float, percentile: float, min_delay: float):
+        self.latencies.append(seconds)
+        self.since_recompute += 1
+        if len(self.latencies) >= MIN_SAMPLES and (self.delay is None or self.since_recompute >= RECOMPUTE_EVERY):
+            self.delay = max(float(np.percentile(self.latencies, percentile)), min_delay)
+            self.since_recompute = 0
+
+    def stats(self) -> dict:
+        return {
+                'calls': self.calls,
+                'hedges': self.hedges,
+                'hedge_rate': self.hedges / self.calls if self.calls else 0.0,
+                'wins': self.wins,
+                'win_rate': self.wins / self.hedges if self.hedges else 0.0,
+                'over_budget': self.over_budget,
+                'delay_ms': None if self.delay is None else self.delay * 1000,
+                }
+
+
+class Hedges(metaclass=Singleton):
+    '''
+    Hedged tfs calls: when a call has not answered after the hedge_percentile of the model's recent latencies,
+    the same call is sent again and whichever answers first wins (the other one is cancelled).
+    Every call earns budget of a hedge and a hedge spends a whole one, so hedging adds at most budget extra calls per call.
+    Used by the TFSClient of the product lines that set hedge = 1 in their [serving] table.
+    '''
+    def __init__(self):
+        self.states: dict[tuple[str, str], HedgeState] = {}
+
+    async def call(self, pl: PLS, model_name: str, send, percentile: float, budget: float, min_delay: float):
+        '''
+        Awaits send() (a coroutine function making the tfs call), hedged.
+        The percentile is computed from the latency of the call that answered, timed from its own start
+        (when the hedge won, its latency and not the hedge delay plus it).
+
+        Args:
+            percentile (float): the percentile of the model's recent latencies after which a call is hedged
+            budget (float): the most extra calls hedging can add, as a fraction of the calls
+            min_delay (float): seconds, calls are never hedged sooner than this
+        '''
+        key = (pl.value, model_name)
+        state = self.states.get(key)
+        if state is None:
+            state = HedgeState()
+            self.states[key] = state
+        state.calls += 1
+        state.tokens = min(state.tokens + budget, MAX_SAVED_HEDGES)
+
+        start = time.perf_counter()
+        primary = asyncio.ensure_future(send())
+        hedge = None
+        try:
+            if state.delay is not None:
+                done, _ = await asyncio.wait({primary}, timeout=state.delay)
+                if not done:
+                    if state.tokens >= 1:
+                        state.tokens -= 1
+                        state.hedges += 1
+                        HEDGES.labels(pl.value, model_name).inc()
+                        hedge_start = time.perf_counter()
+                        hedge = asyncio.ensure_future(send())
+                    else:
+                        state.over_budget += 1
+
+            if hedge is None:
+                result = await primary
+                state.observe(time.perf_counter() - start, percentile, min_delay)
+                return result
+
+            # the first call that succeeds wins, the call only fails if both did
+            pending = {primary, hedge}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                winner = next((task for task in done if task.exception() is None), None)
+                if winner is not None:
+                    break
+            else:
+                return primary.result()
+
+            if winner is hedge:
+                state.wins += 1
+                HEDGE_WINS.labels(pl.value, model_name).inc()
+                logging.debug(' [Hedges] the hedge of %s/%s answered first', pl.value, model_name)
+            state.observe(time.perf_counter() - (hedge_start if winner is hedge else start), percentile, min_delay)
+            return winner.result()
+        finally:
+            for task in (primary, hedge):
+                if task is None:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled():
+                    task.exception()  # the loser's error is not raised, mark it as retrieved
+
+    def stats(self) -> dict:
+        stats = {}
+        for (pl, model_name), state in self.states.items():
+            stats.setdefault(pl, {})[model_name] = state.stats()
+        return stats
@@ -0,0 +1,41 @@
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+
+
+class InferenceBackend:
+    '''
+    What identify needs from whatever runs the models (see utils/backends.py for how a product line picks one):
+        - TFSClient: the tensorflow serving containers (rest or grpc)
+        - LocalBackend: the exported SavedModels (or tflite files) loaded into the api process
+    Implementations are singletons, shared by every product line that uses them.
+    '''
+    def configure(self, pl: PLS, serving_config: dict):
+        '''
+        Args:
+            pl (PRODUCTLINES): The product_line we are working with.
+            serving_config (dict): the [serving] table of the product line's config.toml (can be empty)
+        '''
+
+    async def predict(self, model_name: str, pl: PLS, instances, timeout: float | None = None) -> np.ndarray:
+        '''
+        Args:
+            model_name (string): unique identifier for which (sub)model we are using for evaluation
+            pl (PRODUCTLINES): The product_line we are working with.
+            instances (list | np.ndarray): the batch of preprocessed images, or of encoded image files (bytes)
+            timeout (float | None): seconds left of the budget of the requests the call serves, when they have a deadline
+                (the call should raise DeadlineExceeded rather than take longer), None for the backend's own timeout
+        Returns:
+            np.ndarray: 2-D float32, one softmax row per instance
+        '''
+        raise NotImplementedError
+
+    async def metadata(self, model_name: str, pl: PLS) -> dict:
+        '''
+        Returns:
+            dict: the model's metadata, in the shape of the tfs metadata api (model_spec.version and the signature_def)
+        '''
+        raise NotImplementedError
+
+    async def close(self):
+        pass
@@ -0,0 +1,253 @@
+import asyncio
+import logging
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.file_handler.dir import get_saved_model_dir
+from utils.inference import InferenceBackend
+from utils.tfs_client import (DEFAULT_SIGNATURE_NAME, DEFAULT_BYTES_SIGNATURE_NAME,
+                              get_serving_option, is_encoded)
+
+# defaults, can be overridden with the env or per product line in the [serving] table of its config.toml
+# local_format: 'auto' picks a model.tflite when the version directory has one, the SavedModel otherwise
+DEFAULT_LOCAL_FORMAT = 'auto'
+DEFAULT_LOCAL_MAX_BATCH = 64
+DEFAULT_LOCAL_WORKERS = 2
+TFLITE_FILE = 'model.tflite'
+
+
+def latest_version_dir(model_dir: str) -> tuple[str, str]:
+    '''
+    The newest numbered version directory of a model, like tfs picks it (saved_models/{pl}/{model}/{version}/).
+
+    Returns:
+        tuple[str, str]: the version and its directory
+    '''
+    versions = [name for name in os.listdir(model_dir) if name.isdigit() and os.path.isdir(os.path.join(model_dir, name))]
+    if not versions:
+        raise FileNotFoundError(f'no version directory in {model_dir}')
+    version = max(versions, key=int)
+    return version, os.path.join(model_dir, version)
+
+
+def tensor_metadata(version: str, input_name: str, input_shape, num_classes: int | None) -> dict:
+    '''
+    The part of a tfs metadata response that CachedConfigs reads, for a model loaded in process.
+    '''
+    dims = [{'size': str(-1 if d is None else d)} for d in input_shape]
+    signature = {'inputs': {input_name: {'tensor_shape': {'dim': dims}}}}
+    if num_classes is not None:
+        signature['outputs'] = {'output_0': {'tensor_shape': {'dim': [{'size': '-1'}, {'size': str(num_classes)}]}}}
+    return {
+            'model_spec': {'version': version},
+            'metadata': {'signature_def': {'signature_def': {'serve': signature}}},
+            }
+
+
+class SavedModel:
+    '''
+    A SavedModel exported by keras_to_saved_model.py, called through its serve (pixels) and serve_bytes (encoded files) signatures.
+    Concrete functions are thread safe, so the executor can run several batches of it at once.
+    '''
+    def __init__(self, path: str, version: str, signature_name: str, bytes_signature_name: str):
+        import tensorflow as tf
+
+        self.tf = tf
+        self.version = version
+        self.loaded = tf.saved_model.load(path)
+        self.serve = self.loaded.signatures[signature_name]
+        self.serve_bytes = self.loaded.signatures.get(bytes_signature_name)
+
+    @staticmethod
+    def input_spec(function):
+        # signatures only take keyword arguments, one per input
+        (name, spec), = function.structured_input_signature[1].items()
+        return name, spec
+
+    def predict(self, instances) -> np.ndarray:
+        if is_encoded(instances):
+            if self.serve_bytes is None:
+                raise ValueError('the model has no serve_bytes signature to decode encoded images with')
+            function, batch = self.serve_bytes, self.tf.constant(list(instances), dtype=self.tf.string)
+        else:
+            function = self.serve
+            batch = self.tf.constant(np.asarray(instances, dtype=self.input_spec(function)[1].dtype.as_numpy_dtype))
+
+        outputs = function(**{self.input_spec(function)[0]: batch})
+        (output,) = outputs.values()
+        return output.numpy().astype(np.float32, copy=False)
+
+    def metadata(self) -> dict:
+        name, spec = self.input_spec(self.serve)
+        output_spec, = self.serve.structured_outputs.values()
+        return tensor_metadata(self.version, name, spec.shape.as_list(), output_spec.shape[-1])
+
+
+class TFLiteModel:
+    '''
+    A tflite file (version directory/model.tflite), for cpu only edge boxes. tflite_runtime is used when it is installed,
+    so the edge image does not need all of tensorflow. Quantized (uint8/int8) models are (de)quantized here.
+    An interpreter is not thread safe, so its calls are serialized with a lock.
+    '''
+    def __init__(self, path: str, version: str):
+        try:
+            from tflite_runtime.interpreter import Interpreter
+        except ImportError:
+            from tensorflow.lite import Interpreter
+
+        self.version = version
+        self.interpreter = Interpreter(model_path=path)
+        self.interpreter.allocate_tensors()
+        self.input = self.interpreter.get_input_details()[0]
+        self.output = self.interpreter.get_output_details()[0]
+        self.batch_size = None
+        self.lock = threading.Lock()
+
+    def predict(self, instances) -> np.ndarray:
+        if is_encoded(instances):
+            raise ValueError('tflite models only take preprocessed images, not encoded files')
+
+        batch = np.asarray(instances, dtype=np.float32)
+        scale, zero_point = self.input['quantization']
+        if scale:
+            batch = np.round(batch / scale + zero_point)
+
+        with self.lock:
+            if self.batch_size != len(batch):
+                self.interpreter.resize_tensor_input(self.input['index'], [len(batch), *self.input['shape'][1:]])
+                self.interpreter.allocate_tensors()
+                self.batch_size = len(batch)
+            self.interpreter.set_tensor(self.input['index'], batch.astype(self.input['dtype']))
+            self.interpreter.invoke()
+            output = self.interpreter.get_tensor(self.output['index'])
+
+        scale, zero_point = self.output['quantization']
+        if scale:
+            output = (output.astype(np.float32) - zero_point) * scale
+        return output.astype(np.float32, copy=False)
+
+    def metadata(self) -> dict:
+        input_shape = [None, *self.input['shape'][1:].tolist()]
+        return tensor_metadata(self.version, self.input['name'], input_shape, int(self.output['shape'][-1]))
+
+
+class LocalBackend(InferenceBackend, metaclass=Singleton):
+    '''
+    Runs the exported models inside of the api process instead of calling the tfs containers, for cpu only deployments
+    where the http hop costs more than the model. Picked with backend='local' in the product line's [serving] table.
+    Models are read from the same layout tfs serves (saved_models/{pl}/{model}/{version}/) and loaded on first use
+    (once, however many calls ask for a model at the same time). The newest version directory is looked up when a model
+    is first used and again when CachedConfigs refreshes the metadata, not on every call.
+    The calls run in a small thread pool (tensorflow already spreads one call over the cores),
+    in chunks of at most local_max_batch images.
+    '''
+    def __init__(self):
+        self.options: dict[str, dict] = {}
+        self.models: dict[tuple[str, str], SavedModel | TFLiteModel] = {}
+        # the (version, directory) every model is served from, see version_dir
+        self.version_dirs: dict[tuple[str, str], tuple[str, str]] = {}
+        self.load_locks: dict[tuple[str, str], threading.Lock] = {}
+        self.lock = threading.Lock()
+        self.executor: ThreadPoolExecutor | None = None
+
+    def configure(self, pl: PLS, serving_config: dict):
+        old = self.options.get(pl.value)
+        self.options[pl.value] = {
+            'model_dir': get_serving_option(serving_config, 'local_model_dir', 'LOCAL_MODEL_DIR', ''),
+            'format': get_serving_option(serving_config, 'local_format', 'LOCAL_FORMAT', DEFAULT_LOCAL_FORMAT),
+            'max_batch': get_serving_option(serving_config, 'local_max_batch', 'LOCAL_MAX_BATCH', DEFAULT_LOCAL_MAX_BATCH),
+            'workers': get_serving_option(serving_config, 'local_workers', 'LOCAL_WORKERS', DEFAULT_LOCAL_WORKERS),
+            'signature_name': get_serving_option(serving_config, 'signature_name', 'TFS_SIGNATURE_NAME', DEFAULT_SIGNATURE_NAME),
+            'bytes_signature_name': get_serving_option(serving_config, 'bytes_signature_name', 'TFS_BYTES_SIGNATURE_NAME', DEFAULT_BYTES_SIGNATURE_NAME),
+        }
+        if old is not None and old != self.options[pl.value]:
+            # the models may come from another directory (or in another format) now
+            for key in [key for key in self.version_dirs if key[0] == pl.value]:
+                del self.version_dirs[key]
+
+    def get_options(self, pl: PLS) -> dict:
+        if pl.value not in self.options:
+            self.configure(pl, {})
+        return self.options[pl.value]
+
+    def get_executor(self, pl: PLS) -> ThreadPoolExecutor:
+        if self.executor is None:
+            workers = self.get_options(pl)['workers']
+            self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='inference')
+            logging.info(' [LocalBackend] running the models in %d threads', workers)
+        return self.executor
+
+    def version_dir(self, model_name: str, pl: PLS, rescan: bool = False) -> tuple[str, str]:
+        '''
+        The version a model is served from and its directory, resolved (listing the model's directory) on first use
+        and when rescan is set, the cached one otherwise.
+        '''
+        key = (pl.value, model_name)
+        resolved = self.version_dirs.get(key)
+        if resolved is None or rescan:
+            options = self.get_options(pl)
+            model_dir = os.path.join(options['model_dir'] or os.path.join(get_saved_model_dir(), pl.value), model_name)
+            resolved = latest_version_dir(model_dir)
+            self.version_dirs[key] = resolved
+        return resolved
+
+    def load_lock(self, key: tuple[str, str]) -> threading.Lock:
+        with self.lock:
+            return self.load_locks.setdefault(key, threading.Lock())
+
+    def load(self, model_name: str, pl: PLS, rescan: bool = False) -> SavedModel | TFLiteModel:
+        '''
+        Returns the loaded model, (re)loading it when it is not loaded yet or a newer version was found
+        (rescan looks for one, see version_dir). Concurrent calls for a model that is not loaded wait for a single load.
+        Blocking, runs in the executor.
+        '''
+        version, version_dir = self.version_dir(model_name, pl, rescan)
+        key = (pl.value, model_name)
+        model = self.models.get(key)
+        if model is not None and model.version == version:
+            return model
+
+        with self.load_lock(key):
+            # loaded by the call this one waited on
+            model = self.models.get(key)
+            if model is not None and model.version == version:
+                return model
+
+            options = self.get_options(pl)
+            tflite_path = os.path.join(version_dir, TFLITE_FILE)
+            if options['format'] == 'tflite' or (options['format'] == 'auto' and os.path.exists(tflite_path)):
+                model = TFLiteModel(tflite_path, version)
+            else:
+                model = SavedModel(version_dir, version, options['signature_name'], options['bytes_signature_name'])
+            self.models[key] = model
+        logging.info(' [LocalBackend] loaded %s/%s version %s (%s)', pl.value, model_name, version, type(model).__name__)
+        return model
+
+    def run(self, model_name: str, pl: PLS, instances) -> np.ndarray:
+        model = self.load(model_name, pl)
+        max_batch = self.get_options(pl)['max_batch']
+        if len(instances) <= max_batch:
+            return model.predict(instances)
+        return np.concatenate([model.predict(instances[i:i + max_batch]) for i in range(0, len(instances), max_batch)])
+
+    async def predict(self, model_name: str, pl: PLS, instances, timeout: float | None = None) -> np.ndarray:
+        # a graph that is running can not be interrupted, identify stops waiting on it once the budget ran out
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.get_executor(pl), self.run, model_name, pl, instances)
+
+    async def metadata(self, model_name: str, pl: PLS) -> dict:
+        # called by every config refresh (CachedConfigs.load), which is when a newly exported version gets picked up
+        loop = asyncio.get_running_loop()
+        model = await loop.run_in_executor(self.get_executor(pl), self.load, model_name, pl, True)
+        return model.metadata()
+
+    async def close(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
@@ -0,0 +1,46 @@
+import asyncio
+
+from prometheus_client import Counter, Gauge, Histogram
+
+# seconds, from reading a small upload to a tfs call that runs into its timeout
+STAGE_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+# stages: upload (receiving and parsing the multipart body, before the handler runs), read (copying the parsed files out
+# of their spooled temp files), preprocess (decode + resize of all of the uploads), decode, resize, hash, identify, model
+# (the wait on a model, its batch included), serialize, tfs, deserialize, postprocess, details (card catalog lookups),
+# response; see utils/timing.py
+STAGE_SECONDS = Histogram(
+        'harmony_stage_seconds', 'Time spent in each stage of the inference pipeline',
+        ['stage', 'product_line', 'model'], buckets=STAGE_BUCKETS,
+        )
+IMAGES = Counter('harmony_images', 'Images received for identification', ['product_line'])
+FAILURES = Counter(
+        'harmony_failures', 'Images that could not be identified (reason: invalid_image, timeout, deadline, circuit_open or error)',
+        ['product_line', 'model', 'reason'],
+        )
+SUBMODEL_CALLS = Counter('harmony_submodel_calls', 'Calls a routing model fanned out to its submodels', ['product_line', 'model'])
+SUBMODEL_IMAGES = Counter('harmony_submodel_images', 'Images a routing model sent to its submodels', ['product_line', 'model'])
+HEDGES = Counter('harmony_tfs_hedges', 'Tfs calls that were sent a second time because the first was slow', ['product_line', 'model'])
+HEDGE_WINS = Counter('harmony_tfs_hedge_wins', 'Hedged tfs calls where the second call answered first', ['product_line', 'model'])
+REPLICA_EJECTIONS = Counter('harmony_tfs_replica_ejections', 'Times a tfs replica was ejected for failing', ['product_line', 'replica'])
+REPLICA_EJECTED = Gauge(
+        'harmony_tfs_replica_ejected', 'Whether a tfs replica is ejected (1) or gets calls (0)',
+        ['product_line', 'replica'], multiprocess_mode='livemax',
+        )
+TFS_TIMEOUTS = Counter('harmony_tfs_timeouts', 'Tfs calls that ran into their timeout', ['product_line', 'model'])
+IN_FLIGHT_REQUESTS = Gauge('harmony_in_flight_requests', 'Requests being served', ['endpoint'], multiprocess_mode='livesum')
+CIRCUIT_STATE = Gauge(
+        'harmony_circuit_state', 'Circuit breaker of each model: 0 closed, 1 half open, 2 open',
+        ['product_line', 'model'], multiprocess_mode='livemax',
+        )
+TFS_IN_FLIGHT = Gauge('harmony_tfs_in_flight', 'Tfs calls waiting on an answer', ['product_line', 'model'], multiprocess_mode='livesum')
+
+
+def is_timeout(e: BaseException) -> bool:
+    '''
+    True for the timeouts of both transports (aiohttp raises asyncio.TimeoutError, grpc a DEADLINE_EXCEEDED status).
+    '''
+    if isinstance(e, asyncio.TimeoutError):
+        return True
+    code = getattr(e, 'code', None)
+    return callable(code) and getattr(code(), 'name', None) == 'DEADLINE_EXCEEDED'
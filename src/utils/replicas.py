@@ -0,0 +1,212 @@
+import contextlib
+import hashlib
+import logging
+import random
+import time
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.metrics import REPLICA_EJECTIONS, REPLICA_EJECTED
+from utils.deadline import DeadlineExceeded
+
+BALANCERS = ('p2c', 'least_outstanding')
+# smoothing of the latency average that breaks the ties between replicas with as many calls in flight
+LATENCY_EWMA = 0.2
+# a replica that keeps failing is ejected for eject_seconds times the ejections in a row, up to this many times
+MAX_EJECTION_MULTIPLIER = 6
+
+
+def split_targets(targets: str) -> list[str]:
+    '''
+    'http://tfs-a:8501, http://tfs-b:8501' -> ['http://tfs-a:8501', 'http://tfs-b:8501']
+    '''
+    return [target.strip() for target in targets.split(',') if target.strip()]
+
+
+def affinity_score(model_name: str, target: str) -> int:
+    return int.from_bytes(hashlib.blake2b(f'{model_name}|{target}'.encode(), digest_size=8).digest(), 'big')
+
+
+class Replica:
+    '''
+    One tfs container of a product line: the calls it has in flight, its recent latency and its failures in a row.
+    '''
+    def __init__(self, target: str):
+        self.target = target
+        self.outstanding = 0
+        self.latency: float | None = None
+        self.failures = 0
+        self.ejected_until = 0.0
+        self.ejections_in_a_row = 0
+
+        self.calls = 0
+        self.errors = 0
+        self.ejections = 0
+        self.last_error: str | None = None
+
+    def is_ejected(self, now: float) -> bool:
+        return now < self.ejected_until
+
+    def load(self) -> tuple[int, float]:
+        return self.outstanding, self.latency or 0.0
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        return {
+                'outstanding': self.outstanding,
+                'latency_ms': None if self.latency is None else self.latency * 1000,
+                'calls': self.calls,
+                'errors': self.errors,
+                'ejections': self.ejections,
+                'ejected_seconds_left': max(self.ejected_until - now, 0.0),
+                'last_error': self.last_error,
+                }
+
+
+class ReplicaSet:
+    '''
+    The replicas a product line sends the calls of one transport to.
+
+    Args:
+        balancer (str): 'p2c' picks the least loaded of two random replicas, 'least_outstanding' the least loaded of all
+        affinity (int): the number of replicas the calls of a model are spread over (picked by rendezvous hashing,
+            so each replica only keeps the models it serves warm), 0 spreads every model over all of them
+        eject_failures (int): failures in a row that eject a replica
+        eject_seconds (float): how long the first ejection lasts
+    '''
+    def __init__(self, replicas: list[Replica], balancer: str, affinity: int, eject_failures: int, eject_seconds: float):
+        self.replicas = replicas
+        self.balancer = balancer
+        self.affinity = affinity
+        self.eject_failures = eject_failures
+        self.eject_seconds = eject_seconds
+        self.preferred_replicas: dict[str, list[Replica]] = {}
+
+    def preferred(self, model_name: str) -> list[Replica]:
+        preferred = self.preferred_replicas.get(model_name)
+        if preferred is None:
+            preferred = self.replicas
+            if 0 < self.affinity < len(self.replicas):
+                ranked = sorted(self.replicas, key=lambda replica: affinity_score(model_name, replica.target), reverse=True)
+                preferred = ranked[:self.affinity]
+            self.preferred_replicas[model_name] = preferred
+        return preferred
+
+    def choose(self, model_name: str, exclude: list[str] | None = None) -> Replica:
+        '''
+        The replica the next call of a model goes to: one of its preferred replicas that is not ejected,
+        any replica that is not ejected when all of those are, or the one that comes back first when every replica is ejected.
+        The replicas in exclude (the targets a retried call already failed on) are only picked when there is no other one.
+        '''
+        if len(self.replicas) == 1:
+            return self.replicas[0]
+        now = time.monotonic()
+        replicas = [replica for replica in self.replicas if replica.target not in exclude] if exclude else self.replicas
+        replicas = replicas or self.replicas
+        preferred = [replica for replica in self.preferred(model_name) if replica in replicas]
+        candidates = [replica for replica in preferred if not replica.is_ejected(now)]
+        if not candidates:
+            candidates = [replica for replica in replicas if not replica.is_ejected(now)]
+        if not candidates:
+            return min(replicas, key=lambda replica: replica.ejected_until)
+        if len(candidates) == 1:
+            return candidates[0]
+
+        if self.balancer == 'p2c':
+            a, b = random.sample(candidates, 2)
+            return a if a.load() <= b.load() else b
+        # shuffled, so idle replicas share the calls instead of the first one getting all of them
+        return min(random.sample(candidates, len(candidates)), key=Replica.load)
+
+    def record(self, pl: PLS, replica: Replica, seconds: float, error: BaseException | None = None):
+        '''
+        Records the outcome of a call: a failure of the replica (see is_server_failure) counts towards ejecting it,
+        anything else resets its failures. A replica that comes back from an ejection is ejected again by its first failure.
+        '''
+        # the circuit breakers import the tfs client, which imports this module
+        from utils.circuit import is_server_failure
+
+        replica.calls += 1
+        if error is None or not is_server_failure(error):
+            replica.failures = 0
+            replica.ejections_in_a_row = 0
+            if error is None:
+                replica.latency = seconds if replica.latency is None else replica.latency + LATENCY_EWMA * (seconds - replica.latency)
+            return
+
+        replica.errors += 1
+        replica.failures += 1
+        replica.last_error = repr(error)
+        now = time.monotonic()
+        if replica.failures < self.eject_failures or replica.is_ejected(now):
+            return
+        replica.ejections += 1
+        replica.ejections_in_a_row += 1
+        duration = self.eject_seconds * min(replica.ejections_in_a_row, MAX_EJECTION_MULTIPLIER)
+        replica.ejected_until = now + duration
+        REPLICA_EJECTIONS.labels(pl.value, replica.target).inc()
+        REPLICA_EJECTED.labels(pl.value, replica.target).set(1)
+        logging.warning(' [Replicas] ejected %s of %s for %.1fs (%s)', replica.target, pl.value, duration, replica.last_error)
+
+
+class Replicas(metaclass=Singleton):
+    '''
+    Client side load balancing over the tfs replicas of every product line, set with replicas (grpc_replicas for grpc),
+    balancer, affinity, eject_failures and eject_seconds in the [serving] table (see TFSClient.configure).
+    A product line without replicas has the single replica of its url.
+    Ejection is passive: only the outcome of real calls ejects a replica, and it gets calls again once its ejection ran out.
+    '''
+    def __init__(self):
+        self.sets: dict[tuple[str, str], ReplicaSet] = {}
+
+    def configure(self, pl: PLS, transport: str, targets: list[str], balancer: str, affinity: int, eject_failures: int, eject_seconds: float):
+        if balancer not in BALANCERS:
+            raise ValueError(f'unknown balancer {balancer!r} for {pl.value}, expected one of {list(BALANCERS)}')
+        key = (pl.value, transport)
+        # the replicas that stay keep their state (in flight calls, ejection) across config refreshes
+        old = {replica.target: replica for replica in self.sets[key].replicas} if key in self.sets else {}
+        replicas = [old.get(target) or Replica(target) for target in dict.fromkeys(targets)]
+        if list(old) != [replica.target for replica in replicas]:
+            logging.info(' [Replicas] %s (%s): %s', pl.value, transport, ', '.join(replica.target for replica in replicas))
+        self.sets[key] = ReplicaSet(replicas, balancer, affinity, eject_failures, eject_seconds)
+
+    def targets(self, pl: PLS, transport: str) -> list[str]:
+        return [replica.target for replica in self.sets[(pl.value, transport)].replicas]
+
+    @contextlib.contextmanager
+    def use(self, pl: PLS, transport: str, model_name: str, exclude: list[str] | None = None):
+        '''
+        Picks the replica of a call and counts the call as in flight on it until the block exits, recording its outcome.
+
+        Args:
+            exclude (list[str] | None): targets to avoid, see ReplicaSet.choose
+        Yields:
+            str: the target of the replica (its base url for rest, host:port for grpc)
+        '''
+        replica_set = self.sets[(pl.value, transport)]
+        replica = replica_set.choose(model_name, exclude)
+        if replica.ejected_until and not replica.is_ejected(time.monotonic()):
+            # back from its ejection, on probation until its next call succeeds
+            replica.ejected_until = 0.0
+            REPLICA_EJECTED.labels(pl.value, replica.target).set(0)
+        replica.outstanding += 1
+        start = time.perf_counter()
+        try:
+            yield replica.target
+        except DeadlineExceeded:
+            # the budget of the requests ran out, the replica is not to blame
+            raise
+        except Exception as e:
+            replica_set.record(pl, replica, time.perf_counter() - start, e)
+            raise
+        else:
+            replica_set.record(pl, replica, time.perf_counter() - start)
+        finally:
+            # a cancelled call (ex) the loser of a hedge) only stops counting as in flight
+            replica.outstanding -= 1
+
+    def stats(self) -> dict:
+        stats = {}
+        for (pl, transport), replica_set in self.sets.items():
+            stats.setdefault(pl, {})[transport] = {replica.target: replica.stats() for replica in replica_set.replicas}
+        return stats
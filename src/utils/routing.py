@@ -0,0 +1,125 @@
+import contextlib
+import glob
+import logging
+import os
+import time
+
+import numpy as np
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.file_handler.dir import get_data_dir, get_shared_metadata_dir
+from utils.file_handler.pickle import load_ids
+
+# how often (seconds) a table checks if its pickle changed on disk
+CHECK_INTERVAL = 1.0
+IDS_SUFFIX = '_ids.pkl'
+
+
+def get_ids_path(pl: PLS, model_name: str) -> str:
+    return os.path.join(get_data_dir(), pl.value, f'{model_name}{IDS_SUFFIX}')
+
+
+def load_shared_table(pl: PLS, model_name: str, shared_dir: str) -> np.ndarray:
+    '''
+    The ids of a model as a read only memory map of a .npy file in the shared dir, so every api worker
+    reads the same pages instead of unpickling its own copy. The file is named after the pickle's mtime and size:
+    the first worker to see a new pickle writes it (atomically, the others may race it with the same content)
+    and removes the older ones, which the workers that still map them keep until they reload.
+    '''
+    stat = os.stat(get_ids_path(pl, model_name))
+    pl_dir = os.path.join(shared_dir, pl.value)
+    shared_path = os.path.join(pl_dir, f'{model_name}{IDS_SUFFIX}.{stat.st_mtime_ns}-{stat.st_size}.npy')
+
+    if not os.path.exists(shared_path):
+        os.makedirs(pl_dir, exist_ok=True)
+        tmp_path = f'{shared_path}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.save(f, np.array(load_ids(pl, model_name, 'rb'), dtype=str))
+        os.replace(tmp_path, shared_path)
+        for old_path in glob.glob(os.path.join(pl_dir, f'{model_name}{IDS_SUFFIX}.*.npy')):
+            if old_path != shared_path:
+                with contextlib.suppress(OSError):
+                    os.remove(old_path)
+        logging.info(' [load_shared_table] wrote %s', shared_path)
+
+    return np.load(shared_path, mmap_mode='r').view(np.ndarray)
+
+
+class RoutingTables(metaclass=Singleton):
+    '''
+    The id lists (m*_ids.pkl) of every model of a product line, unpickled once into numpy string arrays.
+    For a routing model (ex. pokemon m0) the ids are the names of the submodels, for a final model they are the _ids.
+    A table is reloaded when its pickle changes on disk (checked at most every CHECK_INTERVAL seconds).
+    With several api workers, the tables are memory mapped from the shared metadata dir (see load_shared_table).
+    '''
+    def __init__(self):
+        self.tables: dict[tuple[str, str], np.ndarray] = {}
+        self.mtimes: dict[tuple[str, str], float] = {}
+        self.checked: dict[tuple[str, str], float] = {}
+        self.versions: dict[str, int] = {}
+
+    def load(self, pl: PLS):
+        '''
+        Loads every *_ids.pkl of the product line that is not loaded yet or changed on disk since it was.
+        Called on every config refresh: the tables that did not change are kept, and so is the version
+        (the prediction cache is only dropped when a table really changed).
+        '''
+        for path in sorted(glob.glob(os.path.join(get_data_dir(), pl.value, f'*{IDS_SUFFIX}'))):
+            model_name = os.path.basename(path)[:-len(IDS_SUFFIX)]
+            try:
+                if (pl.value, model_name) not in self.tables or self.is_changed(pl, model_name):
+                    self.reload(pl, model_name)
+            except Exception as e:
+                logging.error(' [RoutingTables] could not load %s: %s', path, e)
+
+    def is_changed(self, pl: PLS, model_name: str) -> bool:
+        '''
+        Whether the pickle of a loaded table changed on disk since it was loaded.
+        '''
+        key = (pl.value, model_name)
+        self.checked[key] = time.monotonic()
+        return os.path.getmtime(get_ids_path(pl, model_name)) != self.mtimes[key]
+
+    def reload(self, pl: PLS, model_name: str) -> np.ndarray:
+        key = (pl.value, model_name)
+        mtime = os.path.getmtime(get_ids_path(pl, model_name))
+        shared_dir = get_shared_metadata_dir()
+        if shared_dir is not None:
+            table = load_shared_table(pl, model_name, shared_dir)
+        else:
+            table = np.array(load_ids(pl, model_name, 'rb'), dtype=str)
+
+        self.tables[key] = table
+        self.mtimes[key] = mtime
+        self.checked[key] = time.monotonic()
+        self.versions[pl.value] = self.versions.get(pl.value, 0) + 1
+        logging.info(' [RoutingTables] loaded %s/%s (%d ids)', pl.value, model_name, len(table))
+        return table
+
+    def get(self, pl: PLS, model_name: str) -> np.ndarray:
+        '''
+        Args:
+            pl (PRODUCTLINES): The product_line we are working with.
+            model_name (string): the model the ids belong to, ex) 'm0'
+        Returns:
+            np.ndarray: the ids, the index is the label the model outputs
+        '''
+        key = (pl.value, model_name)
+        table = self.tables.get(key)
+        if table is None:
+            return self.reload(pl, model_name)
+
+        if time.monotonic() - self.checked[key] >= CHECK_INTERVAL:
+            try:
+                if self.is_changed(pl, model_name):
+                    return self.reload(pl, model_name)
+            except OSError as e:
+                logging.warning(' [RoutingTables] could not check %s/%s, keeping the loaded table: %s', pl.value, model_name, e)
+        return table
+
+    def version(self, pl: PLS) -> int:
+        '''
+        Bumped every time one of the product line's tables is (re)loaded.
+        '''
+        return self.versions.get(pl.value, 0)
@@ -0,0 +1,338 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+
+import aiohttp
+import numpy as np
+
+try:
+    # serializes ndarrays without going through python lists, the json module is used without it
+    import orjson
+except ImportError:
+    orjson = None
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.singleton import Singleton
+from utils.inference import InferenceBackend
+from utils.metrics import TFS_IN_FLIGHT, TFS_TIMEOUTS, is_timeout
+from utils.timing import timed
+from utils.hedging import Hedges
+from utils.deadline import DeadlineExceeded, budget_timeouts
+from utils.replicas import Replicas, split_targets
+
+# defaults, can be overridden with the env or per product line in the [serving] table of its config.toml
+DEFAULT_URL = 'http://tfs-{pl}:{port}'
+DEFAULT_TRANSPORT = 'rest'
+DEFAULT_REST_FORMAT = 'columnar'
+DEFAULT_GRPC_URL = 'tfs-{pl}:{grpc_port}'
+DEFAULT_GRPC_PORT = '8500'
+DEFAULT_GRPC_DTYPE = 'float32'
+DEFAULT_INPUT_NAME = 'input_layer'
+DEFAULT_SIGNATURE_NAME = 'serve'
+DEFAULT_BYTES_SIGNATURE_NAME = 'serve_bytes'
+DEFAULT_BYTES_INPUT_NAME = 'image_bytes'
+DEFAULT_POOL_SIZE = 32
+DEFAULT_TIMEOUT = 10.0
+DEFAULT_CONNECT_TIMEOUT = 2.0
+DEFAULT_KEEPALIVE_TIMEOUT = 60.0
+DEFAULT_HEDGE = 0
+DEFAULT_HEDGE_PERCENTILE = 95.0
+DEFAULT_HEDGE_BUDGET = 0.05
+DEFAULT_HEDGE_MIN_MS = 5.0
+# comma separated base urls (host:port for grpc) of the tfs replicas, formatted like url, empty for the single replica of url (grpc_url)
+DEFAULT_REPLICAS = ''
+DEFAULT_GRPC_REPLICAS = ''
+DEFAULT_BALANCER = 'p2c'
+DEFAULT_AFFINITY = 0
+DEFAULT_EJECT_FAILURES = 3
+DEFAULT_EJECT_SECONDS = 10.0
+# a call that could not reach its replica is sent to another one, at most this many times
+MAX_REPLICA_RETRIES = 1
+
+
+def get_serving_option(serving_config: dict, key: str, env: str, default):
+    '''
+    Looks up a serving option, preferring the product line's [serving] table, then the env, then the default.
+
+    Args:
+        serving_config (dict): the [serving] table of the product line's config.toml (can be empty)
+        key (str): name of the option inside of the [serving] table
+        env (str): name of the env var that overrides the default for every product line
+        default: fallback value, its type is used to cast the option
+    Returns:
+        the option cast to the type of the default
+    '''
+    value = serving_config.get(key, os.getenv(env, default))
+    return type(default)(value)
+
+
+def is_unreachable(e: BaseException) -> bool:
+    '''
+    True when a call failed to reach its replica (refused or dropped connection, grpc UNAVAILABLE) rather than timing out
+    or being answered with an error, so sending it to another replica is safe and likely to work.
+    '''
+    if is_timeout(e):
+        return False
+    if isinstance(e, aiohttp.ClientConnectionError):
+        return True
+    code = getattr(e, 'code', None)
+    return callable(code) and getattr(code(), 'name', None) == 'UNAVAILABLE'
+
+
+def is_encoded(instances) -> bool:
+    '''
+    True if the batch holds the encoded image files (bytes) rather than preprocessed pixels.
+    '''
+    return len(instances) > 0 and isinstance(instances[0], (bytes, bytearray))
+
+
+def encode_instances(instances, signature_name: str | None = None, columnar: bool = False) -> bytes:
+    '''
+    Encodes a batch as the body of a tfs rest predict request.
+
+    Args:
+        instances (list | np.ndarray): preprocessed pixels (ndarray, or list of rows), or a list of encoded image files
+        signature_name (str | None): signature to call, tfs uses its default signature when None
+        columnar (bool): send the batch as the single tensor of the columnar "inputs" format (tfs answers with "outputs")
+            instead of a list of "instances" (answered with "predictions")
+    Returns:
+        bytes: the json body
+    '''
+    body = {}
+    if signature_name:
+        body['signature_name'] = signature_name
+
+    key = 'inputs' if columnar else 'instances'
+    if is_encoded(instances):
+        body[key] = [{'b64': base64.b64encode(b).decode('ascii')} for b in instances]
+    elif orjson is not None:
+        # written straight from the array's buffer, without a python float per pixel
+        body[key] = np.ascontiguousarray(instances, dtype=np.float32)
+        return orjson.dumps(body, option=orjson.OPT_SERIALIZE_NUMPY)
+    else:
+        body[key] = np.asarray(instances).tolist()
+    return json.dumps(body).encode()
+
+
+def decode_predictions(raw: bytes) -> np.ndarray:
+    '''
+    Decodes the body of a tfs rest predict response into a 2-D float32 ndarray (one softmax row per instance),
+    from the "outputs" of the columnar format or the "predictions" of the row format.
+    '''
+    body = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    predictions = body['outputs'] if 'outputs' in body else body.get('predictions', [])
+    if isinstance(predictions, dict):
+        # a signature with named outputs, identify needs its single softmax
+        if len(predictions) != 1:
+            raise ValueError(f'expected a single output, got {sorted(predictions)}')
+        predictions, = predictions.values()
+    # the lists hold python floats (doubles), converting to float64 first is the fast path of numpy
+    return np.array(predictions, dtype=np.float64).astype(np.float32)
+
+
+class TFSClient(InferenceBackend, metaclass=Singleton):
+    '''
+    Non-blocking tensorflow serving client.
+    Keeps one keep-alive connection pool (aiohttp session) per product line, so a single worker can keep
+    many tfs requests in flight without opening a new tcp connection for every call.
+    A product line can set transport='grpc' in its [serving] table to send packed binary tensors instead of json,
+    and replicas to spread its calls over several tfs containers (see Replicas).
+    '''
+    def __init__(self):
+        self.options: dict[str, dict] = {}
+        self.sessions: dict[str, aiohttp.ClientSession] = {}
+        self.grpc_transports: dict = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        '''
+        Sets the pool size, timeouts and urls of a product line. Sessions that are already open keep their old options.
+
+        Args:
+            pl (PRODUCTLINES): The product_line we are working with.
+            serving_config (dict): the [serving] table of the product line's config.toml (can be empty)
+        '''
+        self.options[pl.value] = {
+            'url': get_serving_option(serving_config, 'url', 'TFS_URL', DEFAULT_URL),
+            'pool_size': get_serving_option(serving_config, 'pool_size', 'TFS_POOL_SIZE', DEFAULT_POOL_SIZE),
+            'timeout': get_serving_option(serving_config, 'timeout', 'TFS_TIMEOUT', DEFAULT_TIMEOUT),
+            'connect_timeout': get_serving_option(serving_config, 'connect_timeout', 'TFS_CONNECT_TIMEOUT', DEFAULT_CONNECT_TIMEOUT),
+            'keepalive_timeout': get_serving_option(serving_config, 'keepalive_timeout', 'TFS_KEEPALIVE_TIMEOUT', DEFAULT_KEEPALIVE_TIMEOUT),
+            'transport': get_serving_option(serving_config, 'transport', 'TFS_TRANSPORT', DEFAULT_TRANSPORT),
+            'rest_format': get_serving_option(serving_config, 'rest_format', 'TFS_REST_FORMAT', DEFAULT_REST_FORMAT),
+            'grpc_url': get_serving_option(serving_config, 'grpc_url', 'TFS_GRPC_URL', DEFAULT_GRPC_URL),
+            'grpc_dtype': get_serving_option(serving_config, 'grpc_dtype', 'TFS_GRPC_DTYPE', DEFAULT_GRPC_DTYPE),
+            'input_name': get_serving_option(serving_config, 'input_name', 'TFS_INPUT_NAME', DEFAULT_INPUT_NAME),
+            'signature_name': get_serving_option(serving_config, 'signature_name', 'TFS_SIGNATURE_NAME', DEFAULT_SIGNATURE_NAME),
+            'bytes_signature_name': get_serving_option(serving_config, 'bytes_signature_name', 'TFS_BYTES_SIGNATURE_NAME', DEFAULT_BYTES_SIGNATURE_NAME),
+            'bytes_input_name': get_serving_option(serving_config, 'bytes_input_name', 'TFS_BYTES_INPUT_NAME', DEFAULT_BYTES_INPUT_NAME),
+            'hedge': get_serving_option(serving_config, 'hedge', 'TFS_HEDGE', DEFAULT_HEDGE),
+            'hedge_percentile': get_serving_option(serving_config, 'hedge_percentile', 'TFS_HEDGE_PERCENTILE', DEFAULT_HEDGE_PERCENTILE),
+            'hedge_budget': get_serving_option(serving_config, 'hedge_budget', 'TFS_HEDGE_BUDGET', DEFAULT_HEDGE_BUDGET),
+            'hedge_min_ms': get_serving_option(serving_config, 'hedge_min_ms', 'TFS_HEDGE_MIN_MS', DEFAULT_HEDGE_MIN_MS),
+            'replicas': get_serving_option(serving_config, 'replicas', 'TFS_REPLICAS', DEFAULT_REPLICAS),
+            'grpc_replicas': get_serving_option(serving_config, 'grpc_replicas', 'TFS_GRPC_REPLICAS', DEFAULT_GRPC_REPLICAS),
+            'balancer': get_serving_option(serving_config, 'balancer', 'TFS_BALANCER', DEFAULT_BALANCER),
+            'affinity': get_serving_option(serving_config, 'affinity', 'TFS_AFFINITY', DEFAULT_AFFINITY),
+            'eject_failures': get_serving_option(serving_config, 'eject_failures', 'TFS_EJECT_FAILURES', DEFAULT_EJECT_FAILURES),
+            'eject_seconds': get_serving_option(serving_config, 'eject_seconds', 'TFS_EJECT_SECONDS', DEFAULT_EJECT_SECONDS),
+        }
+        self.configure_replicas(pl)
+
+    def configure_replicas(self, pl: PLS):
+        '''
+        Hands the replicas of the product line's transport to the balancer (and the rest ones, the metadata is always read over rest).
+        '''
+        options = self.options[pl.value]
+        ports = {'port': os.getenv('TFS_PORT'), 'grpc_port': os.getenv('TFS_GRPC_PORT', DEFAULT_GRPC_PORT)}
+        transports = [('rest', options['replicas'] or options['url'])]
+        if options['transport'] == 'grpc':
+            transports.append(('grpc', options['grpc_replicas'] or options['grpc_url']))
+        for transport, targets in transports:
+            targets = [target.format(pl=pl.value, **ports) for target in split_targets(targets)]
+            Replicas().configure(pl, transport, targets, options['balancer'], options['affinity'],
+                                 options['eject_failures'], options['eject_seconds'])
+
+    def get_options(self, pl: PLS) -> dict:
+        if pl.value not in self.options:
+            self.configure(pl, {})
+        return self.options[pl.value]
+
+    def get_session(self, pl: PLS) -> aiohttp.ClientSession:
+        '''
+        Returns the pooled session of a product line, creating it on first use (must be called inside the event loop).
+        '''
+        session = self.sessions.get(pl.value)
+        if session is None or session.closed:
+            options = self.get_options(pl)
+            # pool_size connections to each replica, with no overall cap: the pool follows the replicas a config refresh
+            # adds or removes, without closing the session (and the calls in flight on it)
+            connector = aiohttp.TCPConnector(
+                    limit=0,
+                    limit_per_host=options['pool_size'],
+                    keepalive_timeout=options['keepalive_timeout'],
+                    )
+            timeout = aiohttp.ClientTimeout(total=options['timeout'], connect=options['connect_timeout'])
+            session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+            self.sessions[pl.value] = session
+            logging.info(' [TFSClient] opened a pool of %d connections per replica for %s', options['pool_size'], pl.value)
+        return session
+
+    def get_grpc_transport(self, pl: PLS, target: str | None = None):
+        '''
+        The channel to a grpc replica of a product line (its first one by default).
+        '''
+        options = self.get_options(pl)
+        if target is None:
+            target = Replicas().targets(pl, 'grpc')[0]
+        transport = self.grpc_transports.get((pl.value, target))
+        if transport is None:
+            # grpc and the tfs protos are only needed by product lines that use them
+            from utils.tfs_grpc import GrpcTransport
+
+            transport = GrpcTransport(
+                    target,
+                    input_name=options['input_name'],
+                    signature_name=options['signature_name'],
+                    bytes_input_name=options['bytes_input_name'],
+                    bytes_signature_name=options['bytes_signature_name'],
+                    dtype=options['grpc_dtype'],
+                    timeout=options['timeout'],
+                    )
+            self.grpc_transports[(pl.value, target)] = transport
+        return transport
+
+    async def predict(self, model_name: str, pl: PLS, instances, timeout: float | None = None) -> np.ndarray:
+        '''
+        Sends the instances to the tfs predict api of a model, over the product line's transport.
+
+        Args:
+            model_name (string): unique identifier for which (sub)model we are using for evaluation
+            pl (PRODUCTLINES): The product_line we are working with.
+            instances (list | np.ndarray): the batch of preprocessed images, or of encoded image files (bytes),
+                which are sent to the serve_bytes signature that decodes and resizes them inside of the graph
+            timeout (float | None): the budget left for the call (see MicroBatcher.send), the product line's timeout when shorter
+        Returns:
+            np.ndarray: the predictions tfs returned, 2-D float32 (one softmax row per instance)
+        '''
+        options = self.get_options(pl)
+        try:
+            with TFS_IN_FLIGHT.labels(pl.value, model_name).track_inprogress():
+                body = await self.encode(model_name, pl, instances)
+                if options['hedge']:
+                    # a slow call is sent again (see Hedges), whichever copy answers first wins
+                    return await Hedges().call(pl, model_name, lambda: self.send(model_name, pl, body, timeout),
+                                               options['hedge_percentile'], options['hedge_budget'], options['hedge_min_ms'] / 1000)
+                return await self.send(model_name, pl, body, timeout)
+        except Exception as e:
+            if is_timeout(e):
+                TFS_TIMEOUTS.labels(pl.value, model_name).inc()
+            raise
+
+    async def encode(self, model_name: str, pl: PLS, instances) -> bytes:
+        '''
+        The body of a predict call in the product line's transport: the json of the rest api, or the serialized PredictRequest
+        for grpc. Encoded once per call, every attempt of it (hedges, retries on another replica) sends the same bytes.
+        '''
+        options = self.get_options(pl)
+        # encoding several MB would stall the event loop, so it is done in a thread
+        with timed('serialize', pl.value, model_name):
+            if options['transport'] == 'grpc':
+                return await asyncio.to_thread(self.get_grpc_transport(pl).encode, model_name, instances)
+            signature_name = options['bytes_signature_name'] if is_encoded(instances) else None
+            return await asyncio.to_thread(encode_instances, instances, signature_name, options['rest_format'] == 'columnar')
+
+    async def send(self, model_name: str, pl: PLS, body: bytes, timeout: float | None = None) -> np.ndarray:
+        '''
+        A single call with an encoded body (see encode), to the replica picked by the balancer (see Replicas).
+        When it can not reach that replica, it is sent to another one, so a replica that went down costs retries
+        rather than failed images until it is ejected.
+        '''
+        options = self.get_options(pl)
+        transport = options['transport']
+        if timeout is not None:
+            if timeout <= 0:
+                raise DeadlineExceeded(f'no budget left for {pl.value}/{model_name}')
+            timeout = min(timeout, options['timeout'])
+        tried = []
+        while True:
+            try:
+                with Replicas().use(pl, transport, model_name, exclude=tried) as target, budget_timeouts(timeout, options['timeout']):
+                    tried.append(target)
+                    if transport == 'grpc':
+                        return await self.get_grpc_transport(pl, target).predict(model_name, body, timeout)
+                    return await self.predict_rest(model_name, pl, body, target, timeout)
+            except Exception as e:
+                if not is_unreachable(e) or len(tried) > MAX_REPLICA_RETRIES or len(Replicas().targets(pl, transport)) <= len(tried):
+                    raise
+                logging.info(' [TFSClient] could not reach %s for %s/%s, retrying on another replica: %r', target, pl.value, model_name, e)
+
+    async def predict_rest(self, model_name: str, pl: PLS, body: bytes, base_url: str, timeout: float | None = None) -> np.ndarray:
+        url = f'{base_url}/v1/models/{model_name}:predict'
+        options = self.get_options(pl)
+        kwargs = {}
+        if timeout is not None:
+            kwargs['timeout'] = aiohttp.ClientTimeout(total=timeout, connect=min(timeout, options['connect_timeout']))
+        with timed('tfs', pl.value, model_name):
+            async with self.get_session(pl).post(url, data=body, headers={'Content-Type': 'application/json'}, **kwargs) as response:
+                response.raise_for_status()
+                raw = await response.read()
+        with timed('deserialize', pl.value, model_name):
+            return await asyncio.to_thread(decode_predictions, raw)
+
+    async def metadata(self, model_name: str, pl: PLS) -> dict:
+        # configures the replicas of a product line on first use
+        self.get_options(pl)
+        with Replicas().use(pl, 'rest', model_name) as base_url:
+            async with self.get_session(pl).get(f'{base_url}/v1/models/{model_name}/metadata') as response:
+                response.raise_for_status()
+                return await response.json()
+
+    async def close(self):
+        for session in self.sessions.values():
+            await session.close()
+        for transport in self.grpc_transports.values():
+            await transport.close()
+        self.sessions = {}
+        self.grpc_transports = {}
@@ -0,0 +1,106 @@
+import logging
+
+import grpc
+import numpy as np
+
+from utils.tfs_client import is_encoded
+from utils.tfs_protos import DT_FLOAT, DT_STRING, DT_UINT8, PREDICT_METHOD, PredictRequest, PredictResponse, TensorProto, TensorShapeProto
+
+# grpc caps messages at 4MB by default, a batch of float32 scans is far bigger than that
+MAX_MESSAGE_LENGTH = 1 << 30
+
+DTYPES = {
+        'float32': (np.float32, DT_FLOAT),
+        'uint8': (np.uint8, DT_UINT8),
+        }
+
+
+def to_string_tensor_proto(instances: list[bytes]) -> TensorProto:
+    '''
+    Packs a batch of encoded image files into a 1-D string TensorProto (for the serve_bytes signature).
+    '''
+    shape = TensorShapeProto(dim=[TensorShapeProto.Dim(size=len(instances))])
+    return TensorProto(dtype=DT_STRING, tensor_shape=shape, string_val=[bytes(b) for b in instances])
+
+
+def to_tensor_proto(batch: np.ndarray, dtype: str = 'float32') -> TensorProto:
+    '''
+    Packs a batch into a TensorProto using the raw tensor_content bytes (no per element proto fields).
+
+    Args:
+        batch (np.ndarray): the batch of preprocessed images, scaled to [0, 1]
+        dtype (str): 'float32' sends the batch as is, 'uint8' sends it rescaled to [0, 255]
+            (only works for models exported with a uint8 input signature)
+    Returns:
+        TensorProto: the packed tensor
+    '''
+    np_dtype, tf_dtype = DTYPES[dtype]
+    if np_dtype == np.uint8 and batch.dtype != np.uint8:
+        batch = np.rint(np.asarray(batch) * 255.0)
+    batch = np.ascontiguousarray(batch, dtype=np_dtype)
+
+    shape = TensorShapeProto(dim=[TensorShapeProto.Dim(size=d) for d in batch.shape])
+    return TensorProto(dtype=tf_dtype, tensor_shape=shape, tensor_content=batch.tobytes())
+
+
+def from_tensor_proto(proto: TensorProto) -> np.ndarray:
+    '''
+    Unpacks a float TensorProto (the softmax output of a model) into a float32 ndarray.
+    '''
+    shape = [d.size for d in proto.tensor_shape.dim]
+    if proto.tensor_content:
+        return np.frombuffer(proto.tensor_content, dtype=np.float32).reshape(shape)
+    return np.asarray(proto.float_val, dtype=np.float32).reshape(shape)
+
+
+class GrpcTransport:
+    '''
+    Talks to the tfs PredictionService over grpc, sending the images as packed binary tensors.
+    One channel per product line, the channel multiplexes every concurrent call.
+    '''
+    def __init__(self, target: str, input_name: str, signature_name: str, bytes_input_name: str,
+                 bytes_signature_name: str, dtype: str, timeout: float):
+        self.target = target
+        self.input_name = input_name
+        self.signature_name = signature_name
+        self.bytes_input_name = bytes_input_name
+        self.bytes_signature_name = bytes_signature_name
+        self.dtype = dtype
+        self.timeout = timeout
+        self.channel = grpc.aio.insecure_channel(target, options=[
+            ('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+            ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH),
+            ])
+        # takes the request already serialized (see encode), so the attempts of a hedged call send the same bytes
+        self.predict_call = self.channel.unary_unary(PREDICT_METHOD, response_deserializer=PredictResponse.FromString)
+        logging.info(' [GrpcTransport] opened a channel to %s', target)
+
+    def build_request(self, model_name: str, instances) -> PredictRequest:
+        request = PredictRequest()
+        request.model_spec.name = model_name
+        if is_encoded(instances):
+            request.model_spec.signature_name = self.bytes_signature_name
+            request.inputs[self.bytes_input_name].CopyFrom(to_string_tensor_proto(instances))
+        else:
+            request.model_spec.signature_name = self.signature_name
+            request.inputs[self.input_name].CopyFrom(to_tensor_proto(np.asarray(instances), self.dtype))
+        return request
+
+    def encode(self, model_name: str, instances) -> bytes:
+        '''
+        The serialized PredictRequest of the instances (blocking, it copies the whole batch).
+        '''
+        return self.build_request(model_name, instances).SerializeToString()
+
+    async def predict(self, model_name: str, request: bytes, timeout: float | None = None) -> np.ndarray:
+        '''
+        Same contract as the rest predict: one softmax vector per instance, as a 2-D float32 ndarray.
+        request is the serialized PredictRequest (see encode), timeout overrides the channel's timeout for this call.
+        '''
+        response = await self.predict_call(request, timeout=self.timeout if timeout is None else timeout)
+        # the keras export has exactly one output, whatever it happens to be named
+        output = next(iter(response.outputs.values()))
+        return from_tensor_proto(output)
+
+    async def close(self):
+        await self.channel.close()
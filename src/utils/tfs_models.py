@@ -1,110 +1,286 @@
+import asyncio
+import contextlib
 import tomllib
 import logging
 import os
-import requests
+import time
+
+from collections import Counter
 
 import numpy as np
 
 from utils.product_lines import PRODUCTLINES as PLS
 from utils.singleton import Singleton
-from utils.file_handler.pickle import load_ids
-
-# TODO : move to api package?
-# but keep some of the features
+from utils.file_handler.dir import get_saved_model_dir
+from utils.backends import Backends, get_backend
+from utils.tfs_client import get_serving_option
+from utils.batching import MicroBatchers
+from utils.routing import RoutingTables
+from utils.catalog import Catalog, get_deckdrafterprod_path
+from utils.circuit import CircuitBreakers, CircuitOpenError
+from utils.deadline import DeadlineExceeded, within_deadline
+from utils.metrics import FAILURES, SUBMODEL_CALLS, SUBMODEL_IMAGES, is_timeout
+from utils.timing import timed
+
+# default bound on the submodel calls a product line has in flight, see SubmodelLimiter
+DEFAULT_MAX_CONCURRENT_SUBMODELS = 8
+
+# routing='best' sends an image to its most confident submodel only, 'cascade' also tries the next cascade_routes - 1
+# submodels while its final confidence stays below the threshold, see EarlyExit
+DEFAULT_ROUTING = 'best'
+DEFAULT_CASCADE_ROUTES = 2
+
+# the model that runs m0 and all of the submodels in one graph (see fuse_saved_model in keras_to_saved_model.py),
+# identify uses it when the product line's config.toml has a [fused] table, unless use_fused = 0 in [serving]
+FUSED_MODEL_NAME = 'fused'
+
+# see CachedConfigs, a product line is reloaded every CONFIG_REFRESH_S seconds,
+# failed loads are retried after 1, 2, 4... seconds (at most CONFIG_BACKOFF_MAX)
+CONFIG_REFRESH_ENV = 'CONFIG_REFRESH_S'
+DEFAULT_CONFIG_REFRESH = 60.0
+CONFIG_BACKOFF_BASE = 2
+CONFIG_BACKOFF_MAX = 30.0
 
 # TODO : move to api package?
 # but keep some of the features
 
-def identify(instances: list, model_name: str, pl: PLS) -> tuple[list[str], list[float]]:
+async def identify(instances: list, model_name: str, pl: PLS, threshold: float = 0.0, bounds: np.ndarray | None = None,
+                   trace: list[list[dict]] | None = None, partial: list[dict] | None = None) -> tuple[list[str], list[float]]:
     '''
     Identifies a card with multiple models, giving the most confident output.
 
     Args:
-        instances (list): The list of preprocessed images that are converted to a tensor, which is converted to a list
+        instances (list | np.ndarray): The batch of preprocessed images (or of encoded image files)
         model_name (string): unique identifier for which (sub)model we are using for evaluation
             ex) in the model "m12.keras", the model_name is "m12"
             ex) in the labels toml "m0_labels.toml", the model_name is "m0"
         pl (PRODUCTLINES): The product_line we are working with.
+        threshold (float): the final confidence an _id needs, below it the _id is None.
+            Images whose routing confidence already rules it out are not sent to a submodel at all (see EarlyExit)
+        bounds (np.ndarray | None): per image, the product of the confidences of the models above this one
+            (the most the final confidence can still be), None for a top level call (which can use the fused model)
+        trace (list[list[dict]] | None): per image, a list the models it went through are appended to
+            ({model, label, confidence, latency_ms}, see trace_calls), for the debug payload of /predict
+        partial (list[dict] | None): per image, a dict that is filled with {route, confidence} when the request's deadline
+            (see request_deadline) ran out before the image got its final answer, see partial_answers
 
     Returns:
         tuple[list[str | None], list[float]]: a tuple containing:
-            - list of most confident labels (or None if there is some sort of error)
-            - list of confidences corresponding to each label
+            - list of the most confident _ids, looked up in the ids of the final model
+              (or None if there is some sort of error, or the final confidence is below the threshold)
+            - list of confidences corresponding to each _id, relative to this model
+              (for images that were cut off early, the most they could have reached)
     '''
-
-    TFS_PORT = os.getenv('TFS_PORT')
-    url = f'http://tfs-{pl.value}:{TFS_PORT}/v1/models/{model_name}:predict'
-
+    n = len(instances)
+    if n == 0:
+        return [], []
+    if bounds is None:
+        # a top level call, with a fused model the whole hierarchy is a single call
+        if model_name == 'm0' and has_fused_model(pl):
+            return await identify_fused(instances, pl, threshold, trace, partial)
+        bounds = np.ones(n)
+
+    start = time.perf_counter()
     try:
-        response = requests.post(url, json={'instances': instances}, timeout=10)
-        response.raise_for_status()
-        predictions = response.json().get('predictions', [])
+        # batched together with the calls that concurrent requests make to the same model
+        # waits at most for what is left of the request's budget (the micro-batcher sends it along as the tfs timeout)
+        with timed('model', pl.value, model_name):
+            async with within_deadline(f'{pl.value}/{model_name}'), SubmodelLimiter().slot(model_name, pl):
+                predictions = await MicroBatchers().predict(model_name, pl, instances)
+        if predictions.shape[0] != n:
+            raise ValueError(f'got {predictions.shape[0]} predictions for {n} instances')
+        _ids = RoutingTables().get(pl, model_name)
     except Exception as e:
-        logging.warning('Model [%s] failed to get predictions: %s', model_name, str(e))
-        return [None] * len(instances), [0.0] * len(instances)
-
-    final_prediction_labels = [None] * len(instances)
-    confidences = [0.0] * len(instances)
+        FAILURES.labels(pl.value, model_name, failure_reason(e)).inc(n)
+        trace_calls(trace, model_name, [None] * n, np.zeros(n), time.perf_counter() - start, error=repr(e))
+        if isinstance(e, DeadlineExceeded):
+            logging.info('Model [%s] did not answer within the budget: %s', model_name, e)
+            return partial_answers(model_name, bounds, partial)
+        logging.warning('Model [%s] failed to get predictions: %r', model_name, e)
+        return [None] * n, [0.0] * n
+    latency = time.perf_counter() - start
+
+    # every prediction of the call is post-processed at once, as one (n, classes) matrix
+    with timed('postprocess', pl.value, model_name):
+        best_idx = predictions.argmax(axis=1)
+        best_conf = predictions[np.arange(n), best_idx].astype(np.float64)
+
+        valid = best_idx < len(_ids)
+        if not valid.all():
+            logging.warning('Model [%s] predicted labels outside of its %d ids for images %s', model_name, len(_ids), np.flatnonzero(~valid).tolist())
+        labels = np.full(n, None, dtype=object)
+        labels[valid] = _ids[best_idx[valid]]
+        confidences = np.where(valid, best_conf, 0.0)
+    trace_calls(trace, model_name, labels, confidences, latency)
 
     if CachedConfigs().request_config(pl)[model_name]['is_final']:
-        for i, p in enumerate(predictions):
-            try:
-                p_np = np.array(p)
-                best_idx = int(np.argmax(p_np))
-                confidence = float(p_np[best_idx])
-                final_prediction_labels[i] = best_idx
-                confidences[i] = confidence
-                logging.info('Model [%s] final prediction for image %d: %d (%.4f)', model_name, i, best_idx, confidence)
-            except Exception as e:
-                logging.warning('Model [%s] failed to process prediction for image %d: %s', model_name, i, str(e))
-        return final_prediction_labels, confidences
-
-    # Handle submodel routing
-    submodel_inputs = {}
-    image_indices_by_submodel = {}
-
-    for i, p in enumerate(predictions):
-        try:
-            p_np = np.array(p)
-            best_idx = int(np.argmax(p_np))
-            confidence = float(p_np[best_idx])
-
-            _ids: list[str] = load_ids(pl, model_name, 'rb') # TODO: move this outside of the for enumerate(predictions) loop
-
-            next_model: str = _ids[best_idx]
-
-            logging.info('Model [%s] defers image %d to submodel [%s] (label: %d)', model_name, i, next_model, best_idx)
-
-            if next_model not in submodel_inputs:
-                submodel_inputs[next_model] = []
-                image_indices_by_submodel[next_model] = []
-
-            submodel_inputs[next_model].append(instances[i])
-            image_indices_by_submodel[next_model].append(i)
-        except Exception as e:
-            logging.warning('Model [%s] failed to defer image %d: %s', model_name, i, str(e))
-
-    # Recurse into submodels
-    for next_model, sub_instances in submodel_inputs.items():
-        try:
-            sub_labels, sub_confidences = identify(sub_instances, next_model, pl)
-        except Exception as e:
-            logging.warning('Submodel [%s] failed to identify batch: %s', next_model, str(e))
-            sub_labels = [None] * len(sub_instances)
-            sub_confidences = [0.0] * len(sub_instances)
+        labels[bounds * confidences < threshold] = None
+        logging.info('Model [%s] final predictions: %s', model_name, labels.tolist())
+        return labels.tolist(), confidences.tolist()
+
+    # Handle submodel routing, the labels of a routing model are the names of the submodels
+    final_prediction_labels = np.full(n, None, dtype=object)
+    final_confidences = np.zeros(n)
+
+    # in cascade mode, an image whose final confidence stays below the threshold is retried with its next best submodel
+    routes = np.argsort(-predictions, axis=1)[:, :EarlyExit().max_routes(pl)]
+    routed_once = np.zeros(n, dtype=bool)
+    for attempt in range(routes.shape[1]):
+        route = routes[:, attempt]
+        route_conf = predictions[np.arange(n), route].astype(np.float64)
+        next_labels = _ids[np.minimum(route, len(_ids) - 1)]
+
+        # the submodel's confidence is at most 1, so the final confidence can not beat the routing confidence:
+        # images that can not reach the threshold (or their best result so far) are not sent at all
+        pending = valid & (final_prediction_labels == None) & (route < len(_ids))  # noqa: E711
+        routed = pending & (bounds * route_conf >= threshold) & ((attempt == 0) | (route_conf > final_confidences))
+        if attempt == 0:
+            EarlyExit().count_gated(pl, next_labels[pending & ~routed], next_labels[routed])
+        if not routed.any():
+            break
+
+        next_models = np.unique(next_labels[routed]).tolist()
+        image_indices_by_submodel = {next_model: np.flatnonzero(routed & (next_labels == next_model)) for next_model in next_models}
+        for next_model, indices in image_indices_by_submodel.items():
+            logging.info('Model [%s] defers images %s to submodel [%s]', model_name, indices.tolist(), next_model)
+            SUBMODEL_CALLS.labels(pl.value, next_model).inc()
+            SUBMODEL_IMAGES.labels(pl.value, next_model).inc(len(indices))
+        EarlyExit().count_routed(pl, attempt, len(next_models), int(routed.sum()))
+
+        # Recurse into the submodels concurrently, so the latency is the slowest submodel instead of the sum of all of them
+        results = await asyncio.gather(
+                *(identify(take(instances, indices), next_model, pl, threshold, bounds[indices] * route_conf[indices],
+                           None if trace is None else [trace[i] for i in indices],
+                           None if partial is None else [partial[i] for i in indices])
+                  for next_model, indices in image_indices_by_submodel.items()),
+                return_exceptions=True,
+                )
+
+        for next_model, result in zip(next_models, results):
+            indices = image_indices_by_submodel[next_model]
+            if isinstance(result, Exception):
+                logging.warning('Submodel [%s] failed to identify batch: %s', next_model, str(result))
+                continue
+
+            sub_labels, sub_confidences = result
+            # confidence of the top-level model times the confidence of the submodel
+            combined = route_conf[indices] * np.asarray(sub_confidences, dtype=np.float64)
+            # an _id is only returned above the threshold, so the most confident attempt is also the one with an _id
+            better = combined > final_confidences[indices]
+            final_prediction_labels[indices[better]] = np.asarray(sub_labels, dtype=object)[better]
+            final_confidences[indices[better]] = combined[better]
+        routed_once |= routed
+
+        # images that got an _id stop here, even if they had more routes left
+        if attempt + 1 < routes.shape[1]:
+            EarlyExit().count_stopped(pl, int((routed & (final_prediction_labels != None)).sum()))  # noqa: E711
+
+    # images that were never sent to a submodel are reported with their routing confidence, the most they could have reached
+    final_confidences[~routed_once] = confidences[~routed_once]
+    return final_prediction_labels.tolist(), final_confidences.tolist()
+
+
+def has_fused_model(pl: PLS) -> bool:
+    config = CachedConfigs().request_config(pl)
+    return FUSED_MODEL_NAME in config and get_serving_option(config.get('serving', {}), 'use_fused', 'USE_FUSED_MODEL', 1) != 0
+
+
+async def identify_fused(instances, pl: PLS, threshold: float = 0.0, trace: list[list[dict]] | None = None,
+                         partial: list[dict] | None = None) -> tuple[list[str], list[float]]:
+    '''
+    Same contract as identify(instances, 'm0', pl, threshold), with a single call to the fused model,
+    which routes and runs the submodels inside of its graph and returns (index into fused_ids, combined confidence) rows.
+    Falls back to the call per level when the fused model fails.
+    '''
+    n = len(instances)
+    start = time.perf_counter()
+    try:
+        with timed('model', pl.value, FUSED_MODEL_NAME):
+            async with within_deadline(f'{pl.value}/{FUSED_MODEL_NAME}'):
+                predictions = await MicroBatchers().predict(FUSED_MODEL_NAME, pl, instances)
+        if predictions.shape != (n, 2):
+            raise ValueError(f'expected ({n}, 2) predictions, got {predictions.shape}')
+        _ids = RoutingTables().get(pl, FUSED_MODEL_NAME)
+    except Exception as e:
+        FAILURES.labels(pl.value, FUSED_MODEL_NAME, failure_reason(e)).inc(n)
+        trace_calls(trace, FUSED_MODEL_NAME, [None] * n, np.zeros(n), time.perf_counter() - start, error=repr(e))
+        if isinstance(e, DeadlineExceeded):
+            # no time left to go through the models one by one either
+            logging.info('Model [%s] did not answer within the budget: %s', FUSED_MODEL_NAME, e)
+            return partial_answers('m0', np.ones(n), partial)
+        logging.warning('Model [%s] failed, falling back to the models one by one: %r', FUSED_MODEL_NAME, e)
+        return await identify(instances, 'm0', pl, threshold, np.ones(n), trace, partial)
+    latency = time.perf_counter() - start
+
+    best_idx = predictions[:, 0].astype(np.int64)
+    confidences = predictions[:, 1].astype(np.float64)
+
+    valid = (best_idx >= 0) & (best_idx < len(_ids))
+    if not valid.all():
+        logging.warning('Model [%s] predicted labels outside of its %d ids for images %s', FUSED_MODEL_NAME, len(_ids), np.flatnonzero(~valid).tolist())
+    labels = np.full(n, None, dtype=object)
+    labels[valid] = _ids[best_idx[valid]]
+    confidences = np.where(valid, confidences, 0.0)
+    trace_calls(trace, FUSED_MODEL_NAME, labels, confidences, latency)
+    labels[confidences < threshold] = None
+
+    logging.info('Model [%s] final predictions: %s', FUSED_MODEL_NAME, labels.tolist())
+    return labels.tolist(), confidences.tolist()
+
+
+def failure_reason(e: Exception) -> str:
+    if isinstance(e, CircuitOpenError):
+        return 'circuit_open'
+    if isinstance(e, DeadlineExceeded):
+        return 'deadline'
+    return 'timeout' if is_timeout(e) else 'error'
+
+
+def partial_answers(model_name: str, bounds: np.ndarray, partial: list[dict] | None) -> tuple[list[None], list[float]]:
+    '''
+    The answer for images whose budget ran out before model_name answered: no _id, and their partial dict is set to
+    the submodel they were routed to and their routing confidence (the product of the confidences above it, see bounds),
+    the best answer the models that did answer give. Relative to the submodel their confidence is 1, the most it could
+    have been, so the routing model reports the routing confidence like it does for the images it cut off early.
+    m0 is the root of the hierarchy: its images get no route and a confidence of 0.
+    '''
+    n = len(bounds)
+    root = model_name == 'm0'
+    for image_partial, bound in zip(partial or [], bounds):
+        if root:
+            image_partial.update(route=None, confidence=0.0)
+        # in cascade mode, an image keeps its most confident route
+        elif not image_partial or image_partial['confidence'] < bound:
+            image_partial.update(route=model_name, confidence=float(bound))
+    return [None] * n, [0.0 if root else 1.0] * n
+
+
+def trace_calls(trace: list[list[dict]] | None, model_name: str, labels, confidences: np.ndarray, seconds: float, error: str | None = None):
+    '''
+    Appends a model call to the trace of each of its images: the label the model picked (the submodel it routes to,
+    or the _id of a final model), its own confidence in it and the latency of the call (the batch it shared included).
+    '''
+    if trace is None:
+        return
+    for image_trace, label, confidence in zip(trace, labels, confidences):
+        step = {'model': model_name, 'label': None if label is None else str(label), 'confidence': float(confidence), 'latency_ms': seconds * 1000}
+        if error is not None:
+            step['error'] = error
+        image_trace.append(step)
 
-        for idx, sub_label, sub_conf in zip(image_indices_by_submodel[next_model], sub_labels, sub_confidences):
-            top_prediction = predictions[idx]
-            top_conf = float(np.max(top_prediction))  # confidence of the top-level model
-            final_prediction_labels[idx] = sub_label
-            confidences[idx] = top_conf * sub_conf
 
-    return final_prediction_labels, confidences
+def take(instances, indices: np.ndarray):
+    '''
+    instances[indices] for both ndarrays and lists (lists of rows or of encoded image files).
+    '''
+    if isinstance(instances, np.ndarray):
+        return instances[indices]
+    return [instances[i] for i in indices]
 
 
-def get_model_metadata(model_name: str, pl: PLS) -> dict:
+async def get_model_metadata(model_name: str, pl: PLS) -> dict:
     '''
-    gets the json dict of the metadata that tensorflow serving returns
+    gets the json dict of the metadata that tensorflow serving returns (or its equivalent, for the local backend)
 
     Args:
         model_name (string): unique identifier for which (sub)model we are using for evaluation
@@ -114,10 +290,7 @@ def get_model_metadata(model_name: str, pl: PLS) -> dict:
     Returns: 
         dict: json dict response from tfs metadata get request
     '''
-    # port = get_port(pl) 
-    port = os.getenv('TFS_PORT')
-    url = f'http://tfs-{pl.value}:{port}/v1/models/{model_name}/metadata'
-    return requests.get(url).json()
+    return await get_backend(pl).metadata(model_name, pl)
 
 
 # TODO: pickled information may be easier?
@@ -146,25 +319,233 @@ def get_model_config(pl: PLS) -> dict:
 
 
 
+# -------------------------------------------------------
+class SubmodelLimiter(metaclass=Singleton):
+    '''
+    Bounds how many submodel calls (everything but m0) a product line has in flight at once,
+    so a wide fan-out can not flood its tfs container. Set with max_concurrent_submodels in the [serving] table.
+    Only the model call holds a slot (not the recursion), so deeper hierarchies can not deadlock on it.
+    '''
+    def __init__(self):
+        self.limits: dict[str, int] = {}
+        self.semaphores: dict[str, asyncio.Semaphore] = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        limit = get_serving_option(serving_config, 'max_concurrent_submodels', 'MAX_CONCURRENT_SUBMODELS', DEFAULT_MAX_CONCURRENT_SUBMODELS)
+        if self.limits.get(pl.value) != limit:
+            self.limits[pl.value] = limit
+            self.semaphores.pop(pl.value, None)
+
+    def slot(self, model_name: str, pl: PLS):
+        if model_name == 'm0':
+            return contextlib.nullcontext()
+
+        semaphore = self.semaphores.get(pl.value)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self.limits.get(pl.value, DEFAULT_MAX_CONCURRENT_SUBMODELS))
+            self.semaphores[pl.value] = semaphore
+        return semaphore
+
+
+# -------------------------------------------------------
+class EarlyExit(metaclass=Singleton):
+    '''
+    The routing mode of every product line and the counters of the work identify skipped thanks to the threshold:
+        - gated_images: images not sent to a submodel, their routing confidence could not reach the threshold
+        - saved_calls: submodel calls that were not made at all, because all of their images were gated
+        - stopped_images: (cascade) images that got an _id above the threshold and skipped their other routes
+        - cascade_images / cascade_calls: (cascade) retries with the next best submodel
+    '''
+    def __init__(self):
+        self.routes: dict[str, int] = {}
+        self.counters: dict[str, Counter] = {}
+
+    def configure(self, pl: PLS, serving_config: dict):
+        routing = get_serving_option(serving_config, 'routing', 'ROUTING_MODE', DEFAULT_ROUTING)
+        if routing not in ('best', 'cascade'):
+            raise ValueError(f'unknown routing {routing!r} for {pl.value}, expected best or cascade')
+        cascade_routes = get_serving_option(serving_config, 'cascade_routes', 'CASCADE_ROUTES', DEFAULT_CASCADE_ROUTES)
+        self.routes[pl.value] = max(cascade_routes, 1) if routing == 'cascade' else 1
+
+    def max_routes(self, pl: PLS) -> int:
+        return self.routes.get(pl.value, 1)
+
+    def count_gated(self, pl: PLS, gated_models: np.ndarray, routed_models: np.ndarray):
+        counter = self.counters.setdefault(pl.value, Counter())
+        counter['gated_images'] += len(gated_models)
+        counter['saved_calls'] += len(set(gated_models.tolist()) - set(routed_models.tolist()))
+
+    def count_routed(self, pl: PLS, attempt: int, calls: int, images: int):
+        counter = self.counters.setdefault(pl.value, Counter())
+        counter['submodel_calls'] += calls
+        counter['routed_images'] += images
+        if attempt > 0:
+            counter['cascade_calls'] += calls
+            counter['cascade_images'] += images
+
+    def count_stopped(self, pl: PLS, images: int):
+        self.counters.setdefault(pl.value, Counter())['stopped_images'] += images
+
+    def stats(self) -> dict:
+        return {pl: dict(counter) for pl, counter in self.counters.items()}
+
+
 # -------------------------------------------------------
 class CachedConfigs(metaclass=Singleton):
+    '''
+    The config.toml and the tfs metadata (input size, model versions) of every product line.
+    Nothing is loaded when it is created: start() loads each product line in its own background task
+    (concurrently, retrying with backoff) and then refreshes it every CONFIG_REFRESH_S seconds,
+    so one slow or missing tfs container neither blocks the api boot nor the other product lines.
+    Until a product line's first load succeeds it is not ready (is_ready), and the api answers its requests with a 503.
+    '''
     # TODO: pickled information may be easier?
     def __init__(self):
         self.cached_configs = {}
+        self.errors: dict[str, str] = {}
+        self.loaded_at: dict[str, float] = {}
+        self.tasks: dict[str, asyncio.Task] = {}
+        self.catalog_tasks: dict[str, asyncio.Task] = {}
+        # the mtime of the deckdrafterprod.json each catalog was last opened from (None when it was missing)
+        self.catalog_sources: dict[str, float | None] = {}
+        self.refresh_interval = float(os.getenv(CONFIG_REFRESH_ENV, DEFAULT_CONFIG_REFRESH))
+
+    def start(self):
+        '''
+        Starts the background loading of every product line. Must be called inside the event loop (api startup).
+        '''
         for pl in PLS:
-            self.cached_configs[pl.value] = get_model_config(pl)
-
-            # for each of the product lines
-            # find the one that is 'base'
-            # that is the only one that needs height and width because all other models should be following the same format
-            # this is for efficiency. why else should we be training the models off of different sized images?A
-            # this might bite me in the butt when it comes to versioning... 
-            metadata = get_model_metadata('m0', pl)
-            input_width = int(metadata['metadata']['signature_def']['signature_def']['serve']['inputs']['input_layer']['tensor_shape']['dim'][1]['size'])
-            input_height = int(metadata['metadata']['signature_def']['signature_def']['serve']['inputs']['input_layer']['tensor_shape']['dim'][2]['size'])
-
-            self.cached_configs[pl.value]['m0']['input_width'] = input_width
-            self.cached_configs[pl.value]['m0']['input_height'] = input_height 
+            self.start_loading(pl)
+
+    def start_loading(self, pl: PLS):
+        task = self.tasks.get(pl.value)
+        if task is None or task.done():
+            self.tasks[pl.value] = asyncio.create_task(self.keep_loaded(pl))
+
+    async def stop(self):
+        tasks = [*self.tasks.values(), *self.catalog_tasks.values()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        self.tasks = {}
+        self.catalog_tasks = {}
+
+    async def keep_loaded(self, pl: PLS):
+        attempt = 0
+        while True:
+            try:
+                await self.load(pl)
+                attempt = 0
+                delay = self.refresh_interval
+            except Exception as e:
+                # a failed refresh keeps serving the config that was already loaded
+                self.errors[pl.value] = repr(e)
+                delay = min(CONFIG_BACKOFF_BASE ** attempt, CONFIG_BACKOFF_MAX)
+                attempt += 1
+                logging.warning(' [CachedConfigs] loading %s failed (attempt %d), retrying in %.0fs: %r', pl.value, attempt, delay, e)
+            await asyncio.sleep(delay)
+
+    async def load(self, pl: PLS):
+        '''
+        Reads the product line's config.toml and asks tfs for m0's input size and every model's version.
+        The new config replaces the old one only once all of it loaded.
+        '''
+        config = get_model_config(pl)
+        if 'm0' not in config:
+            raise KeyError(f'no [m0] in the config.toml of {pl.value}')
+
+        serving_config = config.get('serving', {})
+        Backends().configure(pl, serving_config)
+        MicroBatchers().configure(pl, serving_config)
+        SubmodelLimiter().configure(pl, serving_config)
+        EarlyExit().configure(pl, serving_config)
+        CircuitBreakers().configure(pl, serving_config)
+        RoutingTables().load(pl)
+
+        # for each of the product lines
+        # find the one that is 'base'
+        # that is the only one that needs height and width because all other models should be following the same format
+        # this is for efficiency. why else should we be training the models off of different sized images?A
+        # this might bite me in the butt when it comes to versioning... 
+        metadata = await get_model_metadata('m0', pl)
+        # the serve signature has a single input (named input_layer by keras, tflite renames it)
+        input_spec, = metadata['metadata']['signature_def']['signature_def']['serve']['inputs'].values()
+        input_width = int(input_spec['tensor_shape']['dim'][1]['size'])
+        input_height = int(input_spec['tensor_shape']['dim'][2]['size'])
+
+        config['m0']['input_width'] = input_width
+        config['m0']['input_height'] = input_height 
+        config['m0']['version'] = metadata.get('model_spec', {}).get('version')
+
+        await load_versions(config, pl)
+
+        self.cached_configs[pl.value] = config
+        self.loaded_at[pl.value] = time.time()
+        self.errors.pop(pl.value, None)
+        logging.info(' [CachedConfigs] %s loaded', pl.value)
+        self.refresh_catalog(pl)
+
+    def refresh_catalog(self, pl: PLS):
+        '''
+        Opens the card catalog of a ready product line in a background task, building it first if it is stale,
+        and opens it again only when its deckdrafterprod.json changed (a stat per config refresh otherwise).
+        The catalog is optional: until it is open, /predict answers with the _ids and no card details.
+        '''
+        try:
+            source_mtime = os.path.getmtime(get_deckdrafterprod_path(pl))
+        except OSError:
+            source_mtime = None
+        task = self.catalog_tasks.get(pl.value)
+        if task is not None and not task.done():
+            return
+        if pl.value in self.catalog_sources and self.catalog_sources[pl.value] == source_mtime:
+            return
+        self.catalog_sources[pl.value] = source_mtime
+        self.catalog_tasks[pl.value] = asyncio.create_task(self.open_catalog(pl))
+
+    async def open_catalog(self, pl: PLS):
+        try:
+            await asyncio.to_thread(Catalog().open, pl)
+        except Exception as e:
+            # tried again once deckdrafterprod.json changes
+            logging.warning(' [CachedConfigs] no card catalog for %s: %s', pl.value, e)
+
+    def is_ready(self, pl: PLS) -> bool:
+        return pl.value in self.cached_configs
+
+    def status(self) -> dict:
+        return {
+                pl.value: {
+                    'ready': self.is_ready(pl),
+                    'loaded_at': self.loaded_at.get(pl.value),
+                    'error': self.errors.get(pl.value),
+                    'catalog': Catalog().is_open(pl),
+                    }
+                for pl in PLS
+                }
+
+    def model_health(self, pl: PLS) -> dict:
+        '''
+        Whether the product line can identify images, from its circuit breakers (no model is called):
+        it needs its config and m0 (or the fused model), an open submodel only fails the images routed to it.
+
+        Returns:
+            dict: {available, models: {model_name: closed | half_open | open}}
+        '''
+        if not self.is_ready(pl):
+            return {'available': False, 'models': {}}
+        model_names = [name for name, _ in self.model_versions(pl)]
+        if has_fused_model(pl):
+            model_names.append(FUSED_MODEL_NAME)
+        available = CircuitBreakers().is_available(pl, 'm0') or (has_fused_model(pl) and CircuitBreakers().is_available(pl, FUSED_MODEL_NAME))
+        return {'available': available, 'models': CircuitBreakers().states(pl, model_names)}
+
+    def model_versions(self, pl: PLS) -> tuple:
+        '''
+        The tfs version of every model of the product line, changes whenever one of them is redeployed.
+        '''
+        config = self.request_config(pl)
+        return tuple((name, section.get('version')) for name, section in config.items() if isinstance(section, dict) and 'is_final' in section)
 
     def request_config(self, pl: PLS) -> dict:
         try:
@@ -173,3 +554,15 @@ class CachedConfigs(metaclass=Singleton):
             logging.error(' [request_config] ps not loaded yet. Error: %s.', e)
             return {}
 
+
+async def load_versions(config: dict, pl: PLS):
+    '''
+    Asks tfs which version of each submodel it is serving (m0's comes with its metadata).
+    '''
+    model_names = [name for name, section in config.items() if name != 'm0' and isinstance(section, dict) and 'is_final' in section]
+    results = await asyncio.gather(*(get_model_metadata(name, pl) for name in model_names), return_exceptions=True)
+    for name, metadata in zip(model_names, results):
+        if isinstance(metadata, Exception):
+            logging.warning(' [load_versions] could not get the version of %s/%s: %s', pl.value, name, metadata)
+            continue
+        config[name]['version'] = metadata.get('model_spec', {}).get('version')
@@ -0,0 +1,131 @@
+'''
+The tensorflow serving protos the grpc transport needs (PredictRequest / PredictResponse and the TensorProto they carry),
+declared from the upstream .proto files instead of importing them from tensorflow-serving-api, which depends on all of
+tensorflow. Only protobuf is needed. Only the wire format matters: the package, message and field names, the field
+numbers and the types below are the ones of tensorflow/core/framework/{types,tensor_shape,tensor}.proto and
+tensorflow_serving/apis/{model,predict}.proto. Fields the api never sets or reads (resource handles, variants, the
+streamed predict options) are left out, protobuf skips them on the wire.
+The descriptors are built in a private pool, so they do not clash with tensorflow's own when a process imports both
+(ex) the local backend).
+'''
+from google.protobuf import descriptor_pb2, descriptor_pool, message_factory, wrappers_pb2
+
+Field = descriptor_pb2.FieldDescriptorProto
+
+# tensorflow.DataType, types.proto (proto3 enums are open, the values left out still parse)
+DATA_TYPES = {
+        'DT_INVALID': 0, 'DT_FLOAT': 1, 'DT_DOUBLE': 2, 'DT_INT32': 3, 'DT_UINT8': 4, 'DT_INT16': 5, 'DT_INT8': 6,
+        'DT_STRING': 7, 'DT_COMPLEX64': 8, 'DT_INT64': 9, 'DT_BOOL': 10, 'DT_QINT8': 11, 'DT_QUINT8': 12, 'DT_QINT32': 13,
+        'DT_BFLOAT16': 14, 'DT_QINT16': 15, 'DT_QUINT16': 16, 'DT_UINT16': 17, 'DT_COMPLEX128': 18, 'DT_HALF': 19,
+        'DT_RESOURCE': 20, 'DT_VARIANT': 21, 'DT_UINT32': 22, 'DT_UINT64': 23,
+        }
+DT_FLOAT = DATA_TYPES['DT_FLOAT']
+DT_UINT8 = DATA_TYPES['DT_UINT8']
+DT_STRING = DATA_TYPES['DT_STRING']
+
+PREDICT_METHOD = '/tensorflow.serving.PredictionService/Predict'
+
+
+def field(name: str, number: int, kind: int, type_name: str | None = None, repeated: bool = False,
+          oneof_index: int | None = None) -> Field:
+    proto = Field(name=name, number=number, type=kind, label=Field.LABEL_REPEATED if repeated else Field.LABEL_OPTIONAL)
+    if type_name is not None:
+        proto.type_name = type_name
+    if oneof_index is not None:
+        proto.oneof_index = oneof_index
+    return proto
+
+
+def map_entry(name: str, value_type: str) -> descriptor_pb2.DescriptorProto:
+    '''
+    The nested message of a map<string, value_type> field.
+    '''
+    entry = descriptor_pb2.DescriptorProto(name=name, field=[
+        field('key', 1, Field.TYPE_STRING),
+        field('value', 2, Field.TYPE_MESSAGE, value_type),
+        ])
+    entry.options.map_entry = True
+    return entry
+
+
+def proto_file(name: str, package: str, dependencies: list[str], messages: list[descriptor_pb2.DescriptorProto],
+               enums: list[descriptor_pb2.EnumDescriptorProto] = ()) -> descriptor_pb2.FileDescriptorProto:
+    return descriptor_pb2.FileDescriptorProto(name=name, package=package, syntax='proto3', dependency=dependencies,
+                                              message_type=messages, enum_type=enums)
+
+
+def build_pool() -> descriptor_pool.DescriptorPool:
+    pool = descriptor_pool.DescriptorPool()
+    pool.Add(descriptor_pb2.FileDescriptorProto.FromString(wrappers_pb2.DESCRIPTOR.serialized_pb))
+
+    types = descriptor_pb2.EnumDescriptorProto(name='DataType', value=[
+        descriptor_pb2.EnumValueDescriptorProto(name=name, number=number) for name, number in DATA_TYPES.items()
+        ])
+    pool.Add(proto_file('tensorflow/core/framework/types.proto', 'tensorflow', [], [], [types]))
+
+    dim = descriptor_pb2.DescriptorProto(name='Dim', field=[
+        field('size', 1, Field.TYPE_INT64),
+        field('name', 2, Field.TYPE_STRING),
+        ])
+    shape = descriptor_pb2.DescriptorProto(name='TensorShapeProto', nested_type=[dim], field=[
+        field('dim', 2, Field.TYPE_MESSAGE, '.tensorflow.TensorShapeProto.Dim', repeated=True),
+        field('unknown_rank', 3, Field.TYPE_BOOL),
+        ])
+    pool.Add(proto_file('tensorflow/core/framework/tensor_shape.proto', 'tensorflow', [], [shape]))
+
+    tensor = descriptor_pb2.DescriptorProto(name='TensorProto', field=[
+        field('dtype', 1, Field.TYPE_ENUM, '.tensorflow.DataType'),
+        field('tensor_shape', 2, Field.TYPE_MESSAGE, '.tensorflow.TensorShapeProto'),
+        field('version_number', 3, Field.TYPE_INT32),
+        field('tensor_content', 4, Field.TYPE_BYTES),
+        field('half_val', 13, Field.TYPE_INT32, repeated=True),
+        field('float_val', 5, Field.TYPE_FLOAT, repeated=True),
+        field('double_val', 6, Field.TYPE_DOUBLE, repeated=True),
+        field('int_val', 7, Field.TYPE_INT32, repeated=True),
+        field('string_val', 8, Field.TYPE_BYTES, repeated=True),
+        field('scomplex_val', 9, Field.TYPE_FLOAT, repeated=True),
+        field('int64_val', 10, Field.TYPE_INT64, repeated=True),
+        field('bool_val', 11, Field.TYPE_BOOL, repeated=True),
+        field('dcomplex_val', 12, Field.TYPE_DOUBLE, repeated=True),
+        field('uint32_val', 16, Field.TYPE_UINT32, repeated=True),
+        field('uint64_val', 17, Field.TYPE_UINT64, repeated=True),
+        ])
+    pool.Add(proto_file('tensorflow/core/framework/tensor.proto', 'tensorflow',
+                        ['tensorflow/core/framework/tensor_shape.proto', 'tensorflow/core/framework/types.proto'], [tensor]))
+
+    model_spec = descriptor_pb2.DescriptorProto(name='ModelSpec', field=[
+        field('name', 1, Field.TYPE_STRING),
+        field('version', 2, Field.TYPE_MESSAGE, '.google.protobuf.Int64Value', oneof_index=0),
+        field('version_label', 4, Field.TYPE_STRING, oneof_index=0),
+        field('signature_name', 3, Field.TYPE_STRING),
+        ])
+    model_spec.oneof_decl.add(name='version_choice')
+    pool.Add(proto_file('tensorflow_serving/apis/model.proto', 'tensorflow.serving', ['google/protobuf/wrappers.proto'], [model_spec]))
+
+    request = descriptor_pb2.DescriptorProto(name='PredictRequest', nested_type=[map_entry('InputsEntry', '.tensorflow.TensorProto')], field=[
+        field('model_spec', 1, Field.TYPE_MESSAGE, '.tensorflow.serving.ModelSpec'),
+        field('inputs', 2, Field.TYPE_MESSAGE, '.tensorflow.serving.PredictRequest.InputsEntry', repeated=True),
+        field('output_filter', 3, Field.TYPE_STRING, repeated=True),
+        ])
+    response = descriptor_pb2.DescriptorProto(name='PredictResponse', nested_type=[map_entry('OutputsEntry', '.tensorflow.TensorProto')], field=[
+        field('model_spec', 2, Field.TYPE_MESSAGE, '.tensorflow.serving.ModelSpec'),
+        field('outputs', 1, Field.TYPE_MESSAGE, '.tensorflow.serving.PredictResponse.OutputsEntry', repeated=True),
+        ])
+    pool.Add(proto_file('tensorflow_serving/apis/predict.proto', 'tensorflow.serving',
+                        ['tensorflow/core/framework/tensor.proto', 'tensorflow_serving/apis/model.proto'], [request, response]))
+    return pool
+
+
+POOL = build_pool()
+
+
+def message_class(full_name: str) -> type:
+    return message_factory.GetMessageClass(POOL.FindMessageTypeByName(full_name))
+
+
+TensorShapeProto = message_class('tensorflow.TensorShapeProto')
+TensorProto = message_class('tensorflow.TensorProto')
+ModelSpec = message_class('tensorflow.serving.ModelSpec')
+PredictRequest = message_class('tensorflow.serving.PredictRequest')
+PredictResponse = message_class('tensorflow.serving.PredictResponse')
+
@@ -0,0 +1,107 @@
+import contextlib
+import contextvars
+import threading
+import time
+
+from utils.metrics import STAGE_SECONDS
+from utils.singleton import Singleton
+
+# the (stage, model, seconds) of the request being served, see request_timings
+REQUEST_TIMINGS: contextvars.ContextVar[list | None] = contextvars.ContextVar('request_timings', default=None)
+
+
+class StageTimings(metaclass=Singleton):
+    '''
+    How much time the inference pipeline spends in each stage (reading the uploads, decoding, the model calls...),
+    summed since the process started. Cheap enough for the hot path: a perf_counter and a dict update per stage.
+    Stages are keyed stage or stage:model, see utils/metrics.py for the names.
+    '''
+    def __init__(self):
+        self.totals: dict[str, list] = {}
+        # decode and resize are recorded from the decode pool's threads
+        self.lock = threading.Lock()
+
+    def record(self, stage: str, seconds: float):
+        with self.lock:
+            total = self.totals.get(stage)
+            if total is None:
+                self.totals[stage] = [1, seconds, seconds]
+                return
+            total[0] += 1
+            total[1] += seconds
+            if seconds > total[2]:
+                total[2] = seconds
+
+    def stats(self) -> dict:
+        with self.lock:
+            totals = sorted((stage, list(total)) for stage, total in self.totals.items())
+        return {
+                stage: {
+                    'count': count,
+                    'total_ms': seconds * 1000,
+                    'mean_ms': seconds * 1000 / count,
+                    'max_ms': longest * 1000,
+                    }
+                for stage, (count, seconds, longest) in totals
+                }
+
+
+@contextlib.contextmanager
+def timed(stage: str, pl: str = '', model: str = ''):
+    '''
+    Records the time spent inside of the block under stage (exceptions included), in /stats and in the
+    harmony_stage_seconds histogram of /metrics.
+
+    Args:
+        stage (str): name of the stage, ex) decode
+        pl (str): value of the product line the work is for, if known
+        model (str): the model the work is for, if any
+    '''
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - start, pl, model)
+
+
+def record_stage(stage: str, seconds: float, pl: str = '', model: str = ''):
+    '''
+    Records a stage that could not be timed with a block around it (ex) the upload, parsed before the handler runs), see timed.
+    '''
+    StageTimings().record(f'{stage}:{model}' if model else stage, seconds)
+    STAGE_SECONDS.labels(stage, pl, model).observe(seconds)
+    timings = REQUEST_TIMINGS.get()
+    if timings is not None:
+        timings.append((stage, model, seconds))
+
+
+@contextlib.contextmanager
+def request_timings():
+    '''
+    Collects the stages timed inside of the block (and the tasks and decode threads it starts) for a single request.
+    A micro-batch is sent from the context of the request that opened it, so the serialize, tfs and deserialize stages
+    of a shared tfs call only show up for that request; every request sees its own wait on the model.
+
+    Yields:
+        list[tuple[str, str, float]]: the (stage, model, seconds) timed so far
+    '''
+    timings = []
+    token = REQUEST_TIMINGS.set(timings)
+    try:
+        yield timings
+    finally:
+        REQUEST_TIMINGS.reset(token)
+
+
+def server_timing(timings: list[tuple[str, str, float]], total: float | None = None) -> str:
+    '''
+    Formats the timings of a request as a Server-Timing header: one entry per stage (summed over its occurrences,
+    ex) the decode of every image) and one per model the request waited on, named after the model (m0, m7...).
+    '''
+    durations: dict[str, float] = {}
+    for stage, model, seconds in timings:
+        name = model if stage == 'model' else stage
+        durations[name] = durations.get(name, 0.0) + seconds
+    if total is not None:
+        durations['total'] = total
+    return ', '.join(f'{name};dur={seconds * 1000:.3f}' for name, seconds in durations.items())
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# the api and its utils are imported as top level packages of src (PYTHONPATH=src in the containers)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+@pytest.fixture
+def data_dir(tmp_path, monkeypatch):
+    '''
+    An empty DATA_DIR, with the id tables kept in each process (no shared metadata dir).
+    '''
+    monkeypatch.setenv('DATA_DIR', str(tmp_path))
+    monkeypatch.setenv('SHARED_METADATA_DIR', '')
+    return tmp_path
+
+
+@pytest.fixture
+def fresh():
+    '''
+    fresh(SomeSingleton) drops the instance of a Singleton class, so the test gets a new one (and the next test too).
+    '''
+    classes = []
+
+    def reset(cls):
+        cls._Singleton__instance = None
+        classes.append(cls)
+        return cls()
+
+    yield reset
+    for cls in classes:
+        cls._Singleton__instance = None
@@ -0,0 +1,61 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import utils.batching as batching
+from utils.batching import MicroBatchers
+from utils.circuit import CircuitBreakers
+from utils.product_lines import PRODUCTLINES as PLS
+
+
+@pytest.fixture
+def batches(fresh, monkeypatch):
+    '''
+    The sizes of the batches sent to the backend, which answers every instance with its own value.
+    '''
+    fresh(CircuitBreakers)
+    sizes = []
+
+    async def call_backend(model_name, pl, instances, timeout=None):
+        sizes.append(len(instances))
+        await asyncio.sleep(0)
+        return np.asarray(instances, dtype=np.float32).reshape(-1, 1)
+
+    monkeypatch.setattr(batching, 'call_backend', call_backend)
+    return sizes
+
+
+def test_batches_stay_under_max_batch_size(fresh, batches):
+    batchers = fresh(MicroBatchers)
+    batchers.configure(PLS.POKEMON, {'max_batch_size': 64, 'max_batch_wait_ms': 50})
+
+    async def run():
+        requests = [list(range(start, start + size)) for start, size in [(0, 40), (100, 40), (200, 20), (300, 100), (500, 4)]]
+        results = await asyncio.gather(*(batchers.predict('m0', PLS.POKEMON, request) for request in requests))
+        for request, result in zip(requests, results):
+            assert result.ravel().tolist() == request
+
+    asyncio.run(run())
+    # 40 + 40 would be over the limit, the 100 instance request goes alone
+    assert batches == [40, 60, 100, 4]
+
+
+def test_configure_updates_existing_batchers(fresh, batches):
+    batchers = fresh(MicroBatchers)
+    batchers.configure(PLS.POKEMON, {'max_batch_size': 64, 'max_batch_wait_ms': 50})
+
+    async def run():
+        await batchers.predict('m0', PLS.POKEMON, [1, 2])
+        batchers.configure(PLS.POKEMON, {'max_batch_size': 2, 'max_batch_wait_ms': 1000})
+        batcher, = batchers.batchers.values()
+        assert (batcher.max_batch_size, batcher.max_wait) == (2, 1.0)
+        # full at the new size, it does not wait for the new max_wait
+        await asyncio.wait_for(asyncio.gather(*(batchers.predict('m0', PLS.POKEMON, [i]) for i in range(4))), 0.5)
+
+        batchers.configure(PLS.POKEMON, {'max_batch_size': 0})
+        await batchers.predict('m0', PLS.POKEMON, [1, 2, 3])
+        return batcher.stats()['batches']
+
+    assert asyncio.run(run()) == 3
+    assert batches == [2, 2, 2, 3]
@@ -0,0 +1,134 @@
+import asyncio
+import io
+import json
+import tarfile
+import zipfile
+
+import pytest
+from fastapi.testclient import TestClient
+
+import api.server as server
+from api.bulk import archive_files
+from utils.tfs_models import CachedConfigs
+
+PARAMS = {'product_line_string': 'pokemon', 'threshold': '0', 'window': '2'}
+
+
+def scan(i: int) -> bytes:
+    return f'scan {i} '.encode() * 100
+
+
+def make_tar(n: int, mode: str = 'w') -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode=mode) as archive:
+        directory = tarfile.TarInfo('cards')
+        directory.type = tarfile.DIRTYPE  # skipped
+        archive.addfile(directory)
+        for i in range(n):
+            info = tarfile.TarInfo(f'cards/{i}.jpg')
+            info.size = len(scan(i))
+            archive.addfile(info, io.BytesIO(scan(i)))
+    return buffer.getvalue()
+
+
+def make_zip(n: int) -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w') as archive:
+        for i in range(n):
+            archive.writestr(f'cards/{i}.jpg', scan(i))
+    return buffer.getvalue()
+
+
+async def chunked(body: bytes, size: int = 700):
+    for start in range(0, len(body), size):
+        yield body[start:start + size]
+
+
+async def read_all(body: bytes) -> list:
+    return [item async for item in archive_files(chunked(body))]
+
+
+@pytest.mark.parametrize('body', [make_tar(5), make_tar(5, 'w:gz'), make_zip(5)], ids=['tar', 'tar.gz', 'zip'])
+def test_archive_files(body):
+    assert asyncio.run(read_all(body)) == [(f'cards/{i}.jpg', scan(i), None) for i in range(5)]
+
+
+def test_large_members_are_reported_not_read(monkeypatch):
+    monkeypatch.setenv('BULK_MAX_IMAGE_BYTES', '100')
+    assert asyncio.run(read_all(make_tar(2))) == [(f'cards/{i}.jpg', None, 'larger than 100 bytes') for i in range(2)]
+
+
+def test_truncated_tar_yields_the_complete_files():
+    items = []
+
+    async def run():
+        # in the middle of the data of the second file
+        async for item in archive_files(chunked(make_tar(3)[:3000])):
+            items.append(item)
+
+    with pytest.raises(tarfile.ReadError):
+        asyncio.run(run())
+    assert [name for name, _, _ in items] == ['cards/0.jpg']
+
+
+def test_cancelled_while_reading_the_body():
+    body = make_tar(3)
+
+    async def stalled():
+        # part of the archive, then the client stops sending
+        yield body[:2100]
+        await asyncio.Event().wait()
+
+    async def run():
+        async def consume():
+            async for _ in archive_files(stalled()):
+                pass
+
+        task = asyncio.create_task(consume())
+        await asyncio.sleep(0.2)
+        task.cancel()
+        await asyncio.wait_for(asyncio.wait({task}), 5)
+        return task
+
+    # cancelled as is, not replaced by the error of closing a generator that is still running in its thread
+    assert asyncio.run(run()).cancelled()
+
+
+@pytest.fixture
+def client(monkeypatch):
+    '''
+    /predict/bulk of a ready product line whose "model" answers every file with its content.
+    '''
+    async def identify_window(files, start, pl, threshold, encoded):
+        return [{'index': start + i, 'name': name, 'id': None if data is None else data.decode(), 'confidence': 1.0}
+                for i, (name, data, _) in enumerate(files)]
+
+    monkeypatch.setattr(CachedConfigs, 'is_ready', lambda self, pl: True)
+    monkeypatch.setattr(server, 'identify_window', identify_window)
+    return TestClient(server.app)
+
+
+def post(client, body: bytes) -> list[dict]:
+    response = client.post('/predict/bulk', params=PARAMS, content=body)
+    assert response.status_code == 200
+    return [json.loads(line) for line in response.text.splitlines()]
+
+
+@pytest.mark.parametrize('body', [make_tar(5), make_zip(5)], ids=['tar', 'zip'])
+def test_bulk_answers_every_file(client, body):
+    *lines, summary = post(client, body)
+    assert [(line['index'], line['id']) for line in lines] == [(i, scan(i).decode()) for i in range(5)]
+    assert summary == {'done': True, 'images': 5, 'identified': 5, 'failed': 0}
+
+
+def test_bulk_truncated_archive_keeps_the_files_read(client):
+    *lines, summary = post(client, make_tar(5)[:4500])
+    assert [line['name'] for line in lines] == ['cards/0.jpg', 'cards/1.jpg']
+    assert summary['done'] is False and summary['images'] == 2 and 'could not read the archive' in summary['error']
+
+
+def test_bulk_empty_bodies(client):
+    summary, = post(client, b'')
+    assert summary['done'] is False and summary['images'] == 0
+    # an empty zip is a valid archive of no files
+    assert post(client, make_zip(0)) == [{'done': True, 'images': 0, 'identified': 0, 'failed': 0}]
@@ -0,0 +1,112 @@
+import asyncio
+
+import numpy as np
+import pytest
+
+import api.cache as cache
+from api.cache import PredictionCache
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.routing import RoutingTables
+from utils.tfs_models import CachedConfigs
+
+
+def scans(n: int) -> list[np.ndarray]:
+    '''
+    n images with different perceptual hashes, the first pixel says which one it is.
+    '''
+    rng = np.random.default_rng(0)
+    images = [rng.integers(0, 255, (32, 24, 3), dtype=np.uint8) for _ in range(n)]
+    for i, image in enumerate(images):
+        image[0, 0, 0] = i
+    return images
+
+
+@pytest.fixture
+def versions(monkeypatch):
+    '''
+    The tfs versions of the models of the product line.
+    '''
+    versions = {'m0': 1}
+    monkeypatch.setattr(CachedConfigs, 'model_versions', lambda self, pl: tuple(versions.items()))
+    return versions
+
+
+@pytest.fixture
+def calls(fresh, monkeypatch, versions):
+    '''
+    The batches the pipeline was called with (as lists of image numbers), it answers image i with id{i}.
+    '''
+    monkeypatch.delenv('CACHE_MAX_BYTES', raising=False)
+    fresh(RoutingTables)
+    calls = []
+
+    async def identify(instances, model_name, pl, threshold=0.0, partial=None):
+        numbers = [int(instance[0, 0, 0]) for instance in instances]
+        calls.append(numbers)
+        await asyncio.sleep(0.01)
+        if -1 in numbers:
+            raise ConnectionError('tfs is down')
+        return [f'id{i}' for i in numbers], [0.9] * len(numbers)
+
+    monkeypatch.setattr(cache, 'identify', identify)
+    return calls
+
+
+def test_duplicates_share_one_inference(fresh, calls):
+    prediction_cache = fresh(PredictionCache)
+    a, b, c = scans(3)
+
+    async def run():
+        return await asyncio.gather(prediction_cache.identify([a, b, a], PLS.POKEMON),
+                                    prediction_cache.identify([b, c], PLS.POKEMON))
+
+    (labels1, _), (labels2, _) = asyncio.run(run())
+    assert labels1 == ['id0', 'id1', 'id0'] and labels2 == ['id1', 'id2']
+    # a twice in the first request, b in both: every image is identified once
+    assert calls == [[0, 1], [2]]
+    stats = prediction_cache.stats()
+    assert (stats['misses'], stats['coalesced'], stats['in_flight']) == (3, 2, 0)
+
+
+def test_rescans_are_answered_from_the_cache(fresh, calls):
+    prediction_cache = fresh(PredictionCache)
+    a, b = scans(2)
+
+    asyncio.run(prediction_cache.identify([a], PLS.POKEMON))
+    labels, confidences = asyncio.run(prediction_cache.identify([a.copy(), b], PLS.POKEMON))
+    assert labels == ['id0', 'id1'] and confidences == [0.9, 0.9]
+    assert calls == [[0], [1]]
+    # below the threshold of the request, a cached answer is no answer
+    assert asyncio.run(prediction_cache.identify([a], PLS.POKEMON, 0.95))[0] == [None]
+    assert len(calls) == 2
+
+
+def test_a_redeployed_model_drops_the_entries(fresh, calls, versions):
+    prediction_cache = fresh(PredictionCache)
+    a, = scans(1)
+
+    asyncio.run(prediction_cache.identify([a], PLS.POKEMON))
+    versions['m0'] = 2
+    asyncio.run(prediction_cache.identify([a], PLS.POKEMON))
+    assert calls == [[0], [0]]
+    assert prediction_cache.stats()['invalidations'] == 1
+
+    # so does a reloaded id table
+    RoutingTables().versions[PLS.POKEMON.value] = 1
+    asyncio.run(prediction_cache.identify([a], PLS.POKEMON))
+    assert calls == [[0], [0], [0]] and prediction_cache.stats()['entries'] == 1
+
+
+def test_waiters_of_a_failed_inference_get_no_answer(fresh, calls):
+    prediction_cache = fresh(PredictionCache)
+    failing = scans(1)[0].astype(np.int16)
+    failing[0, 0, 0] = -1
+
+    async def run():
+        return await asyncio.gather(prediction_cache.identify([failing], PLS.POKEMON),
+                                    prediction_cache.identify([failing], PLS.POKEMON), return_exceptions=True)
+
+    owner, waiter = asyncio.run(run())
+    assert isinstance(owner, ConnectionError)
+    assert waiter == ([None], [0.0])
+    assert calls == [[-1]] and prediction_cache.stats()['entries'] == 0
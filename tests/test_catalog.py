@@ -0,0 +1,57 @@
+import asyncio
+import json
+import os
+import pickle
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.catalog import Catalog
+from utils.data_conversion import id_to_label, label_to_id, label_to_json
+from utils.tfs_models import CachedConfigs
+
+PL = PLS.POKEMON
+CARDS = [{'_id': 'c1', 'name': 'Pikachu', 'tcgplayer_productId': 1}, {'_id': 'c2', 'name': 'Eevee', 'tcgplayer_productId': 2},
+         {'_id': 'c3', 'name': 'Mew', 'tcgplayer_productId': 3}]
+
+
+def write_product_line(data_dir):
+    pl_dir = data_dir / PL.value
+    pl_dir.mkdir(exist_ok=True)
+    (pl_dir / 'deckdrafterprod.json').write_text(json.dumps(CARDS))
+    # the master labels are not the deckdrafterprod order, and m0 routes to submodels (none of its labels is a card)
+    for model_name, _ids in (('master', ['c3', 'c1', 'c2']), ('m0', ['m1', 'm2']), ('m1', ['c1']), ('m2', ['c2', 'c3'])):
+        with open(pl_dir / f'{model_name}_ids.pkl', 'wb') as f:
+            pickle.dump(_ids, f)
+
+
+def test_labels_are_the_master_labels(data_dir, fresh):
+    write_product_line(data_dir)
+    fresh(Catalog)
+
+    assert [id_to_label(_id, PL) for _id in ('c1', 'c2', 'c3', 'nope')] == [1, 2, 0, None]
+    assert [label_to_id(label, PL) for label in (0, 1, 2, 3)] == ['c3', 'c1', 'c2', None]
+    assert label_to_json(2, PL) == CARDS[1]
+    Catalog().close()
+
+
+def test_catalog_opens_after_ready_and_only_when_its_source_changes(data_dir, fresh, monkeypatch):
+    write_product_line(data_dir)
+    catalog = fresh(Catalog)
+    configs = fresh(CachedConfigs)
+    opened = []
+    original_open = Catalog.open
+    monkeypatch.setattr(Catalog, 'open', lambda self, pl: (opened.append(pl), original_open(self, pl)))
+
+    async def refreshes(n: int):
+        for _ in range(n):
+            configs.refresh_catalog(PL)
+            await asyncio.gather(*configs.catalog_tasks.values())
+
+    asyncio.run(refreshes(3))
+    assert opened == [PL] and catalog.is_open(PL)
+
+    source = data_dir / PL.value / 'deckdrafterprod.json'
+    mtime = os.path.getmtime(source) + 10
+    os.utime(source, (mtime, mtime))
+    asyncio.run(refreshes(2))
+    assert opened == [PL, PL]
+    catalog.close()
@@ -0,0 +1,98 @@
+import types
+
+import pytest
+
+import utils.circuit as circuit
+from utils.circuit import CLOSED, HALF_OPEN, OPEN, CircuitBreakers, CircuitOpenError
+from utils.product_lines import PRODUCTLINES as PLS
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    The time.monotonic of the breakers, moved by hand: clock.now += seconds.
+    '''
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(circuit, 'time', types.SimpleNamespace(monotonic=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def breakers(fresh, clock):
+    breakers = fresh(CircuitBreakers)
+    breakers.configure(PLS.POKEMON, {'breaker_failures': 2, 'breaker_open_seconds': 10, 'breaker_slow_seconds': 5})
+    return breakers
+
+
+def state(breakers) -> str:
+    return breakers.states(PLS.POKEMON, ['m0'])['m0']
+
+
+def test_failures_in_a_row_open_the_circuit(breakers, clock):
+    breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+    breakers.record(PLS.POKEMON, 'm0', clock.now)
+    breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+    assert state(breakers) == CLOSED
+
+    # a slow call counts as a failure
+    started = clock.now
+    clock.now += 6
+    breakers.record(PLS.POKEMON, 'm0', started)
+    assert state(breakers) == OPEN
+    with pytest.raises(CircuitOpenError):
+        breakers.check(PLS.POKEMON, 'm0')
+
+
+def test_client_errors_do_not_open_the_circuit(breakers, clock):
+    error = types.SimpleNamespace(status=400)
+    for _ in range(3):
+        breakers.record(PLS.POKEMON, 'm0', clock.now, error)
+    assert state(breakers) == CLOSED
+
+
+def test_half_open_probe_closes_or_reopens(breakers, clock):
+    for _ in range(2):
+        breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+    clock.now += 10
+    assert state(breakers) == HALF_OPEN
+
+    # a single probe goes through, the calls behind it fail right away
+    breakers.check(PLS.POKEMON, 'm0')
+    with pytest.raises(CircuitOpenError):
+        breakers.check(PLS.POKEMON, 'm0')
+    breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+    assert state(breakers) == OPEN
+
+    clock.now += 10
+    breakers.check(PLS.POKEMON, 'm0')
+    breakers.record(PLS.POKEMON, 'm0', clock.now)
+    assert state(breakers) == CLOSED
+    breakers.check(PLS.POKEMON, 'm0')
+
+
+def test_probe_that_never_reports_back_is_replaced(breakers, clock):
+    for _ in range(2):
+        breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+    clock.now += 10
+    breakers.check(PLS.POKEMON, 'm0')
+    clock.now += 10
+    breakers.check(PLS.POKEMON, 'm0')
+
+
+def test_only_the_probe_moves_an_open_circuit(breakers, clock):
+    # a slow call sent while the circuit was closed
+    stale = clock.now
+    for _ in range(2):
+        breakers.record(PLS.POKEMON, 'm0', clock.now, ConnectionError())
+
+    breakers.record(PLS.POKEMON, 'm0', stale)
+    assert state(breakers) == OPEN
+
+    clock.now += 10
+    breakers.check(PLS.POKEMON, 'm0')
+    probe = clock.now
+    clock.now += 1
+    breakers.record(PLS.POKEMON, 'm0', stale)
+    assert breakers.breakers[(PLS.POKEMON.value, 'm0')].state == HALF_OPEN
+    breakers.record(PLS.POKEMON, 'm0', probe, ConnectionError())
+    assert state(breakers) == OPEN
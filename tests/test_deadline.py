@@ -0,0 +1,80 @@
+import asyncio
+
+import numpy as np
+import pytest
+from prometheus_client import REGISTRY
+
+import utils.tfs_models as tfs_models
+from utils.batching import MicroBatchers
+from utils.deadline import request_deadline
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.routing import RoutingTables
+from utils.tfs_models import CachedConfigs, EarlyExit, SubmodelLimiter, identify
+
+# m0 routes image 0 to m1 and image 1 to m2
+IDS = {'m0': ['m1', 'm2'], 'm1': ['a', 'b'], 'm2': ['c', 'd']}
+PREDICTIONS = {
+        'm0': [[0.9, 0.1], [0.2, 0.8]],
+        'm1': [[0.7, 0.3]],
+        'm2': [[0.6, 0.4]],
+        }
+
+
+@pytest.fixture
+def delays(fresh, monkeypatch):
+    '''
+    Seconds each model takes to answer, a hierarchy of m0 over two final submodels.
+    '''
+    delays = {'m0': 0.0, 'm1': 0.0, 'm2': 0.0}
+
+    async def predict(self, model_name, pl, instances):
+        await asyncio.sleep(delays[model_name])
+        rows = PREDICTIONS[model_name]
+        return np.array([rows[int(instance[0]) % len(rows)] for instance in instances], dtype=np.float32)
+
+    config = {name: {'is_final': name != 'm0'} for name in IDS}
+    monkeypatch.setattr(MicroBatchers, 'predict', predict)
+    monkeypatch.setattr(RoutingTables, 'get', lambda self, pl, model_name: np.array(IDS[model_name]))
+    monkeypatch.setattr(CachedConfigs, 'request_config', lambda self, pl: config)
+    monkeypatch.setattr(tfs_models, 'has_fused_model', lambda pl: False)
+    fresh(EarlyExit)
+    fresh(SubmodelLimiter)
+    return delays
+
+
+def run(budget: float | None) -> tuple[list, list, list[dict]]:
+    async def identify_with_budget():
+        partial = [{}, {}]
+        with request_deadline(budget):
+            labels, confidences = await identify(np.array([[0.0], [1.0]]), 'm0', PLS.POKEMON, partial=partial)
+        return labels, confidences, partial
+
+    return asyncio.run(identify_with_budget())
+
+
+def deadline_failures(model_name: str) -> float:
+    return REGISTRY.get_sample_value('harmony_failures_total', {'product_line': 'pokemon', 'model': model_name, 'reason': 'deadline'}) or 0.0
+
+
+def test_answers_within_the_budget(delays):
+    labels, confidences, partial = run(1.0)
+    assert labels == ['a', 'c'] and confidences == pytest.approx([0.63, 0.48])
+    assert partial == [{}, {}]
+
+
+def test_slow_submodel_gives_a_partial_answer(delays):
+    delays['m2'] = 1.0
+    before = deadline_failures('m2')
+
+    labels, confidences, partial = run(0.1)
+    # image 0 got its answer, image 1 is reported with the submodel it was routed to and m0's confidence in it
+    assert labels == ['a', None] and confidences == pytest.approx([0.63, 0.8])
+    assert partial == [{}, {'route': 'm2', 'confidence': pytest.approx(0.8)}]
+    assert deadline_failures('m2') == before + 1
+
+
+def test_budget_out_before_the_routing_model_answered(delays):
+    delays['m0'] = 1.0
+    labels, confidences, partial = run(0.05)
+    assert labels == [None, None] and confidences == [0.0, 0.0]
+    assert partial == [{'route': None, 'confidence': 0.0}] * 2
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+from utils.hedging import MAX_SAVED_HEDGES, HedgeState, Hedges
+from utils.product_lines import PRODUCTLINES as PLS
+
+
+@pytest.fixture
+def hedges(fresh):
+    return fresh(Hedges)
+
+
+def hedge_state(hedges, delay: float | None) -> HedgeState:
+    state = HedgeState()
+    state.delay = delay
+    hedges.states[(PLS.POKEMON.value, 'm0')] = state
+    return state
+
+
+def sender(*latencies: float):
+    '''
+    A send whose nth call answers its nth latency later (the last one repeats), with the index of the call.
+    '''
+    calls = []
+
+    async def send():
+        index = len(calls)
+        calls.append(index)
+        await asyncio.sleep(latencies[min(index, len(latencies) - 1)])
+        return index
+
+    return send, calls
+
+
+def test_hedge_that_wins_records_its_own_latency(hedges):
+    state = hedge_state(hedges, 0.05)
+    send, calls = sender(1.0, 0.01)
+
+    assert asyncio.run(hedges.call(PLS.POKEMON, 'm0', send, 90, 1.0, 0.0)) == 1
+    assert (state.hedges, state.wins) == (1, 1)
+    # not the 50ms the call waited before it was hedged
+    assert state.latencies[-1] < 0.04
+
+
+def test_hedges_stay_within_the_budget(hedges):
+    state = hedge_state(hedges, 0.001)
+
+    async def run():
+        results = []
+        for _ in range(8):
+            # the hedges lose, only the counts matter
+            send, _ = sender(0.02, 1.0)
+            results.append(await hedges.call(PLS.POKEMON, 'm0', send, 90, 0.25, 0.0))
+        return results
+
+    assert asyncio.run(run()) == [0] * 8
+    # a hedge costs a whole token and every call earns a quarter of one
+    assert (state.calls, state.hedges, state.over_budget) == (8, 2, 6)
+
+
+def test_saved_hedges_are_capped(hedges):
+    state = hedge_state(hedges, None)
+
+    async def run():
+        for _ in range(30):
+            send, _ = sender(0)
+            await hedges.call(PLS.POKEMON, 'm0', send, 90, 0.5, 0.0)
+
+    asyncio.run(run())
+    assert state.tokens == MAX_SAVED_HEDGES and state.hedges == 0
+
+
+def test_failed_call_is_answered_by_its_hedge(hedges):
+    state = hedge_state(hedges, 0.01)
+    calls = []
+
+    async def send():
+        calls.append(len(calls))
+        if len(calls) == 1:
+            await asyncio.sleep(0.03)
+            raise ConnectionError('primary')
+        await asyncio.sleep(0.05)
+        return 'hedge'
+
+    assert asyncio.run(hedges.call(PLS.POKEMON, 'm0', send, 90, 1.0, 0.0)) == 'hedge'
+    assert state.wins == 1
@@ -0,0 +1,137 @@
+import asyncio
+import os
+import socket
+import sys
+import threading
+import time
+
+import numpy as np
+import pytest
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils import local_inference
+from utils.local_inference import LocalBackend
+
+PL = PLS.POKEMON
+
+
+class FakeModel:
+    '''
+    Stands in for a SavedModel: slow to load, counts its loads.
+    '''
+    loads = 0
+
+    def __init__(self, path: str, version: str, signature_name: str, bytes_signature_name: str):
+        FakeModel.loads += 1
+        time.sleep(0.05)
+        self.path = path
+        self.version = version
+
+    def predict(self, instances) -> np.ndarray:
+        return np.full((len(instances), 2), float(self.version), dtype=np.float32)
+
+    def metadata(self) -> dict:
+        return local_inference.tensor_metadata(self.version, 'input_layer', [None, 4, 4, 3], 2)
+
+
+@pytest.fixture
+def backend(tmp_path, monkeypatch, fresh):
+    monkeypatch.setenv('SAVED_MODEL_DIR', str(tmp_path))
+    (tmp_path / PL.value / 'm0' / '1').mkdir(parents=True)
+    monkeypatch.setattr(local_inference, 'SavedModel', FakeModel)
+    FakeModel.loads = 0
+    backend = fresh(LocalBackend)
+    yield backend
+    asyncio.run(backend.close())
+
+
+def test_version_dir_is_only_listed_on_refresh(backend, tmp_path, monkeypatch):
+    listed = []
+    latest_version_dir = local_inference.latest_version_dir
+    monkeypatch.setattr(local_inference, 'latest_version_dir', lambda model_dir: (listed.append(model_dir), latest_version_dir(model_dir))[1])
+    batch = np.zeros((3, 4, 4, 3), dtype=np.float32)
+
+    async def run():
+        outputs = [await backend.predict('m0', PL, batch) for _ in range(5)]
+        (tmp_path / PL.value / 'm0' / '2').mkdir()
+        # a new version is only seen by the next config refresh
+        outputs.append(await backend.predict('m0', PL, batch))
+        metadata = await backend.metadata('m0', PL)
+        outputs.append(await backend.predict('m0', PL, batch))
+        return outputs, metadata
+
+    outputs, metadata = asyncio.run(run())
+    assert len(listed) == 2
+    assert [float(output[0, 0]) for output in outputs] == [1.0] * 6 + [2.0]
+    assert metadata['model_spec']['version'] == '2'
+    assert FakeModel.loads == 2
+
+
+def test_concurrent_first_calls_load_once(backend):
+    threads = [threading.Thread(target=backend.load, args=('m0', PL)) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert FakeModel.loads == 1
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_parity_with_tfs(tmp_path, monkeypatch, fresh):
+    '''
+    A tiny exported model gives the same softmax through the local backend as through the tfs client, against a stub
+    tfs that runs the same SavedModel (the serve signature, like tensorflow serving).
+    '''
+    tf = pytest.importorskip('tensorflow')
+    from aiohttp import web
+    from benchmarks.stub_tfs import StubModels, make_app
+    from utils.tfs_client import TFSClient
+
+    sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+    from keras_to_saved_model import keras_to_saved_model
+
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+            tf.keras.Input((8, 6, 3), name='input_layer'),
+            tf.keras.layers.Conv2D(4, 3, activation='relu'),
+            tf.keras.layers.GlobalAveragePooling2D(),
+            tf.keras.layers.Dense(5, activation='softmax'),
+            ])
+    model.save(tmp_path / 'm0.keras')
+    version_dir = tmp_path / 'saved_models' / PL.value / 'm0' / '1'
+    keras_to_saved_model(str(tmp_path / 'm0.keras'), str(version_dir))
+    monkeypatch.setenv('SAVED_MODEL_DIR', str(tmp_path / 'saved_models'))
+
+    class SavedModelStub(StubModels):
+        def __init__(self):
+            super().__init__()
+            self.model = local_inference.SavedModel(str(version_dir), '1', 'serve', 'serve_bytes')
+
+        def predict(self, model_name: str, batch) -> np.ndarray:
+            return self.model.predict(batch)
+
+    batch = np.random.default_rng(0).random((6, 8, 6, 3), dtype=np.float32)
+    port = free_port()
+
+    async def run():
+        runner = web.AppRunner(make_app(SavedModelStub()))
+        await runner.setup()
+        await web.TCPSite(runner, '127.0.0.1', port).start()
+        client = fresh(TFSClient)
+        client.configure(PL, {'url': f'http://127.0.0.1:{port}'})
+        local = fresh(LocalBackend)
+        try:
+            return await client.predict('m0', PL, batch), await local.predict('m0', PL, batch)
+        finally:
+            await client.close()
+            await local.close()
+            await runner.cleanup()
+
+    tfs_output, local_output = asyncio.run(run())
+    np.testing.assert_allclose(local_output, tfs_output, rtol=0, atol=1e-6)
+    np.testing.assert_array_equal(local_output.argmax(axis=1), tfs_output.argmax(axis=1))
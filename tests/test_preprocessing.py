@@ -0,0 +1,63 @@
+import io
+
+import numpy as np
+import pytest
+
+from PIL import Image
+
+from api.preprocessing import preprocess_image, resize_bilinear
+
+# what tf.image.resize(image, [height, width]) (bilinear, half pixel centers, no antialiasing) returns for these images,
+# worked out from tensorflow's resize kernel: output pixel i samples the input at (i + 0.5) * in / out - 0.5,
+# clamped to the edge pixels, lerped along the rows first and then between them
+UP = (np.array([[0, 1], [2, 3]]), 4, 4, [
+        [0.0, 0.25, 0.75, 1.0],
+        [0.5, 0.75, 1.25, 1.5],
+        [1.5, 1.75, 2.25, 2.5],
+        [2.0, 2.25, 2.75, 3.0],
+        ])
+DOWN = (np.arange(16).reshape(4, 4), 2, 2, [
+        [2.5, 4.5],
+        [10.5, 12.5],
+        ])
+# 3 rows to 2 samples rows 0.25 and 1.75, 3 columns to 5 samples columns -0.2 (the edge), 0.4, 1.0, 1.6 and 2.2 (the edge)
+UNEVEN = (np.array([[0, 40, 80], [120, 160, 200], [240, 250, 255]]), 2, 5, [
+        [30.0, 46.0, 70.0, 94.0, 110.0],
+        [210.0, 217.0, 227.5, 235.75, 241.25],
+        ])
+RGB = np.array([[[0, 255, 10], [100, 50, 20]], [[200, 0, 30], [255, 255, 40]]], dtype=np.uint8)
+RGB_3X3 = [
+        [[0.0, 255.0, 10.0], [50.0, 152.5, 15.0], [100.0, 50.0, 20.0]],
+        [[100.0, 127.5, 20.0], [138.75, 140.0, 25.0], [177.5, 152.5, 30.0]],
+        [[200.0, 0.0, 30.0], [227.5, 127.5, 35.0], [255.0, 255.0, 40.0]],
+        ]
+
+
+@pytest.mark.parametrize('image, height, width, expected', [UP, DOWN, UNEVEN], ids=['up', 'down', 'uneven'])
+def test_resize_matches_tensorflow(image, height, width, expected):
+    out = resize_bilinear(image.astype(np.uint8)[:, :, None], width, height)
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out[:, :, 0], expected, rtol=0, atol=1e-4)
+
+
+def test_resize_channels_and_out():
+    batch = np.zeros((2, 3, 3, 3), dtype=np.float32)
+    resize_bilinear(RGB, 3, 3, out=batch[1])
+    np.testing.assert_allclose(batch[1], RGB_3X3, rtol=0, atol=1e-4)
+    assert not batch[0].any()
+
+
+def test_preprocess_image_scales_like_training():
+    buffer = io.BytesIO()
+    Image.fromarray(RGB).save(buffer, format='PNG')
+    out = preprocess_image(buffer.getvalue(), 3, 3)
+    np.testing.assert_allclose(out, np.array(RGB_3X3) / 255.0, rtol=0, atol=1e-6)
+    assert preprocess_image(b'not an image', 3, 3) is None
+
+
+@pytest.mark.parametrize('height, width', [(40, 30), (7, 13), (100, 75)])
+def test_resize_matches_installed_tensorflow(height, width):
+    tf = pytest.importorskip('tensorflow')
+    image = np.random.default_rng(0).integers(0, 256, (53, 37, 3), dtype=np.uint8)
+    expected = tf.image.resize(tf.convert_to_tensor(image, dtype=tf.float32), [height, width]).numpy()
+    np.testing.assert_allclose(resize_bilinear(image, width, height), expected, rtol=0, atol=1e-3)
@@ -0,0 +1,111 @@
+import asyncio
+import types
+
+import aiohttp
+import numpy as np
+import pytest
+
+import utils.replicas as replicas
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.replicas import Replicas
+from utils.tfs_client import TFSClient
+
+TARGETS = ['http://a:8501', 'http://b:8501', 'http://c:8501']
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    '''
+    The clock of the replicas, moved by hand: clock.now += seconds.
+    '''
+    clock = types.SimpleNamespace(now=1000.0)
+    monkeypatch.setattr(replicas, 'time', types.SimpleNamespace(monotonic=lambda: clock.now, perf_counter=lambda: clock.now))
+    return clock
+
+
+@pytest.fixture
+def balancer(fresh, clock):
+    balancer = fresh(Replicas)
+    balancer.configure(PLS.POKEMON, 'rest', TARGETS, 'least_outstanding', 0, 2, 10.0)
+    return balancer
+
+
+def call(balancer, error: BaseException | None = None, exclude: list[str] | None = None) -> str:
+    '''
+    A call that fails with error (if any), returns the replica it went to.
+    '''
+    try:
+        with balancer.use(PLS.POKEMON, 'rest', 'm0', exclude) as target:
+            if error is not None:
+                raise error
+    except type(error):
+        pass
+    return target
+
+
+def fail(balancer, target: str, times: int):
+    for _ in range(times):
+        assert call(balancer, ConnectionError(), exclude=[t for t in TARGETS if t != target]) == target
+
+
+def ejected(balancer) -> set[str]:
+    stats = balancer.stats()[PLS.POKEMON.value]['rest']
+    return {target for target, replica in stats.items() if replica['ejected_seconds_left'] > 0}
+
+
+def test_failing_replica_is_ejected_and_comes_back(balancer, clock):
+    fail(balancer, TARGETS[0], 1)
+    assert ejected(balancer) == set()
+    fail(balancer, TARGETS[0], 1)
+    assert ejected(balancer) == {TARGETS[0]}
+    assert TARGETS[0] not in {call(balancer) for _ in range(20)}
+
+    clock.now += 10
+    assert ejected(balancer) == set()
+    # back on probation: its next failure ejects it again, for longer
+    fail(balancer, TARGETS[0], 1)
+    assert balancer.stats()[PLS.POKEMON.value]['rest'][TARGETS[0]]['ejected_seconds_left'] == 20
+
+    clock.now += 20
+    call(balancer, exclude=TARGETS[1:])
+    fail(balancer, TARGETS[0], 1)
+    # a success ended the probation
+    assert ejected(balancer) == set()
+
+
+def test_client_errors_do_not_eject(balancer):
+    for _ in range(5):
+        call(balancer, aiohttp.ClientResponseError(None, (), status=400), exclude=TARGETS[1:])
+    assert ejected(balancer) == set()
+
+
+def test_every_replica_ejected_picks_the_first_back(balancer, clock):
+    for target in TARGETS:
+        fail(balancer, target, 2)
+        clock.now += 1
+    assert ejected(balancer) == set(TARGETS)
+    assert call(balancer) == TARGETS[0]
+
+
+def test_unreachable_replica_is_retried_on_another(fresh, monkeypatch):
+    fresh(Replicas)
+    client = fresh(TFSClient)
+    client.configure(PLS.POKEMON, {'replicas': ','.join(TARGETS[:2]), 'balancer': 'least_outstanding', 'eject_failures': 1})
+    tried = []
+
+    async def predict_rest(model_name, pl, body, base_url, timeout=None):
+        tried.append(base_url)
+        if base_url == TARGETS[0]:
+            raise aiohttp.ClientConnectionError('refused')
+        return np.ones((1, 2), dtype=np.float32)
+
+    monkeypatch.setattr(client, 'predict_rest', predict_rest)
+    # no shuffling: the idle replicas are picked in order, a first
+    monkeypatch.setattr(replicas.random, 'sample', lambda population, k: list(population)[:k])
+
+    async def run():
+        return [await client.send('m0', PLS.POKEMON, b'{}') for _ in range(4)]
+
+    assert all(result.shape == (1, 2) for result in asyncio.run(run()))
+    # the first call to a failed once and went to b, a is ejected after that
+    assert tried.count(TARGETS[0]) == 1 and tried.count(TARGETS[1]) == 4
@@ -0,0 +1,58 @@
+import os
+import pickle
+import time
+
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.routing import RoutingTables
+from utils.tfs_models import CachedConfigs
+from api.cache import PredictionCache
+
+PL = PLS.POKEMON
+
+
+def write_ids(data_dir, model_name: str, _ids: list[str]):
+    pl_dir = data_dir / PL.value
+    pl_dir.mkdir(exist_ok=True)
+    with open(pl_dir / f'{model_name}_ids.pkl', 'wb') as f:
+        pickle.dump(_ids, f)
+
+
+def test_refresh_without_changes_keeps_version_and_cache(data_dir, fresh):
+    write_ids(data_dir, 'm0', ['m1', 'm2'])
+    write_ids(data_dir, 'm1', ['a1', 'a2', 'a3'])
+    tables = fresh(RoutingTables)
+    configs = fresh(CachedConfigs)
+    cache = fresh(PredictionCache)
+    configs.cached_configs[PL.value] = {'m0': {'is_final': False, 'version': 1}}
+
+    tables.load(PL)
+    version = tables.version(PL)
+    key = (PL.value, cache.generation(PL), b'hash')
+    cache.store(key, 'a1', 0.9, time.monotonic())
+
+    # two config refreshes with no file changes
+    tables.load(PL)
+    tables.load(PL)
+
+    assert tables.version(PL) == version
+    assert cache.generation(PL) == key[1]
+    assert cache.lookup(key, time.monotonic(), 0.5) == ('a1', 0.9)
+    assert cache.invalidations == 0
+
+
+def test_refresh_reloads_changed_table(data_dir, fresh):
+    write_ids(data_dir, 'm0', ['m1', 'm2'])
+    write_ids(data_dir, 'm1', ['a1', 'a2'])
+    tables = fresh(RoutingTables)
+    tables.load(PL)
+    version = tables.version(PL)
+
+    write_ids(data_dir, 'm1', ['a1', 'a2', 'a3'])
+    path = data_dir / PL.value / 'm1_ids.pkl'
+    mtime = os.path.getmtime(path) + 10
+    os.utime(path, (mtime, mtime))
+    tables.load(PL)
+
+    assert tables.version(PL) == version + 1
+    assert tables.get(PL, 'm1').tolist() == ['a1', 'a2', 'a3']
+    assert tables.get(PL, 'm0').tolist() == ['m1', 'm2']
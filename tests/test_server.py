@@ -0,0 +1,100 @@
+import asyncio
+import time
+
+import pytest
+from fastapi import FastAPI, HTTPException
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from prometheus_client import REGISTRY
+
+from api.server import InFlightMiddleware
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.tfs_models import CachedConfigs
+
+
+def in_flight(endpoint: str) -> float:
+    return REGISTRY.get_sample_value('harmony_in_flight_requests', {'endpoint': endpoint}) or 0.0
+
+
+def test_streamed_requests_count_until_their_last_line():
+    app = FastAPI()
+    app.add_middleware(InFlightMiddleware)
+    seen = []
+
+    @app.post('/predict/stream')
+    async def stream():
+        async def lines():
+            for i in range(3):
+                await asyncio.sleep(0.01)
+                seen.append(in_flight('/predict/stream'))
+                yield f'{i}\n'
+        return StreamingResponse(lines(), media_type='application/x-ndjson')
+
+    before = in_flight('/predict/stream')
+    with TestClient(app) as client:
+        assert client.post('/predict/stream').text == '0\n1\n2\n'
+    assert seen == [before + 1] * 3
+    assert in_flight('/predict/stream') == before
+
+
+
+def test_ready_isolates_product_lines(monkeypatch):
+    from api.server import ready, ready_product_line
+
+    # lorcana is still loading, pokemon is up
+    loaded = {PLS.POKEMON.value}
+    monkeypatch.setattr(CachedConfigs, 'is_ready', lambda self, pl: pl.value in loaded)
+    monkeypatch.setattr(CachedConfigs, 'start_loading', lambda self, pl: None)
+    monkeypatch.setattr(CachedConfigs, 'status', lambda self: {pl.value: {'ready': pl.value in loaded} for pl in PLS})
+    monkeypatch.setattr(CachedConfigs, 'model_health', lambda self, pl: {'available': pl.value in loaded, 'models': {}})
+
+    status = asyncio.run(ready())
+    assert status['pokemon']['ready'] is True
+    assert status['lorcana']['ready'] is False
+    assert asyncio.run(ready_product_line('pokemon'))['ready'] is True
+    with pytest.raises(HTTPException) as e:
+        asyncio.run(ready_product_line('lorcana'))
+    assert e.value.status_code == 503
+
+
+def test_open_circuit_degrades_only_its_product_line(fresh, monkeypatch):
+    from api.server import health, ready, ready_product_line
+    from utils.circuit import CircuitBreakers
+
+    monkeypatch.setattr(CachedConfigs, 'is_ready', lambda self, pl: True)
+    monkeypatch.setattr(CachedConfigs, 'status', lambda self: {pl.value: {'ready': True} for pl in PLS})
+    monkeypatch.setattr(CachedConfigs, 'model_versions', lambda self, pl: (('m0', 1),))
+    breakers = fresh(CircuitBreakers)
+    breakers.configure(PLS.POKEMON, {'breaker_failures': 1})
+    breakers.record(PLS.POKEMON, 'm0', time.monotonic(), ConnectionError())
+
+    status = asyncio.run(ready())
+    assert status['pokemon'] == {'ready': True, 'available': False, 'models': {'m0': 'open'}}
+    assert status['lorcana'] == {'ready': True, 'available': True, 'models': {'m0': 'closed'}}
+    assert asyncio.run(ready_product_line('pokemon'))['available'] is False
+    assert asyncio.run(health())['status'] == 'degraded'
+
+
+def test_upload_stage_covers_the_multipart_parsing():
+    from fastapi import File, Request, UploadFile
+
+    from api.server import record_upload
+    from utils.timing import request_timings
+
+    app = FastAPI()
+    app.add_middleware(InFlightMiddleware)
+    stages = []
+
+    @app.post('/predict/upload')
+    async def upload(request: Request, images: list[UploadFile] = File(...)):
+        with request_timings() as timings:
+            record_upload(request, PLS.POKEMON)
+        stages.extend(timings)
+        return len(images)
+
+    with TestClient(app) as client:
+        files = [('images', (f'{i}.jpg', bytes(256 * 1024), 'image/jpeg')) for i in range(4)]
+        assert client.post('/predict/upload', files=files).json() == 4
+    (stage, model, seconds), = stages
+    assert (stage, model) == ('upload', '') and seconds > 0
+    assert REGISTRY.get_sample_value('harmony_stage_seconds_count', {'stage': 'upload', 'product_line': 'pokemon', 'model': ''}) >= 1
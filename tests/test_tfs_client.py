@@ -0,0 +1,58 @@
+import asyncio
+
+import numpy as np
+
+import utils.tfs_client as tfs_client
+from utils.hedging import Hedges
+from utils.product_lines import PRODUCTLINES as PLS
+from utils.replicas import Replicas
+from utils.tfs_client import TFSClient
+
+
+def test_hedged_predict_serializes_once(fresh, monkeypatch):
+    client = fresh(TFSClient)
+    client.configure(PLS.POKEMON, {'hedge': 1})
+
+    encoded = []
+    real_encode = tfs_client.encode_instances
+
+    def encode_instances(*args, **kwargs):
+        encoded.append(1)
+        return real_encode(*args, **kwargs)
+
+    bodies = []
+
+    async def send(model_name, pl, body, timeout=None):
+        bodies.append(body)
+        return np.zeros((2, 3), dtype=np.float32)
+
+    async def call(pl, model_name, send, percentile, budget, min_delay):
+        # the call and its hedge
+        first, _ = await asyncio.gather(send(), send())
+        return first
+
+    monkeypatch.setattr(tfs_client, 'encode_instances', encode_instances)
+    monkeypatch.setattr(client, 'send', send)
+    monkeypatch.setattr(fresh(Hedges), 'call', call)
+
+    batch = np.zeros((2, 4, 4, 3), dtype=np.float32)
+    assert asyncio.run(client.predict('m0', PLS.POKEMON, batch)).shape == (2, 3)
+    assert len(encoded) == 1
+    assert len(bodies) == 2 and bodies[0] is bodies[1]
+
+
+def test_session_pool_follows_replicas(fresh):
+    client = fresh(TFSClient)
+    fresh(Replicas)
+    client.configure(PLS.POKEMON, {'pool_size': 4, 'replicas': 'http://a:8501'})
+
+    async def pool():
+        session = client.get_session(PLS.POKEMON)
+        # a replica added by a config refresh gets its own pool_size connections from the same session
+        client.configure(PLS.POKEMON, {'pool_size': 4, 'replicas': 'http://a:8501,http://b:8501,http://c:8501'})
+        assert client.get_session(PLS.POKEMON) is session
+        limits = session.connector.limit, session.connector.limit_per_host
+        await client.close()
+        return limits
+
+    assert asyncio.run(pool()) == (0, 4)
@@ -0,0 +1,74 @@
+import asyncio
+import socket
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('grpc')
+
+from utils.tfs_grpc import GrpcTransport, from_tensor_proto, to_string_tensor_proto, to_tensor_proto
+from utils.tfs_protos import DT_FLOAT, PredictRequest, PredictResponse, TensorProto
+from benchmarks.stub_tfs import StubModels, start_grpc
+
+
+def test_tensor_proto_wire_format():
+    # dtype (1) = DT_FLOAT, tensor_shape (2) { dim (2) { size (1) = 2 } }, tensor_content (4) = 8 bytes,
+    # as encoded by tensorflow's tensor.proto / tensor_shape.proto
+    proto = to_tensor_proto(np.zeros(2, dtype=np.float32))
+    assert proto.SerializeToString() == bytes([0x08, 0x01, 0x12, 0x04, 0x12, 0x02, 0x08, 0x02, 0x22, 0x08]) + bytes(8)
+    assert proto.dtype == DT_FLOAT
+
+
+def test_predict_request_wire_format():
+    request = PredictRequest()
+    request.model_spec.name = 'm0'
+    request.model_spec.signature_name = 'serve_bytes'
+    request.inputs['x'].CopyFrom(to_string_tensor_proto([b'ab']))
+    # model_spec (1) { name (1), signature_name (3) }, inputs (2) { key (1), value (2) { dtype (1) = DT_STRING,
+    # tensor_shape (2) { dim (2) { size (1) = 1 } }, string_val (8) } }
+    tensor = bytes([0x08, 0x07, 0x12, 0x04, 0x12, 0x02, 0x08, 0x01, 0x42, 0x02]) + b'ab'
+    entry = bytes([0x0a, 0x01]) + b'x' + bytes([0x12, len(tensor)]) + tensor
+    model_spec = bytes([0x0a, 0x02]) + b'm0' + bytes([0x1a, 0x0b]) + b'serve_bytes'
+    assert request.SerializeToString() == bytes([0x0a, len(model_spec)]) + model_spec + bytes([0x12, len(entry)]) + entry
+
+
+def test_predict_response_roundtrip():
+    # outputs is field 1 of PredictResponse, model_spec field 2 (the other way around from the request)
+    response = PredictResponse()
+    response.model_spec.name = 'm0'
+    response.outputs['output_0'].CopyFrom(TensorProto(dtype=DT_FLOAT, float_val=[0.25, 0.75]))
+    response.outputs['output_0'].tensor_shape.dim.add(size=1)
+    response.outputs['output_0'].tensor_shape.dim.add(size=2)
+    data = response.SerializeToString()
+    assert data[0] == 0x0a and data[-6:] == bytes([0x12, 0x04, 0x0a, 0x02]) + b'm0'
+    output = from_tensor_proto(PredictResponse.FromString(data).outputs['output_0'])
+    np.testing.assert_array_equal(output, [[0.25, 0.75]])
+
+
+def test_does_not_import_tensorflow():
+    assert 'tensorflow' not in sys.modules
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def test_predict_against_stub():
+    async def run():
+        port = free_port()
+        models = StubModels({'m0': 3})
+        server = await start_grpc(models, port)
+        transport = GrpcTransport(f'127.0.0.1:{port}', 'input_layer', 'serve', 'bytes', 'serve_bytes', 'float32', 5.0)
+        try:
+            batch = np.random.default_rng(0).random((4, 8, 6, 3), dtype=np.float32)
+            return await transport.predict('m0', transport.encode('m0', batch)), models.predict('m0', batch)
+        finally:
+            await transport.close()
+            await server.stop(None)
+
+    output, expected = asyncio.run(run())
+    assert output.shape == (4, 3)
+    np.testing.assert_array_equal(output, expected)